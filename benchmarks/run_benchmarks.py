@@ -0,0 +1,210 @@
+"""
+Times MIMIC's own Python work (genome list preparation, species file, merging, scoring) on synthetic
+data across read and taxa counts, so regressions show up without running Lemur, MAGnet, NanoSim or
+Kraken2. With --pipeline, the whole of mimic.py is also run end to end against the stand-in executables
+in benchmarks/stubs and the per-stage times of its run report are collected.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --reads 1000 100000 --taxa 10 1000 -o bench.tsv
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+from src.evaluation import EvaluationTruth, evaluate_classifiers, rescore_kraken2_nanosim_output_by_rank, score_kraken2_nanosim_output
+from src.ncbi_taxonomy_utils import NCBItaxonomy
+from src.seq_utils import merge_shuffle_reads
+from src.sim import TruthTableWriter, generate_species_file_info, plan_read_counts, prep_sim_lemur, read_genome_list
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(REPO_ROOT, 'benchmarks', 'stubs')
+RESULT_COLUMNS = ['benchmark', 'n_taxa', 'n_reads', 'repeats', 'best_s', 'mean_s']
+
+def time_call(func, repeat:int, setup=None):
+    """Best and mean wall time of func() over repeat calls; setup() runs untimed before each call"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return min(times), statistics.mean(times)
+
+class Results():
+
+    def __init__(self, out_loc:str=None):
+        self.rows = []
+        self.out_loc = out_loc
+        print('\t'.join(RESULT_COLUMNS))
+
+    def add(self, benchmark:str, n_taxa, n_reads, repeat:int, times):
+        row = [benchmark, n_taxa, n_reads, repeat, round(times[0], 4), round(times[1], 4)]
+        self.rows.append(row)
+        print('\t'.join(str(r) for r in row), flush=True)
+
+    def write(self):
+        if self.out_loc is None:
+            return
+        with open(self.out_loc, 'w') as f:
+            f.write('\t'.join(RESULT_COLUMNS) + '\n')
+            for row in self.rows:
+                f.write('\t'.join(str(r) for r in row) + '\n')
+
+def prepare_sample(working:str, n_taxa:int, seed:int, genome_length:int):
+    """Lemur and MAGnet outputs plus the taxonomy for n_taxa, laid out like a MIMIC working directory"""
+    for sub in ['lemur', 'magnet', 'nanosim', 'taxonomy']:
+        os.makedirs(os.path.join(working, sub), exist_ok=True)
+    lemur_loc = synthetic.write_lemur_output(os.path.join(working, 'lemur', 'relative_abundance.tsv'), n_taxa, seed)
+    synthetic.write_magnet_output(os.path.join(working, 'magnet'), n_taxa, seed, genome_length=genome_length)
+    synthetic.write_taxonomy(os.path.join(working, 'taxonomy'), n_taxa)
+    return lemur_loc, os.path.join(working, 'magnet', 'cluster_representative.csv')
+
+def bench_taxa(results:Results, working:str, n_taxa:int, args):
+    """Benchmarks that only depend on the number of taxa"""
+    lemur_loc, magnet_report = prepare_sample(working, n_taxa, args.seed, args.genome_length)
+    nanosim_loc = os.path.join(working, 'nanosim')
+
+    results.add('prep_sim_lemur', n_taxa, '', args.repeat, time_call(
+        lambda: prep_sim_lemur(magnet_report, lemur_loc, nanosim_loc, working), args.repeat))
+
+    genome_list = read_genome_list(os.path.join(nanosim_loc, 'genome_list1.tsv'))
+    def remove_indexes():
+        for fai in os.listdir(os.path.join(working, 'magnet', 'reference_genomes')):
+            if fai.endswith('.fai'):
+                os.remove(os.path.join(working, 'magnet', 'reference_genomes', fai))
+    results.add('generate_species_file_info (cold)', n_taxa, '', args.repeat, time_call(
+        lambda: generate_species_file_info(genome_list, nanosim_loc), args.repeat, setup=remove_indexes))
+    results.add('generate_species_file_info (indexed)', n_taxa, '', args.repeat, time_call(
+        lambda: generate_species_file_info(genome_list, nanosim_loc), args.repeat))
+    results.add('plan_read_counts (length weighted)', n_taxa, '', args.repeat, time_call(
+        lambda: plan_read_counts(genome_list, 10000000, length_weighted=True), args.repeat))
+
+def bench_reads(results:Results, working:str, n_taxa:int, n_reads:int, ncbitax, args):
+    """Benchmarks over the simulated reads and the Kraken2 output for them"""
+    present = synthetic.present_taxa(n_taxa, args.seed)
+    weights = synthetic.abundances(n_taxa, args.seed)
+    species = [synthetic.species_name(i) for i in present]
+    read_files = synthetic.write_nanosim_reads(os.path.join(working, 'nanosim', 'simulated'), species, [weights[i] for i in present],
+                                               n_reads, seed=args.seed, read_length=args.read_length)
+    merged_loc = os.path.join(working, 'simulated.fasta')
+
+    if n_taxa == min(args.taxa):
+        ## merging only depends on the reads, so it is timed once per read count
+        results.add('merge_shuffle_reads', '', n_reads, args.repeat, time_call(
+            lambda: merge_shuffle_reads(read_files, merged_loc, seed=args.seed), args.repeat))
+    else:
+        merge_shuffle_reads(read_files, merged_loc, seed=args.seed)
+
+    read_names, true_taxids = [], []
+    name_to_taxid = {synthetic.species_name(i).replace(' ', '_'): synthetic.species_taxid(i) for i in present}
+    with open(merged_loc, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                read_names.append(name)
+                true_taxids.append(name_to_taxid.get(name.split('-')[0], 0))
+    kraken2_output = synthetic.write_kraken2_output(os.path.join(working, 'kraken2_output.txt'), read_names, true_taxids, args.seed, n_taxa)
+
+    magnet_folder = os.path.join(working, 'magnet')
+    scores = {}
+    def score():
+        scores['records'] = score_kraken2_nanosim_output(kraken2_output, magnet_folder)[3]
+    results.add('score_kraken2_nanosim_output', n_taxa, n_reads, args.repeat, time_call(score, args.repeat))
+    results.add('rescore_kraken2_nanosim_output_by_rank', n_taxa, n_reads, args.repeat, time_call(
+        lambda: rescore_kraken2_nanosim_output_by_rank(scores['records'], ncbitax), args.repeat))
+
+    ## rescoring against the columnar truth cache only parses the classifier output
+    truth_loc = write_truth_table(os.path.join(working, 'truth_table'), read_names, true_taxids)
+    cache_dir = os.path.join(working, 'truth_cache')
+    EvaluationTruth.cached(truth_loc, ncbitax, cache_dir)
+    results.add('evaluate_classifiers (cached truth)', n_taxa, n_reads, args.repeat, time_call(
+        lambda: evaluate_classifiers({'kraken2': ('kraken2', kraken2_output)}, EvaluationTruth.cached(truth_loc, ncbitax, cache_dir), ncbitax),
+        args.repeat))
+    del read_names, true_taxids
+
+    for loc in read_files + [merged_loc, kraken2_output, truth_loc]:
+        os.remove(loc)
+    shutil.rmtree(cache_dir)
+
+def write_truth_table(out_loc:str, read_names, true_taxids):
+    """A truth table with the read IDs and true taxa of the synthetic reads (the other columns are filler)"""
+    writer = TruthTableWriter(out_loc)
+    n = len(read_names)
+    filler = {c: [''] * n for c in ['species', 'assembly_accession', 'contig', 'strand']}
+    writer.write_batch(dict(filler, read_id=read_names, true_taxid=true_taxids, length=[0] * n, aligned=[True] * n, perfect=[True] * n))
+    writer.close()
+    return writer.out_loc
+
+def bench_pipeline(results:Results, working:str, n_taxa:int, n_reads:int, args):
+    """Runs mimic.py end to end with the stand-in tools and records every stage of its run report"""
+    run_dir = os.path.join(working, 'pipeline')
+    os.makedirs(run_dir, exist_ok=True)
+    if not os.path.exists(os.path.join(run_dir, 'magnet')):
+        os.symlink(os.path.join(STUBS, 'magnet'), os.path.join(run_dir, 'magnet'))
+    fastq = os.path.join(run_dir, 'input.fastq')
+    with open(fastq, 'w') as f:
+        source = synthetic.ReadSource(args.seed)
+        for i in range(1000):
+            seq = source.read(args.read_length)
+            f.write(f'@read{i}\n{seq}\n+\n{"I" * len(seq)}\n')
+    lemur_db = os.path.join(run_dir, 'lemur_db')
+    os.makedirs(lemur_db, exist_ok=True)
+
+    env = dict(os.environ, PATH=STUBS + os.pathsep + os.environ.get('PATH', ''), MIMIC_BENCH_TAXA=str(n_taxa),
+               MIMIC_BENCH_READ_LENGTH=str(args.read_length), MIMIC_BENCH_GENOME_LENGTH=str(args.genome_length),
+               MIMIC_BENCH_SEED=str(args.seed))
+    out = os.path.join(run_dir, 'out')
+    shutil.rmtree(out, ignore_errors=True)
+    cmd = [sys.executable, os.path.join(REPO_ROOT, 'mimic.py'), '-i', fastq, '-o', out, '--db', lemur_db, '-r', str(n_reads),
+           '-t', str(args.threads), '--seed', str(args.seed), '--kraken2-db', lemur_db,
+           '--genome-store', os.path.join(run_dir, 'genome_store'), '--no-model-cache']
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=run_dir, env=env, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    results.add('mimic.py (stubbed tools)', n_taxa, n_reads, 1, (wall, wall))
+    with open(os.path.join(out, 'run_report.json'), 'r') as f:
+        for stage in json.load(f)['stages']:
+            results.add(f'stage {stage["stage"]}', n_taxa, n_reads, 1, (stage['wall_time'], stage['wall_time']))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks of MIMIC with synthetic data and stand-in tools')
+    parser.add_argument('--reads', type=int, nargs='+', default=[1000, 10000, 100000, 1000000, 10000000], help='Read counts to benchmark (Default: 1k to 10M)')
+    parser.add_argument('--taxa', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Taxa counts to benchmark (Default: 10 to 10k)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed repeats of each benchmark, the best is reported (Default: 3)')
+    parser.add_argument('--read-length', type=int, default=200, help='Mean length of the synthetic reads (Default: 200)')
+    parser.add_argument('--genome-length', type=int, default=5000, help='Length of the synthetic reference genomes (Default: 5000)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data (Default: 0)')
+    parser.add_argument('--pipeline', action='store_true', help='Also run mimic.py end to end with the stand-in tools')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Threads for the end to end runs (Default: 1)')
+    parser.add_argument('--tmp-dir', type=str, help='Where the synthetic data is written (Default: system temp dir)')
+    parser.add_argument('-o', '--output', type=str, help='Write the results as TSV to this file')
+    args = parser.parse_args()
+
+    results = Results(args.output)
+    for n_taxa in sorted(args.taxa):
+        working = tempfile.mkdtemp(prefix=f'mimic_bench_{n_taxa}_', dir=args.tmp_dir)
+        try:
+            bench_taxa(results, working, n_taxa, args)
+            with contextlib.redirect_stdout(io.StringIO()):
+                ncbitax = NCBItaxonomy(os.path.join(working, 'taxonomy'))
+            for n_reads in sorted(args.reads):
+                bench_reads(results, working, n_taxa, n_reads, ncbitax, args)
+                if args.pipeline:
+                    bench_pipeline(results, working, n_taxa, n_reads, args)
+        finally:
+            shutil.rmtree(working, ignore_errors=True)
+            results.write()
+
+if __name__ == '__main__':
+    parse_args()
@@ -0,0 +1,18 @@
+"""
+Shared helpers of the stand-in executables: argument lookup and the benchmark sizes, which are passed
+through the environment by run_benchmarks.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+
+N_TAXA = int(os.environ.get('MIMIC_BENCH_TAXA', '100'))
+READ_LENGTH = int(os.environ.get('MIMIC_BENCH_READ_LENGTH', '200'))
+GENOME_LENGTH = int(os.environ.get('MIMIC_BENCH_GENOME_LENGTH', '5000'))
+SEED = int(os.environ.get('MIMIC_BENCH_SEED', '0'))
+
+def arg(flag:str, default=None):
+    """Value following flag on the command line"""
+    return sys.argv[sys.argv.index(flag) + 1] if flag in sys.argv else default
@@ -0,0 +1,9 @@
+"""Stand-in for magnet/magnet.py: writes cluster_representative.csv and reference genomes"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import _common
+from synthetic import write_magnet_output
+
+write_magnet_output(_common.arg('-o'), _common.N_TAXA, _common.SEED, genome_length=_common.GENOME_LENGTH)
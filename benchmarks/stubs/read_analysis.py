@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""Stand-in for NanoSim's read_analysis.py: writes small placeholder model files"""
+import os
+import sys
+import _common
+
+if '--version' in sys.argv:
+    print('NanoSim 3.1.0 (benchmark stand-in)')
+    sys.exit(0)
+
+prefix = _common.arg('-o')
+os.makedirs(os.path.dirname(prefix), exist_ok=True)
+for suffix in ['_model_profile', '_error_markov_model', '_first_match.hist', '_aligned_reads.pkl', '_reads_alignment_rate']:
+    with open(prefix + suffix, 'w') as f:
+        f.write('benchmark stand-in model\n')
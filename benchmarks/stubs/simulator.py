@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""Stand-in for NanoSim's simulator.py metagenome: writes reads with NanoSim-style names drawn by abundance"""
+import sys
+import _common
+from synthetic import write_nanosim_reads
+
+with open(_common.arg('-a'), 'r') as f:
+    size_line, *species_lines = f.read().splitlines()
+n_reads = int(size_line.split('\t')[1])
+species = [line.split('\t')[0] for line in species_lines]
+weights = [max(float(line.split('\t')[1]), 1e-9) for line in species_lines]
+
+contigs = {}
+with open(_common.arg('-dl'), 'r') as f:
+    for line in f:
+        name, contig = line.rstrip('\n').split('\t')[:2]
+        contigs.setdefault(name, contig)
+
+prefix = _common.arg('-o')
+seed = int(_common.arg('--seed', _common.SEED))
+write_nanosim_reads(prefix, species, weights, n_reads, seed=seed, read_length=_common.READ_LENGTH, contigs=contigs)
+if '--perfect' not in sys.argv:
+    with open(f'{prefix}_sample0_aligned_error_profile', 'w') as f:
+        f.write('benchmark stand-in error profile\n')
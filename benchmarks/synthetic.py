@@ -0,0 +1,139 @@
+"""
+Synthetic stand-ins for the files the external tools produce (Lemur abundances, MAGnet cluster
+representatives and reference genomes, NanoSim reads, Kraken2 output) and a matching NCBI taxonomy,
+sized by number of taxa and reads. The same seed always gives the same files.
+"""
+import os
+import random
+
+## species i sits in genus i // 4, family i // 16, ... so lineages share ancestors like real ones
+RANK_DIVISORS = [('genus', 4), ('family', 16), ('order', 64), ('class', 256), ('phylum', 1024)]
+RANK_BASES = {'species': 1000000, 'genus': 2000000, 'family': 3000000, 'order': 4000000, 'class': 5000000, 'phylum': 6000000}
+SUPERKINGDOM_TAXID = 2
+
+def species_taxid(i:int):
+    return RANK_BASES['species'] + i
+
+def species_name(i:int):
+    return f'Synthetica species{i}'
+
+def species_accession(i:int):
+    return f'GCF_{900000000 + i}.1'
+
+def species_contigs(i:int):
+    return [f'NZ_CP{i:06d}.1', f'NZ_PL{i:06d}.1']
+
+def lineage(i:int):
+    """(rank, taxid) from the species up to the phylum"""
+    out = [('species', species_taxid(i))]
+    for rank, divisor in RANK_DIVISORS:
+        out.append((rank, RANK_BASES[rank] + i // divisor))
+    return out
+
+def write_taxonomy(taxdmp_folder:str, n_taxa:int):
+    """Writes nodes.dmp and names.dmp covering species 0..n_taxa-1 and their ancestors"""
+    os.makedirs(taxdmp_folder, exist_ok=True)
+    nodes = {1: (1, 'no rank', 'root'), SUPERKINGDOM_TAXID: (1, 'superkingdom', 'Bacteria')}
+    for i in range(n_taxa):
+        ranks = lineage(i)
+        for (rank, taxid), (_, parent) in zip(ranks, ranks[1:] + [('superkingdom', SUPERKINGDOM_TAXID)]):
+            nodes[taxid] = (parent, rank, species_name(i) if rank == 'species' else f'Synthetic {rank} {taxid}')
+    with open(os.path.join(taxdmp_folder, 'nodes.dmp'), 'w') as nodes_f, open(os.path.join(taxdmp_folder, 'names.dmp'), 'w') as names_f:
+        for taxid in sorted(nodes):
+            parent, rank, name = nodes[taxid]
+            nodes_f.write(f'{taxid}\t|\t{parent}\t|\t{rank}\t|\t\t|\n')
+            names_f.write(f'{taxid}\t|\t{name}\t|\t\t|\tscientific name\t|\n')
+    return taxdmp_folder
+
+def abundances(n_taxa:int, seed:int=0):
+    """Log-normal relative abundances summing to 1, like a real community profile"""
+    rng = random.Random(seed)
+    weights = [rng.lognormvariate(0, 2) for _ in range(n_taxa)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+def write_lemur_output(out_loc:str, n_taxa:int, seed:int=0):
+    """relative_abundance.tsv as written by Lemur"""
+    with open(out_loc, 'w') as f:
+        f.write('F\tTarget_ID\tspecies\tgenus\tfamily\torder\tclass\tphylum\tsuperkingdom\n')
+        for i, abundance in enumerate(abundances(n_taxa, seed)):
+            names = [species_name(i)] + [f'Synthetic {rank} {taxid}' for rank, taxid in lineage(i)[1:]]
+            f.write(f'{abundance:.6g}\t{species_taxid(i)}\t' + '\t'.join(names) + '\tBacteria\n')
+    return out_loc
+
+def present_taxa(n_taxa:int, seed:int=0, present_fraction:float=0.9):
+    rng = random.Random(seed + 1)
+    return [i for i in range(n_taxa) if rng.random() < present_fraction]
+
+def write_magnet_output(out_folder:str, n_taxa:int, seed:int=0, genome_length:int=5000, present_fraction:float=0.9):
+    """cluster_representative.csv as written by MAGnet, plus a reference genome (chromosome and plasmid)
+    for every taxon called present"""
+    os.makedirs(os.path.join(out_folder, 'reference_genomes'), exist_ok=True)
+    present = set(present_taxa(n_taxa, seed, present_fraction))
+    rng = random.Random(seed + 2)
+    with open(os.path.join(out_folder, 'cluster_representative.csv'), 'w') as f:
+        f.write('Taxonomy ID,Species Taxonomy ID,Cluster,Representative,Assembly Accession ID,Organism of Assembly,Total Reads,Mapped,Ratio,Presence/Absence\n')
+        for i in range(n_taxa):
+            total = rng.randint(10, 1000)
+            mapped = total if i in present else rng.randint(0, total // 10)
+            f.write(f'{species_taxid(i)},{species_taxid(i)},{i},1,{species_accession(i)},{species_name(i)},{total},{mapped},'
+                    f'{mapped / total:.3f},{"Present" if i in present else "Absent"}\n')
+
+    for i in sorted(present):
+        chromosome, plasmid = species_contigs(i)
+        with open(os.path.join(out_folder, 'reference_genomes', f'{species_accession(i)}.fasta'), 'w') as f:
+            for contig, length in [(chromosome, genome_length), (plasmid, max(1, genome_length // 10))]:
+                seq = ''.join(rng.choices('ACGT', k=length))
+                f.write(f'>{contig} {species_name(i)}\n')
+                f.write('\n'.join(seq[j:j + 80] for j in range(0, len(seq), 80)) + '\n')
+    return out_folder
+
+class ReadSource():
+    """Fast random reads: slices of one pre-generated random sequence"""
+
+    def __init__(self, seed:int=0, pool_size:int=1 << 20):
+        self.rng = random.Random(seed)
+        self.pool = ''.join(self.rng.choices('ACGT', k=pool_size))
+
+    def read(self, length:int):
+        start = self.rng.randrange(0, len(self.pool) - length)
+        return self.pool[start:start + length]
+
+def nanosim_read_name(species:str, contig:str, position:int, index:int, strand:str, length:int, aligned:bool=True):
+    return f'{species.replace(" ", "_")}-{contig}_{position}_{"aligned" if aligned else "unaligned"}_{index}_{strand}_0_{length}_0'
+
+def write_nanosim_reads(out_prefix:str, species:list, weights:list, n_reads:int, seed:int=0, read_length:int=200,
+                        unaligned_fraction:float=0.02, contigs:dict=None):
+    """<out_prefix>_sample0_aligned_reads.fasta and _unaligned_reads.fasta as written by NanoSim metagenome mode.
+    contigs maps species to the contig the reads are drawn from (default: a synthetic name)"""
+    source = ReadSource(seed)
+    rng = source.rng
+    chosen = rng.choices(range(len(species)), weights=weights, k=n_reads)
+    aligned_loc = f'{out_prefix}_sample0_aligned_reads.fasta'
+    unaligned_loc = f'{out_prefix}_sample0_unaligned_reads.fasta'
+    with open(aligned_loc, 'w') as aligned_f, open(unaligned_loc, 'w') as unaligned_f:
+        for index, s in enumerate(chosen):
+            length = max(50, int(rng.gauss(read_length, read_length / 4)))
+            aligned = rng.random() >= unaligned_fraction
+            contig = contigs.get(species[s], 'NZ_CP000000.1') if contigs is not None else 'NZ_CP000000.1'
+            name = nanosim_read_name(species[s], contig, rng.randrange(0, 100000), index, rng.choice('FR'), length, aligned)
+            (aligned_f if aligned else unaligned_f).write(f'>{name}\n{source.read(length)}\n')
+    return [aligned_loc, unaligned_loc]
+
+def write_kraken2_output(out_loc:str, read_names, true_taxids, seed:int=0, n_taxa:int=None):
+    """Kraken2 output.txt for the given reads: mostly the true species, some at the genus, some wrong and some
+    unclassified, roughly like a real run"""
+    rng = random.Random(seed + 3)
+    with open(out_loc, 'w') as f:
+        for name, taxid in zip(read_names, true_taxids):
+            r = rng.random()
+            if r < 0.1 or taxid == 0:
+                est = 0
+            elif r < 0.75:
+                est = taxid
+            elif r < 0.9:
+                est = RANK_BASES['genus'] + (taxid - RANK_BASES['species']) // 4
+            else:
+                est = species_taxid(rng.randrange(n_taxa)) if n_taxa else taxid
+            f.write(f"{'U' if est == 0 else 'C'}\t{name}\t{est}\t{rng.randint(100, 2000)}\t{est}:10 0:5\n")
+    return out_loc
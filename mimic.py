@@ -11,12 +11,30 @@ Mimic creates simulated metagenomes based off of real existing metagenomes.
 '''
 
 import argparse
+import concurrent.futures
+import copy
+import glob
+import math
 import os
+import shutil
 import pathlib
-import subprocess
+import sys
+import time
+
+import pandas as pd
 
 from src.tax_identification import run_bracken, run_kraken2, run_lemur, parse_magnet_output
-from src.sim import generate_species_file_info, prep_sim_lemur, run_read_analysis, run_sim
+from src.sim import generate_species_file_info, generate_truth_table, plan_read_counts, TRUTH_TABLE_SUFFIXES, truth_table_loc, prep_sim_lemur, read_genome_list, read_length_distribution, run_read_analysis, run_sim_sharded, shard_read_renamer, simulate_perfect_reads, subsample_training_reads, write_nanosim_abundances, write_read_plan
+from src.pipeline import Pipeline, ResourceBudget, STATE_DIRNAME
+from src.instrumentation import METRIC_FIELDS, run_command
+from src.seq_utils import merge_shuffle_reads
+from src.io_utils import COMPRESSIONS, EXTENSIONS, detect_compression
+from src.fastq_stats import profile_fastx, read_fastq_stats, write_fastq_stats
+from src.genome_store import DEFAULT_GENOME_STORE, GenomeStore
+from src.model_cache import DEFAULT_MODEL_CACHE, ModelCache, genome_list_digest, nanosim_version, reset_training_dir
+from src.evaluation import PROFILE_PARSERS, READ_PARSERS, EvaluationTruth, evaluate_classifiers, write_evaluation
+from src.ncbi_taxonomy_utils import load_ncbi_taxonomy
+from src.server import DEFAULT_PORT, JobArgumentError, JobArgumentParser, JobServer, serve
 
 __author__ = "Ryan Doughty, Iva Kotaskova, Kasambula Arthur Shem, Shwetha Kumar, Mike Nute, Todd Treangen"
 __contact__ = "rdd4@rice.edu"
@@ -26,6 +44,9 @@ __version__ = "0.1"
 __email__ = "rdd4@rice.edu"
 __status__ = "Development"
 
+EVAL_CLASSIFIERS = ['kraken2', 'bracken', 'lemur']
+PIPELINE_STAGES = ['lemur', 'fastq_stats', 'magnet', 'prep', 'species_info', 'read_analysis', 'plan', 'simulate', 'merge', 'truth_table', 'kraken2', 'lemur_eval']
+
 def print_info():
     """
     Prints tool information
@@ -38,30 +59,26 @@ def print_info():
     print(f'Status: {__status__}\n\n')
     
 def initialize_working(working:str):
-    """Initializes working directory, creates necessary sub directories"""
+    """Initializes working directory, creates necessary sub directories. An existing directory is reused
+    only if it holds the state of an earlier MIMIC run, so that run can be resumed"""
 
-    if os.path.exists(working):
-        raise SystemExit('Initializing Working Directory Failed, working directory already exists')
-    else:
-        os.mkdir(working)
-        
-        lemur = os.path.join(working, 'lemur')
-        os.mkdir(lemur)
-        
-        magnet = os.path.join(working, 'magnet')
-        os.mkdir(magnet)
-        
-        nanosim = os.path.join(working, 'nanosim')
-        os.mkdir(nanosim)
-        
-        simulated_data = os.path.join(working, 'simulated_data')
-        os.mkdir(simulated_data)
-        
-        print('Initialized Working Directory\n')
+    if os.path.exists(working) and os.listdir(working) and not os.path.isdir(os.path.join(working, STATE_DIRNAME)):
+        raise SystemExit('Initializing Working Directory Failed, working directory already exists and is not a MIMIC run')
     
-def run_mimic(args):
+    for sub in ['lemur', 'magnet', 'nanosim', 'simulated_data']:
+        os.makedirs(os.path.join(working, sub), exist_ok=True)
+    
+    print('Initialized Working Directory\n')
+    
+def database_size(path:str):
+    """Total size in bytes of a database directory (or file), used as the memory estimate of the tools that load it"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+def run_mimic(args, budget:ResourceBudget=None, sample_name:str=None):
     """
-    Main pipeline function for the MIMIC
+    Main pipeline function for the MIMIC. budget and sample_name are set when the sample is one of a batch
     """
     fastq1 = args.fastq
     fastq2 = args.fastq2
@@ -71,76 +88,477 @@ def run_mimic(args):
     num_reads = args.reads
     simulate_only = args.simulate_only
     perfect = args.perfect
+    force_from = args.force_from
+    kraken2_db = args.kraken2_db
+    seed = args.seed
+    compress = args.compress
+    sim_shards = args.sim_shards
+    length_weighted = args.length_weighted
+    sim_engine = args.sim_engine
+    if sim_engine == 'native' and not perfect:
+        raise SystemExit('The native simulation engine only generates perfect reads, use it with --perfect')
+    ## MIMIC's own steps read any compression, but Lemur, MAGnet, NanoSim and Kraken2 only take plain or gzipped reads
+    if any(fastq is not None and os.path.exists(fastq) and detect_compression(fastq) == 'zstd' for fastq in [fastq1, fastq2]):
+        raise SystemExit('zstd compressed input reads are not supported by Lemur and MAGnet, use plain or gzipped fastq')
+    if compress == 'zstd' and kraken2_db is not None:
+        raise SystemExit('Kraken2 and Lemur cannot read zstd compressed reads, use --compress gzip or bgzip with --kraken2-db')
+    training_subsample = None if args.no_subsample else {'reads': args.training_reads, 'bases': args.training_bases, 'seed': args.training_seed}
+    genome_store = GenomeStore(args.genome_store) if not args.no_genome_store else None
+    model_cache = ModelCache(args.model_cache, max_bytes=int(args.model_cache_size * 1024**3)) if not args.no_model_cache else None
     
     nanosim_loc = os.path.join(output, 'nanosim')
     lemur_out = os.path.join(output, 'lemur')
     magnet_out = os.path.join(output, 'magnet')
-
+    report_loc = os.path.join(lemur_out, 'relative_abundance.tsv')
+    magnet_report = os.path.join(magnet_out, 'cluster_representative.csv')
+    genome_list1_loc = os.path.join(nanosim_loc, 'genome_list1.tsv')
+    genome_list2_loc = os.path.join(nanosim_loc, 'genome_list2.tsv')
+    abundances = os.path.join(nanosim_loc, 'abundances.tsv')
+    read_plan_loc = os.path.join(nanosim_loc, 'read_counts.tsv')
+    species_loc = os.path.join(nanosim_loc, 'species_info.tsv')
+    fastq_stats_loc = os.path.join(output, 'input_stats.json')
+    simulated_loc = os.path.join(output, 'simulated_data', 'simulated.fasta' + EXTENSIONS[compress])
+    evaluation_loc = os.path.join(output, 'evaluation')
     
     if not simulate_only:
         initialize_working(output)
-        
-        ## run lemur
-        report_loc = run_lemur(fastq1, lemur_db, lemur_out, threads=threads)
-        report_loc = os.path.join(lemur_out, 'relative_abundance.tsv')
-                
+    
+    def lemur_stage(n_threads):
+        run_lemur(fastq1, lemur_db, lemur_out, threads=n_threads)
+    
+    def fastq_stats_stage(n_threads):
+        write_fastq_stats(profile_fastx(fastq1, processes=n_threads), fastq_stats_loc, source=fastq1)
+    
+    def magnet_stage(n_threads):
+        reference_genomes = os.path.join(magnet_out, 'reference_genomes')
+        if genome_store is not None:
+            genome_store.unlink_folder(reference_genomes)
         if fastq2 is not None:
-            subprocess.run(['python', 'magnet/magnet.py',
-                            '-c', report_loc,
-                            '-i', fastq1,
-                            '-I', fastq2, 
-                            '-o', magnet_out,
-                            '--threads', str(threads)], check=True)
+            run_command(['python', 'magnet/magnet.py',
+                         '-c', report_loc,
+                         '-i', fastq1,
+                         '-I', fastq2, 
+                         '-o', magnet_out,
+                         '--threads', str(n_threads)])
         else:
-            subprocess.run(['python', 'magnet/magnet.py',
-                            '-c', report_loc,
-                            '-i', fastq1,
-                            '-o', magnet_out,
-                            '-a', '12',
-                            '--threads', str(threads)], check=True)
+            run_command(['python', 'magnet/magnet.py',
+                         '-c', report_loc,
+                         '-i', fastq1,
+                         '-o', magnet_out,
+                         '-a', '12',
+                         '--threads', str(n_threads)])
         
-        magnet_report = os.path.join(magnet_out, 'cluster_representative.csv')
         if not os.path.exists(magnet_report):
             raise SystemExit('Magnet failed')
         
+        ## keep one copy of each reference across samples, the working directory only gets links to it
+        if genome_store is not None:
+            magnet_data = pd.read_csv(magnet_report)
+            taxids = dict(zip(magnet_data['Assembly Accession ID'].astype(str), magnet_data['Taxonomy ID']))
+            ingested = genome_store.ingest_folder(reference_genomes, taxids=taxids)
+            print(f'Linked {len(ingested)} reference genomes from the genome store')
+    
+    def prep_stage(n_threads):
+        ## get necessary files for the nanosim input
+        prep_sim_lemur(magnet_report, report_loc, nanosim_loc, output)
+    
+    def plan_stage(n_threads):
+        ## exact reads per genome, shared by every shard and engine; -r only reruns this, not prep
+        plan = plan_read_counts(read_genome_list(genome_list1_loc), num_reads, length_weighted=length_weighted)
+        write_read_plan(plan, read_plan_loc)
+        write_nanosim_abundances(plan['species'], plan['reads'], abundances)
+        print(f"Planned {plan['reads'].sum()} reads over {(plan['reads'] > 0).sum()} of {len(plan)} genomes")
+    
+    def species_info_stage(n_threads):
+        generate_species_file_info(read_genome_list(genome_list1_loc), nanosim_loc)
+    
+    def read_analysis_stage(n_threads):
+        training_loc = os.path.join(nanosim_loc, 'training')
+        if model_cache is not None:
+            ## the trained model only depends on the reads, the genomes and NanoSim itself, so reuse one from an earlier run if possible
+            version = nanosim_version()
+            key = ModelCache.make_key(pipeline.digests.digest(fastq1), genome_list_digest(genome_list1_loc), version,
+                                      subsample=training_subsample)
+            if model_cache.fetch(key, training_loc):
+                print(f'Reusing cached NanoSim model {key}')
+                return
         
-        ## get necessary files for the nanosim input and run nanosim
-        genome_list = prep_sim_lemur(magnet_report, report_loc, nanosim_loc, output, num_reads)
-        species_info = generate_species_file_info(genome_list, nanosim_loc)
+        reset_training_dir(training_loc)
+        ## NanoSim's models converge long before the whole of a large run is used, so train on a bounded subset
+        ## (unless the input is already within the caps, then the subset would just be a copy of it)
+        stats = read_fastq_stats(fastq_stats_loc) if os.path.exists(fastq_stats_loc) else None
+        if training_subsample is not None and (stats is None or
+                                               (training_subsample['reads'] is not None and stats.n_reads > training_subsample['reads']) or
+                                               (training_subsample['bases'] is not None and stats.n_bases > training_subsample['bases'])):
+            training_fastq = os.path.join(nanosim_loc, 'training_reads.fastq')
+            n_reads, n_bases = subsample_training_reads(fastq1, training_fastq, max_reads=training_subsample['reads'],
+                                                        max_bases=training_subsample['bases'], seed=training_subsample['seed'],
+                                                        length_counts=stats.length_counts if stats is not None else None)
+            print(f'Training NanoSim on {n_reads} reads ({n_bases} bases)')
+        else:
+            training_fastq = fastq1
+        run_read_analysis(training_fastq, genome_list1_loc, nanosim_loc, threads=n_threads) ## nanosim step 1
+        if training_fastq != fastq1:
+            os.remove(training_fastq)
         
-        genome_list_loc = os.path.join(nanosim_loc, 'genome_list1.tsv')
-        run_read_analysis(fastq1, genome_list_loc, nanosim_loc, threads=threads) ## nanosim step 1
+        if model_cache is not None:
+            model_cache.store(key, training_loc, fastq=os.path.abspath(str(fastq1)), nanosim_version=version)
+    
+    def simulate_stage(n_threads):
+        ## reads of an earlier, interrupted simulation (e.g. with more shards) must not end up in this merge
+        for stale in glob.glob(os.path.join(nanosim_loc, 'simulated_sample*')):
+            os.remove(stale)
+        if sim_engine == 'native':
+            ## perfect reads are cut straight from the references, no NanoSim model needed
+            if os.path.exists(fastq_stats_loc):
+                read_lengths, length_counts = read_fastq_stats(fastq_stats_loc).lengths()
+            else:
+                ## --simulate-only on a directory from before the input was profiled
+                read_lengths, length_counts = read_length_distribution(fastq1, cache_loc=os.path.join(nanosim_loc, 'read_lengths.npy')), None
+            simulate_perfect_reads(read_plan_loc, species_loc, nanosim_loc, read_lengths, seed=seed, length_counts=length_counts)
+            return
+        run_sim_sharded(genome_list2_loc, abundances, species_loc, nanosim_loc, perfect=perfect, threads=n_threads,
+                        n_shards=sim_shards, seed=seed, read_plan=read_plan_loc) ## nanosim step 2
+    
+    def merge_stage(n_threads):
+        ## merge all nanosim read files into one randomly ordered file, then tidy up the per-sample files
+        read_files = sorted(glob.glob(os.path.join(nanosim_loc, 'simulated_sample*_reads.fast*')))
+        if not read_files:
+            raise SystemExit(f'No simulated reads in {nanosim_loc} to merge, rerun with --force-from simulate')
+        merge_shuffle_reads(read_files, simulated_loc, seed=seed, compression=compress, threads=n_threads,
+                            rename=shard_read_renamer)
         
-    genome_list_loc = os.path.join(nanosim_loc, 'genome_list2.tsv')
-    abundances = os.path.join(nanosim_loc, 'abundances.tsv')
-    species_loc = os.path.join(nanosim_loc, 'species_info.tsv')
-   
-    run_sim(genome_list_loc, abundances, species_loc, nanosim_loc, perfect=perfect, threads=threads) ## nanosim step 2
-    
-    ##concatenate the two fasta files and shuffle results (TODO: quick and dirty solution, will fix)
-    subprocess.run(f'cat {output}/nanosim/*.fasta > {output}/nanosim/simulated.fasta', shell=True, check=True)
-    subprocess.run(f'rm {output}/nanosim/simulated_sample*.fasta ', shell=True, check=True)
-    subprocess.run(f'mv {output}/nanosim/simulated.fasta {output}/simulated_data/', shell=True, check=True)
-    if not perfect:
-        subprocess.run(f'mv {output}/nanosim/simulated_sample* {output}/simulated_data/error_data', shell=True, check=True)
+        ## the read files are only removed once everything else has succeeded, so a failed merge can be rerun
+        leftovers = [f for f in glob.glob(os.path.join(nanosim_loc, 'simulated_sample*')) if f not in read_files]
+        if not perfect:
+            error_data = os.path.join(output, 'simulated_data', 'error_data')
+            os.makedirs(error_data, exist_ok=True)
+            for leftover in leftovers:
+                shutil.move(leftover, os.path.join(error_data, os.path.basename(leftover)))
+        else:
+            for leftover in leftovers:
+                os.remove(leftover)
+        for read_file in read_files:
+            os.remove(read_file)
+    
+    def truth_table_stage(n_threads):
+        ## per-read truth table (true taxid, source, strand, length) for downstream scoring
+        generate_truth_table([simulated_loc], magnet_report, os.path.join(output, 'simulated_data', 'truth_table'), perfect=perfect)
+    
+    def kraken2_stage(n_threads):
+        os.makedirs(os.path.join(evaluation_loc, 'kraken2'), exist_ok=True)
+        run_kraken2(simulated_loc, kraken2_db, evaluation_loc, threads=n_threads)
+    
+    def lemur_eval_stage(n_threads):
+        run_lemur(simulated_loc, lemur_db, os.path.join(evaluation_loc, 'lemur'), threads=n_threads)
+    
+    pipeline = Pipeline(output, name=sample_name, profile=args.profile)
+    pipeline.add_stage('lemur', lemur_stage, inputs=[fastq1, lemur_db], outputs=[report_loc], multithreaded=True,
+                       memory=database_size(lemur_db))
+    ## the input profile only needs the reads, so it runs alongside Lemur
+    pipeline.add_stage('fastq_stats', fastq_stats_stage, inputs=[fastq1], outputs=[fastq_stats_loc], multithreaded=True)
+    pipeline.add_stage('magnet', magnet_stage, inputs=[fastq1, fastq2], outputs=[magnet_report], deps=['lemur'], multithreaded=True)
+    pipeline.add_stage('prep', prep_stage, outputs=[genome_list1_loc, genome_list2_loc], deps=['magnet'])
+    ## species info and nanosim training only need the genome list, so they run side by side
+    pipeline.add_stage('species_info', species_info_stage, inputs=[genome_list1_loc], outputs=[species_loc], deps=['prep'])
+    if sim_engine == 'nanosim':
+        pipeline.add_stage('read_analysis', read_analysis_stage, inputs=[fastq1, genome_list1_loc], outputs=[os.path.join(nanosim_loc, 'training')],
+                           params={'subsample': training_subsample}, deps=['prep', 'fastq_stats'], multithreaded=True)
+    ## after species_info, which has already indexed the genomes the plan takes their sizes from
+    pipeline.add_stage('plan', plan_stage, inputs=[genome_list1_loc], outputs=[read_plan_loc, abundances],
+                       params={'reads': num_reads, 'length_weighted': length_weighted}, deps=['prep', 'species_info'])
+    ## merge consumes the simulated read files, so the simulation only counts as done while their merged file exists
+    if sim_engine == 'nanosim':
+        pipeline.add_stage('simulate', simulate_stage, outputs=[simulated_loc], params={'reads': num_reads, 'perfect': perfect, 'shards': sim_shards, 'seed': seed},
+                           deps=['plan', 'species_info', 'read_analysis'], multithreaded=True)
     else:
-        subprocess.run(f'rm {output}/nanosim/simulated_sample*', shell=True, check=True)
+        pipeline.add_stage('simulate', simulate_stage, inputs=[fastq1], outputs=[simulated_loc],
+                           params={'reads': num_reads, 'perfect': perfect, 'engine': sim_engine, 'seed': seed},
+                           deps=['plan', 'species_info', 'fastq_stats'])
+    pipeline.add_stage('merge', merge_stage, outputs=[simulated_loc], params={'seed': seed, 'compress': compress}, deps=['simulate'],
+                       multithreaded=compress != 'none')
+    pipeline.add_stage('truth_table', truth_table_stage, inputs=[simulated_loc],
+                       outputs=[truth_table_loc(os.path.join(output, 'simulated_data', 'truth_table'))], deps=['merge'])
+    if kraken2_db is not None:
+        ## classifiers on the simulated reads are independent of each other and of the truth table
+        pipeline.add_stage('kraken2', kraken2_stage, inputs=[simulated_loc, kraken2_db],
+                           outputs=[os.path.join(evaluation_loc, 'kraken2', 'output.txt')], deps=['merge'], multithreaded=True,
+                           memory=database_size(kraken2_db))
+        pipeline.add_stage('lemur_eval', lemur_eval_stage, inputs=[simulated_loc, lemur_db],
+                           outputs=[os.path.join(evaluation_loc, 'lemur', 'relative_abundance.tsv')], deps=['merge'], multithreaded=True,
+                           memory=database_size(lemur_db))
+    
+    ## --simulate-only never touches the profiling stages and always redoes the simulation; only the read plan
+    ## is brought up to date first, so a new -r takes effect
+    if simulate_only:
+        pipeline.run(force_from=force_from or 'simulate', skip_before='plan', threads=threads, budget=budget)
+    else:
+        pipeline.run(force_from=force_from, threads=threads, budget=budget)
+    return pipeline
+
+def read_sample_sheet(sample_sheet:str):
+    """Reads a tab separated sample sheet with a header. Required columns: sample, fastq. Optional columns
+    fastq2, reads and seed override the command line values for that sample (empty cells keep them)"""
+    samples = pd.read_csv(sample_sheet, sep='\t', dtype=str).fillna('')
+    missing = {'sample', 'fastq'} - set(samples.columns)
+    if missing:
+        raise SystemExit(f'Sample sheet is missing column(s): {", ".join(sorted(missing))}')
+    if samples['sample'].duplicated().any():
+        raise SystemExit(f'Sample sheet has duplicate sample names: {", ".join(samples["sample"][samples["sample"].duplicated()])}')
+    return samples
 
+def run_batch(args):
+    """Runs every sample of the sample sheet into output/<sample>, several at a time, all sharing one
+    thread/memory budget, the genome store and the model cache. Writes output/batch_report.tsv (one row
+    per sample) and output/batch_timings.tsv (one row per sample and stage)"""
+    samples = read_sample_sheet(args.sample_sheet)
+    os.makedirs(args.output, exist_ok=True)
+    budget = ResourceBudget(args.threads, memory=int(args.max_memory * 1024**3) if args.max_memory is not None else None)
+    max_samples = max(1, min(args.max_samples if args.max_samples is not None else args.threads, len(samples)))
     
-def parse_args():
-    parser = argparse.ArgumentParser(description="Universal Taxonomic Classification Verifier.")
-    parser.add_argument("-i", "--fastq", type=pathlib.Path, required=True, help="Path to first fastq file")
+    def run_sample(row):
+        sample_args = copy.copy(args)
+        ## each sample gets a fair share of the budget so one sample cannot hold every thread
+        sample_args.threads = max(1, math.ceil(args.threads / max_samples))
+        sample_args.fastq = pathlib.Path(row['fastq'])
+        sample_args.fastq2 = pathlib.Path(row['fastq2']) if row.get('fastq2') else None
+        sample_args.output = pathlib.Path(args.output) / row['sample']
+        if row.get('reads'):
+            sample_args.reads = int(row['reads'])
+        if row.get('seed'):
+            sample_args.seed = int(row['seed'])
+        
+        start = time.perf_counter()
+        try:
+            for fastq in [sample_args.fastq, sample_args.fastq2]:
+                if fastq is not None and not os.path.exists(fastq):
+                    raise FileNotFoundError(f'{fastq} not found')
+            pipeline = run_mimic(sample_args, budget=budget, sample_name=row['sample'])
+            error = ''
+        except (Exception, SystemExit) as e:
+            pipeline, error = None, str(e) or type(e).__name__
+            print(f'[{row["sample"]}] failed: {error}')
+        return row['sample'], pipeline, error, time.perf_counter() - start
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_samples) as pool:
+        results = list(pool.map(run_sample, [row for _, row in samples.iterrows()]))
+    
+    report, timings = [], []
+    for sample, pipeline, error, wall_time in results:
+        report.append({'sample': sample, 'status': 'failed' if error else 'done', 'wall_time': round(wall_time, 3), 'error': error})
+        if pipeline is None:
+            continue
+        for row in pipeline.report():
+            timings.append(dict(row, sample=sample))
+    pd.DataFrame(report).to_csv(os.path.join(args.output, 'batch_report.tsv'), sep='\t', index=False)
+    pd.DataFrame(timings, columns=['sample', 'stage', 'status'] + METRIC_FIELDS[1:]).to_csv(
+        os.path.join(args.output, 'batch_timings.tsv'), sep='\t', index=False)
+    
+    print(pd.DataFrame(report).to_string(index=False))
+    if any(error for _, _, error, _ in results):
+        raise SystemExit('Some samples failed, see batch_report.tsv')
+
+def find_simulated_outputs(output:str):
+    """(simulated reads, truth table) of a MIMIC output directory, whatever compression they were written with"""
+    simulated = os.path.join(output, 'simulated_data')
+    reads = [os.path.join(simulated, 'simulated.fasta' + ext) for ext in ['', '.gz', '.zst']]
+    truth = [os.path.join(simulated, 'truth_table' + suffix) for suffix in TRUTH_TABLE_SUFFIXES]
+    found = [next((loc for loc in locs if os.path.exists(loc)), None) for locs in [reads, truth]]
+    if None in found:
+        raise SystemExit(f'No simulated reads and truth table in {simulated}, run the simulation first')
+    return found
+
+def run_evaluation(args, budget:ResourceBudget=None):
+    """Runs the chosen classifiers on the simulated reads of a MIMIC output directory, side by side under one
+    thread/memory budget, then scores them and any precomputed --result against the truth table in one pass.
+    Writes output/evaluation/scores_by_rank.tsv and output/evaluation/scores.tsv. budget is set when the
+    evaluation is a job of mimic.py serve"""
+    output = str(args.output)
+    evaluation_loc = os.path.join(output, 'evaluation')
+    reads_loc, truth_loc = find_simulated_outputs(output)
+    if args.classifiers and detect_compression(reads_loc) == 'zstd':
+        raise SystemExit('Kraken2 and Lemur cannot read zstd compressed reads, simulate with --compress gzip or bgzip')
+    
+    kraken2_output = os.path.join(evaluation_loc, 'kraken2', 'output.txt')
+    kraken2_report = os.path.join(evaluation_loc, 'kraken2', 'report.txt')
+    bracken_output = os.path.join(evaluation_loc, 'kraken2', 'output.braken')
+    lemur_output = os.path.join(evaluation_loc, 'lemur', 'relative_abundance.tsv')
+    
+    outputs = {} ## tool -> (output format, location)
+    pipeline = Pipeline(evaluation_loc, profile=args.profile)
+    if 'kraken2' in args.classifiers or 'bracken' in args.classifiers:
+        def kraken2_stage(n_threads):
+            os.makedirs(os.path.join(evaluation_loc, 'kraken2'), exist_ok=True)
+            run_kraken2(reads_loc, args.kraken2_db, evaluation_loc, threads=n_threads)
+        pipeline.add_stage('kraken2', kraken2_stage, inputs=[reads_loc, args.kraken2_db], outputs=[kraken2_output, kraken2_report],
+                           multithreaded=True, memory=database_size(args.kraken2_db))
+        if 'kraken2' in args.classifiers:
+            outputs['kraken2'] = ('kraken2', kraken2_output)
+    if 'bracken' in args.classifiers:
+        def bracken_stage(n_threads):
+            run_bracken(kraken2_report, args.kraken2_db, evaluation_loc, read_length=args.bracken_read_length, threads=n_threads)
+        pipeline.add_stage('bracken', bracken_stage, inputs=[kraken2_report], outputs=[bracken_output],
+                           params={'read_length': args.bracken_read_length}, deps=['kraken2'])
+        outputs['bracken'] = ('bracken', bracken_output)
+    if 'lemur' in args.classifiers:
+        def lemur_stage(n_threads):
+            run_lemur(reads_loc, args.lemur_db, os.path.join(evaluation_loc, 'lemur'), threads=n_threads)
+        pipeline.add_stage('lemur', lemur_stage, inputs=[reads_loc, args.lemur_db], outputs=[lemur_output],
+                           multithreaded=True, memory=database_size(args.lemur_db))
+        outputs['lemur'] = ('lemur', lemur_output)
+    for result in args.result or []:
+        tool, fmt, path = result.split(':', 2)
+        outputs[tool] = (fmt, path)
+    
+    scores_loc = os.path.join(evaluation_loc, 'scores_by_rank.tsv')
+    summary_loc = os.path.join(evaluation_loc, 'scores.tsv')
+    def score_stage(n_threads):
+        ncbitax = load_ncbi_taxonomy(args.taxonomy)
+        ## the truth lineages are kept in a columnar cache, so rescoring new classifier outputs only parses those
+        truth = EvaluationTruth.cached(truth_loc, ncbitax, os.path.join(evaluation_loc, 'truth_cache'))
+        rank_scores, summary = evaluate_classifiers(outputs, truth, ncbitax, min_abundance=args.min_abundance)
+        write_evaluation(rank_scores, summary, evaluation_loc)
+        print(rank_scores.to_string(index=False))
+        print(summary.to_string(index=False))
+    ## keyed on the dump files, not the taxonomy folder, which also holds the taxcache/ compiled on first use
+    taxonomy_dumps = [os.path.join(args.taxonomy, name) for name in ['nodes.dmp', 'names.dmp']]
+    pipeline.add_stage('score', score_stage, inputs=[truth_loc] + taxonomy_dumps + [path for _, path in outputs.values()],
+                       outputs=[scores_loc, summary_loc], params={'outputs': outputs, 'min_abundance': args.min_abundance},
+                       deps=list(pipeline.stages))
+    
+    if budget is None:
+        budget = ResourceBudget(args.threads, memory=int(args.max_memory * 1024**3) if args.max_memory is not None else None)
+    pipeline.run(force_from=args.force_from, threads=args.threads, budget=budget)
+    return pipeline
+
+def simulate_job(args, budget:ResourceBudget, job_id:str):
+    """Runs one sample as a job of mimic.py serve, returns its pipeline and where its results are"""
+    pipeline = run_mimic(args, budget=budget, sample_name=job_id)
+    output = str(args.output)
+    reads_loc, truth_loc = find_simulated_outputs(output)
+    outputs = {'simulated_reads': reads_loc, 'truth_table': truth_loc,
+               'read_plan': os.path.join(output, 'nanosim', 'read_counts.tsv'),
+               'run_report': os.path.join(output, 'run_report.json')}
+    if args.kraken2_db is not None:
+        outputs['evaluation'] = os.path.join(output, 'evaluation')
+    return pipeline, {name: os.path.abspath(loc) for name, loc in outputs.items()}
+
+def evaluate_job(args, budget:ResourceBudget, job_id:str):
+    """Runs one evaluation as a job of mimic.py serve, returns its pipeline and where its results are"""
+    pipeline = run_evaluation(args, budget=budget)
+    evaluation_loc = os.path.join(str(args.output), 'evaluation')
+    outputs = {'scores': os.path.join(evaluation_loc, 'scores.tsv'),
+               'scores_by_rank': os.path.join(evaluation_loc, 'scores_by_rank.tsv'),
+               'run_report': os.path.join(evaluation_loc, 'run_report.json')}
+    return pipeline, {name: os.path.abspath(loc) for name, loc in outputs.items()}
+
+def parse_simulate_job_args(argv):
+    args = parse_mimic_args(argv, parser_class=JobArgumentParser)
+    if args.sample_sheet is not None:
+        raise JobArgumentError('--sample-sheet cannot be used in a job, submit one job per sample')
+    return args
+
+def run_server(args):
+    """Keeps MIMIC loaded and runs simulate/evaluate jobs posted to http://127.0.0.1:<port> (see README)"""
+    budget = ResourceBudget(args.threads, memory=int(args.max_memory * 1024**3) if args.max_memory is not None else None)
+    for taxonomy in args.taxonomy or []:
+        load_ncbi_taxonomy(taxonomy)
+    runners = {'simulate': (parse_simulate_job_args, simulate_job),
+               'evaluate': (lambda argv: parse_evaluate_args(argv, parser_class=JobArgumentParser), evaluate_job)}
+    jobs = JobServer(runners, budget, workers=args.workers if args.workers is not None else args.threads,
+                     queue_size=args.queue_size, max_history=args.max_history)
+    serve(jobs, port=args.port)
+
+def parse_serve_args(argv):
+    parser = argparse.ArgumentParser(prog='mimic.py serve', description='Runs MIMIC as a local service that keeps its imports and caches loaded and takes simulate/evaluate jobs over HTTP on 127.0.0.1.')
+    parser.add_argument('--port', type=int, required=False, default=DEFAULT_PORT, help=f'Port to listen on, on 127.0.0.1 only (Default: {DEFAULT_PORT})')
+    parser.add_argument('-t', '--threads', type=int, required=False, default=1, help='Threads shared by all running jobs (Default: 1)')
+    parser.add_argument('--max-memory', type=float, required=False, help='Memory budget in GB shared by all running jobs (Default: no limit)')
+    parser.add_argument('--workers', type=int, required=False, help='Maximum number of jobs run at once (Default: --threads)')
+    parser.add_argument('--queue-size', type=int, required=False, default=16, help='Maximum number of waiting jobs, further submissions are refused with 503 (Default: 16)')
+    parser.add_argument('--max-history', type=int, required=False, default=1000, help='Number of finished jobs whose results are kept (Default: 1000)')
+    parser.add_argument('--taxonomy', type=str, action='append', help='NCBI taxdump folder to load at startup rather than at the first evaluate job (repeatable)')
+    return parser.parse_args(argv)
+
+def parse_evaluate_args(argv, parser_class=argparse.ArgumentParser):
+    parser = parser_class(prog='mimic.py evaluate', description='Runs and scores taxonomic classifiers on the simulated reads of a MIMIC output directory.')
+    parser.add_argument('-o', '--output', type=pathlib.Path, required=True, help='MIMIC output directory with simulated_data/ (results go to output/evaluation)')
+    parser.add_argument('--taxonomy', type=str, required=True, help='NCBI taxdump folder (names.dmp/nodes.dmp) used to score every rank')
+    parser.add_argument('--classifiers', type=str, nargs='*', default=[], choices=EVAL_CLASSIFIERS, help='Classifiers to run on the simulated reads, at the same time when threads allow')
+    parser.add_argument('--kraken2-db', type=str, required=False, help='Kraken2 database, needed for kraken2 and bracken')
+    parser.add_argument('--lemur-db', type=str, required=False, help='Lemur database, needed for lemur')
+    parser.add_argument('--bracken-read-length', type=int, required=False, help='Read length of the Bracken database k-mer distribution, needed for bracken')
+    parser.add_argument('--result', type=str, action='append', help=f'Score an existing classifier output as TOOL:FORMAT:PATH, FORMAT one of {", ".join(sorted(READ_PARSERS) + sorted(PROFILE_PARSERS))} (repeatable)')
+    parser.add_argument('--min-abundance', type=float, required=False, default=0.0, help='Relative abundance below which a taxon in a profile counts as absent (Default: 0)')
+    parser.add_argument('-t', '--threads', type=int, required=False, default=1, help='Threads shared by the classifiers (Default: 1)')
+    parser.add_argument('--max-memory', type=float, required=False, help='Memory budget in GB; a classifier waits until its database fits (Default: no limit)')
+    parser.add_argument('--profile', action='store_true', help='Run the Python side of every stage under cProfile')
+    parser.add_argument('--force-from', type=str, required=False, choices=EVAL_CLASSIFIERS + ['score'], help='Rerun this stage and everything after it, even if up to date')
+    args = parser.parse_args(argv)
+    
+    if not args.classifiers and not args.result:
+        parser.error('nothing to evaluate, give --classifiers and/or --result')
+    if ('kraken2' in args.classifiers or 'bracken' in args.classifiers) and args.kraken2_db is None:
+        parser.error('kraken2 and bracken need --kraken2-db')
+    if 'lemur' in args.classifiers and args.lemur_db is None:
+        parser.error('lemur needs --lemur-db')
+    if 'bracken' in args.classifiers and args.bracken_read_length is None:
+        parser.error('bracken needs --bracken-read-length')
+    for result in args.result or []:
+        parts = result.split(':', 2)
+        if len(parts) != 3 or parts[1] not in READ_PARSERS and parts[1] not in PROFILE_PARSERS:
+            parser.error(f'--result {result} is not TOOL:FORMAT:PATH with a known FORMAT')
+        if parts[0] in args.classifiers:
+            parser.error(f'--result {parts[0]} has the name of a classifier that is run')
+    return args
+
+def parse_mimic_args(argv, parser_class=argparse.ArgumentParser):
+    parser = parser_class(description="Universal Taxonomic Classification Verifier.")
+    parser.add_argument("-i", "--fastq", type=pathlib.Path, required=False, help="Path to first fastq file (required unless --sample-sheet is given)")
     parser.add_argument("-I", "--fastq2", type=pathlib.Path, required=False, help="Path to second fastq file for paired-end reads")
     parser.add_argument("-o", "--output", type=pathlib.Path, required=True, help="Path to the output directory.")
+    parser.add_argument('--sample-sheet', type=str, required=False, help='Tab separated sample sheet (columns: sample, fastq and optionally fastq2, reads, seed) to run a batch of samples, each into output/<sample>')
+    parser.add_argument('--max-samples', type=int, required=False, help='With --sample-sheet, the maximum number of samples processed at once (Default: --threads)')
+    parser.add_argument('--max-memory', type=float, required=False, help='With --sample-sheet, memory budget in GB shared by all samples; database-loading stages wait until their database fits (Default: no limit)')
     parser.add_argument("--db", type=str, required=True, help='Kraken2 database location')
     parser.add_argument('-t', '--threads', type=int, required=False, default=1, help='Number of threads for multithreading (Default: 1)')
     parser.add_argument('-r', '--reads', type=int, required=True, default=100, help='Number of simulated reads to generate')
     parser.add_argument('--simulate-only', action='store_true', help='Only runs simulation (must have already run pipeline on sample once, will override existing simulated data)')
     parser.add_argument('--perfect', action='store_true', help='Will generate perfect reads with no errors')
+    parser.add_argument('--seed', type=int, required=False, help='Random seed for shuffling the simulated reads (Default: random)')
+    parser.add_argument('--sim-engine', type=str, required=False, default='nanosim', choices=['nanosim', 'native'], help='Read simulator: NanoSim, or the built-in engine that cuts perfect reads straight from the references, with lengths drawn from the input reads (with --perfect only) (Default: nanosim)')
+    parser.add_argument('--length-weighted', action='store_true', help='Treat the Lemur abundances as cell abundances, so the reads of each genome also scale with its length')
+    parser.add_argument('--sim-shards', type=int, required=False, default=1, help='Split the simulation into this many independent NanoSim runs executed in parallel (Default: 1)')
+    parser.add_argument('--compress', type=str, required=False, default='none', choices=COMPRESSIONS, help='Compression of the simulated reads file, multithreaded when pigz, bgzip or zstd are installed (Default: none)')
+    parser.add_argument('--kraken2-db', type=str, required=False, help='Kraken2 database location, if given Kraken2 and Lemur are run on the simulated reads')
+    parser.add_argument('--training-reads', type=int, required=False, default=100000, help='Maximum number of reads NanoSim is trained on, sampled at random with the same length distribution as the input (Default: 100000)')
+    parser.add_argument('--training-bases', type=int, required=False, help='Maximum number of bases NanoSim is trained on (Default: no limit)')
+    parser.add_argument('--training-seed', type=int, required=False, default=0, help='Random seed of the training subset, separate from --seed so replicate simulations reuse one trained model (Default: 0)')
+    parser.add_argument('--no-subsample', action='store_true', help='Train NanoSim on the full input fastq')
+    parser.add_argument('--genome-store', type=str, required=False, default=DEFAULT_GENOME_STORE, help=f'Directory of reference genomes shared between samples (Default: {DEFAULT_GENOME_STORE})')
+    parser.add_argument('--no-genome-store', action='store_true', help='Keep a private copy of every reference genome in the output directory')
+    parser.add_argument('--model-cache', type=str, required=False, default=DEFAULT_MODEL_CACHE, help=f'Directory of trained NanoSim models shared between runs (Default: {DEFAULT_MODEL_CACHE})')
+    parser.add_argument('--model-cache-size', type=float, required=False, default=50, help='Maximum size of the model cache in GB, least recently used models are evicted first (Default: 50)')
+    parser.add_argument('--no-model-cache', action='store_true', help='Always retrain the NanoSim model and do not store it in the model cache')
+    parser.add_argument('--profile', action='store_true', help='Run the Python side of every stage under cProfile, stats are written to output/.mimic/profiles/<stage>.prof')
+    parser.add_argument('--force-from', type=str, required=False, choices=PIPELINE_STAGES, help='Rerun this stage and everything after it, even if up to date')
     
-    args = parser.parse_args() 
+    args = parser.parse_args(argv)
+    if args.sample_sheet is None and args.fastq is None:
+        parser.error('one of -i/--fastq or --sample-sheet is required')
+    return args
+
+def parse_args():
+    if len(sys.argv) > 1 and sys.argv[1] == 'evaluate':
+        return run_evaluation(parse_evaluate_args(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return run_server(parse_serve_args(sys.argv[2:]))
     
-    run_mimic(args) 
+    args = parse_mimic_args(sys.argv[1:])
+    if args.sample_sheet is not None:
+        run_batch(args)
+    else:
+        run_mimic(args) 
     
     
 
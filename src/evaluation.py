@@ -1,26 +1,16 @@
+import os
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import pandas as pd
 
 from src.tax_identification import *
-from src.ncbi_taxonomy_utils.py import NCBItaxonomy
+from src.ncbi_taxonomy_utils import NCBItaxonomy
+from src.io_utils import open_file, iter_chunks, is_compressed
+from src.sim import read_truth_table
 
-k2db='/home/Users/rdd4/VIMERA_DB_1.0/kraken2-genbank'
-#working='/home/Users/mn56/work/mimic/results_1000_perf'
-working='/home/Users/mn56/work/mimic/results_50000_perf'
-#infasta='/home/Users/rdd4/Mimic/SRR30413550/simulated_data_SRR30413550/simulated1000.fasta'
-#infasta='/home/Users/rdd4/Mimic/SRR30413550/simulated_data_SRR30413550/simulated1000_perf.fasta'
-infasta='/home/Users/rdd4/Mimic/SRR30413550/simulated_data_SRR30413550/simulated50000_perf.fasta'
-#ncbi_taxdmp_fold='/home/mnute/work/rice/ncbi_taxonomy'
-ncbi_taxdmp_fold='/home/Users/mn56/data/ncbi_taxonomy'
-magfold='/home/Users/rdd4/Mimic/SRR30413550/magnet'
-k2_output_path='/home/Users/mn56/work/mimic/results_1000_perf/kraken2/output.txt'
-k2_output_path_aln='/home/Users/mn56/work/mimic/results_1000/kraken2/output.txt'
-k2_output_path_50k='/home/Users/mn56/work/mimic/results_50000_perf/kraken2/output.txt'
-k2_output_path_50k_aln='/home/Users/mn56/work/mimic/results_50000/kraken2/output.txt'
-
-
-run_kraken2(infasta, k2db, working)
-
-k2score_50k=score_kraken2_nanosim_output(k2_output_path_50k, magfold, ncbi_taxdmp_fold)
-rescore_kraken2_nanosim_output_by_rank(k2score_50k[3], ncbi_taxdmp_fold)
+EVAL_RANKS = ['species', 'genus', 'family', 'order', 'class', 'phylum']
 
 def get_prec_rec(fn_tp_fp_tuple):
     return fn_tp_fp_tuple[1]/(fn_tp_fp_tuple[1]+fn_tp_fp_tuple[2]), fn_tp_fp_tuple[1]/sum(fn_tp_fp_tuple[:3])
@@ -38,83 +28,490 @@ def read_magnet_cluster_representatives(magnet_folder):
     return clust_id_lkp
 
 
+def nanosim_true_organism(read_hdr):
+    '''nanosim read names start with the genome name (spaces replaced by underscores)
+    followed by a dash, e.g. Mycobacterium_cookii-NZ_CP012_1_aligned_0_F_0_1000_0'''
+    return read_hdr.split('-')[0].replace('_',' ')
+
+def confusion_counts(true_rank_ids, est_rank_ids):
+    '''takes two aligned arrays of taxon IDs at a single rank (0 meaning the read has
+    no taxon at that rank) and returns the FN/TP/FP/TN counts.'''
+    t_set = true_rank_ids != 0
+    e_set = est_rank_ids != 0
+    tn = int(np.count_nonzero(~t_set & e_set))
+    fn = int(np.count_nonzero(t_set & ~e_set))
+    tp = int(np.count_nonzero(t_set & e_set & (true_rank_ids == est_rank_ids)))
+    fp = int(np.count_nonzero(t_set & e_set & (true_rank_ids != est_rank_ids)))
+    return fn, tp, fp, tn
+
+def with_prec_rec(fn, tp, fp, tn):
+    prec = tp / (tp+fp) if tp+fp > 0 else 0.0
+    rec = tp / (tp+fp+fn) if tp+fp+fn > 0 else 0.0
+    return fn, tp, fp, tn, prec, rec
+
+def fn_tp_fp_tn(true_rank_ids, est_rank_ids):
+    '''same as confusion_counts, with precision and recall appended.'''
+    return with_prec_rec(*confusion_counts(true_rank_ids, est_rank_ids))
+
+class ConfusionAccumulator():
+    '''running confusion counts for a classifier run, updated one chunk of reads at
+    a time so nothing per-read has to be kept. `overall` holds the species-level
+    FN/TP/FP in the sense of score_kraken2_nanosim_output (FN = unclassified, TP =
+    exact taxon ID match, FP = classified to any other taxon) and `by_rank` holds
+    FN/TP/FP/TN per rank as in rescore_kraken2_nanosim_output_by_rank.'''
+
+    def __init__(self, ranks=EVAL_RANKS):
+        self.ranks = list(ranks)
+        self.n_reads = 0
+        self.overall = np.zeros(3, dtype=np.int64)
+        self.by_rank = np.zeros((len(self.ranks), 4), dtype=np.int64)
+
+    def update(self, classified, true_taxids, est_taxids, ncbitax=None):
+        self.n_reads += len(true_taxids)
+        match = true_taxids == est_taxids
+        self.overall += [np.count_nonzero(~classified), np.count_nonzero(match), np.count_nonzero(classified & ~match)]
+        if ncbitax is not None:
+            true_lineages = ncbitax.get_main_rank_lineages(true_taxids)
+            est_lineages = ncbitax.get_main_rank_lineages(est_taxids)
+            for r, rank in enumerate(self.ranks):
+                col = ncbitax.rank_main_seven.index(rank)
+                self.by_rank[r] += confusion_counts(true_lineages[:, col], est_lineages[:, col])
+
+    def merge(self, other):
+        self.n_reads += other.n_reads
+        self.overall += other.overall
+        self.by_rank += other.by_rank
+        return self
+
+    def rank_table(self):
+        return {rank: with_prec_rec(*(int(x) for x in self.by_rank[r])) for r, rank in enumerate(self.ranks)}
+
+def score_kraken2_chunk(lines, magcr_lkp, accumulator, ncbitax=None, records=None):
+    '''scores a list of kraken2 output lines into `accumulator`. if `records` is a
+    list, the per-read (read_hdr, is_classified, true_taxon_id, taxon_id) tuples 
+    are appended to it.'''
+    # only split off the first three columns, the k-mer LCA mapping column can be long
+    fields = [i.split('\t', 3) for i in lines if i.strip()]
+    n = len(fields)
+    classified = np.fromiter((i[0]=='C' for i in fields), dtype=bool, count=n)
+    est_taxids = np.fromiter((int(i[2]) for i in fields), dtype=np.int64, count=n)
+    true_taxids = np.fromiter((magcr_lkp[nanosim_true_organism(i[1])] for i in fields), dtype=np.int64, count=n)
+    accumulator.update(classified, true_taxids, est_taxids, ncbitax)
+    if records is not None:
+        records.extend((i[1], i[0], int(t), int(e)) for i, t, e in zip(fields, true_taxids, est_taxids))
+    return accumulator
+
+def stream_score_kraken2_nanosim_output(kraken2_output, magnet_folder, ncbitax=None, chunk_size=100000, keep_records=False, magcr_lkp=None):
+    '''streaming version of score_kraken2_nanosim_output: reads the (optionally 
+    compressed) kraken2 output `chunk_size` lines at a time and accumulates the counts,
+    so memory stays flat regardless of the number of reads. per-rank counts are
+    accumulated too when an NCBItaxonomy is given. returns the ConfusionAccumulator
+    and the list of per-read records (None unless keep_records).'''
+    if magcr_lkp is None:
+        magcr_lkp = read_magnet_cluster_representatives(magnet_folder)
+    accumulator = ConfusionAccumulator()
+    records = [] if keep_records else None
+    with open_file(kraken2_output, 'rt') as k2out:
+        for chunk in iter_chunks(k2out, chunk_size):
+            score_kraken2_chunk(chunk, magcr_lkp, accumulator, ncbitax, records)
+    return accumulator, records
+
 def score_kraken2_nanosim_output(kraken2_output, magnet_folder):
     '''parses a standard kraken2 output file and reports results. assuming for now that
     all classifications and all ground truth taxon IDs are at the species level.'''
-    # Get kraken2 output.txt file
-    with open(kraken2_output,'r') as k2out:
-        k2output = [i.strip().split('\t') for i in k2out.readlines()]
-    
-    # Get magnet cluster_represnatives taxon ID lookup:
+    accumulator, res = stream_score_kraken2_nanosim_output(kraken2_output, magnet_folder, keep_records=True)
+    false_negatives, true_positives, false_positives = (int(x) for x in accumulator.overall)
+    return false_negatives, true_positives, false_positives, res
+
+def score_kraken2_with_truth_table(kraken2_output, truth_loc, ncbitax=None, chunk_size=1000000):
+    '''scores a kraken2 output against the per-read truth table written by the 
+    simulation stage (see src.sim.generate_truth_table). the truth taxon of each
+    read comes from a vectorized join on the read ID instead of parsing read 
+    headers. reads missing from the truth table get a true taxon of 0.'''
+    truth = read_truth_table(truth_loc, columns=['read_id', 'true_taxid'])
+    truth_lkp = pd.Series(truth['true_taxid'].to_numpy(np.int64), index=truth['read_id'].to_numpy())
+    accumulator = ConfusionAccumulator()
+    with open_file(kraken2_output, 'rt') as k2out:
+        for chunk in pd.read_csv(k2out, sep='\t', header=None, usecols=[0, 1, 2], names=['status', 'read_id', 'taxid'],
+                                 dtype={'status': str, 'read_id': str, 'taxid': np.int64}, chunksize=chunk_size):
+            true_taxids = truth_lkp.reindex(chunk['read_id'].to_numpy()).fillna(0).to_numpy(np.int64)
+            accumulator.update((chunk['status'] == 'C').to_numpy(), true_taxids, chunk['taxid'].to_numpy(np.int64), ncbitax)
+    return accumulator
+
+## per-process state for the parallel scorer, filled in by _init_eval_worker
+_EVAL_WORKER = {}
+
+def _init_eval_worker(magcr_lkp, ncbi_taxdmp_folder):
+    _EVAL_WORKER['magcr_lkp'] = magcr_lkp
+    # every worker maps the same compiled taxonomy files, so the pages are shared
+    _EVAL_WORKER['ncbitax'] = NCBItaxonomy(ncbi_taxdmp_folder, use_mmap_cache=True) if ncbi_taxdmp_folder is not None else None
+
+def _score_kraken2_byte_range(shard):
+    '''scores every line that starts inside the byte range [start, end) of the file.
+    a line straddling `start` belongs to the previous shard.'''
+    path, start, end, chunk_size = shard
+    accumulator = ConfusionAccumulator()
+    with open(path, 'rb') as k2out:
+        pos = start
+        if start > 0:
+            k2out.seek(start - 1)
+            pos = start - 1 + len(k2out.readline())
+        chunk = []
+        while pos < end:
+            line = k2out.readline()
+            if not line:
+                break
+            pos += len(line)
+            chunk.append(line.decode())
+            if len(chunk) >= chunk_size:
+                score_kraken2_chunk(chunk, _EVAL_WORKER['magcr_lkp'], accumulator, _EVAL_WORKER['ncbitax'])
+                chunk = []
+        if chunk:
+            score_kraken2_chunk(chunk, _EVAL_WORKER['magcr_lkp'], accumulator, _EVAL_WORKER['ncbitax'])
+    return accumulator
+
+def _score_kraken2_lines(lines):
+    return score_kraken2_chunk(lines, _EVAL_WORKER['magcr_lkp'], ConfusionAccumulator(), _EVAL_WORKER['ncbitax'])
+
+def byte_range_shards(filepath, n_shards):
+    '''splits a file into n_shards contiguous (start, end) byte ranges'''
+    size = os.path.getsize(filepath)
+    bounds = np.linspace(0, size, n_shards + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i+1])) for i in range(n_shards) if bounds[i+1] > bounds[i]]
+
+def parallel_score_kraken2_nanosim_output(kraken2_output, magnet_folder, ncbi_taxdmp_folder=None, threads=1, chunk_size=100000, shards_per_thread=4):
+    '''multi-process version of stream_score_kraken2_nanosim_output. a plain text
+    kraken2 output is split into byte-range shards that the workers read on their
+    own; a compressed one has to be decompressed serially, so the main process reads
+    chunks and hands them out instead. each worker memory-maps the taxonomy cache
+    in ncbi_taxdmp_folder (per-rank counts are skipped if it is None) and the 
+    per-shard confusion tables are merged at the end.'''
     magcr_lkp = read_magnet_cluster_representatives(magnet_folder)
-    #
-    res = []
-    for i in k2output:
-        read_hdr = i[1]
-        is_classified = i[0]
-        taxon_id = int(i[2])
-        ground_truth_organism = read_hdr.split('-')[0].replace('_',' ')
-        true_taxon_id = magcr_lkp[ground_truth_organism]
-        res.append((read_hdr, is_classified, true_taxon_id, taxon_id))
+    if ncbi_taxdmp_folder is not None:
+        # compile the cache once up front rather than racing to do it in every worker
+        NCBItaxonomy(ncbi_taxdmp_folder, use_mmap_cache=True)
+    if threads <= 1:
+        _init_eval_worker(magcr_lkp, ncbi_taxdmp_folder)
+        accumulator, _ = stream_score_kraken2_nanosim_output(kraken2_output, magnet_folder, _EVAL_WORKER['ncbitax'], chunk_size, magcr_lkp=magcr_lkp)
+        return accumulator
     
-    false_negatives=sum([1 if i[1]=='U' else 0 for i in res])
-    true_positives=sum([1 if i[2]==i[3] else 0 for i in res])
-    false_positives = sum([1 if i[1]=='C' and i[2]!=i[3] else 0 for i in res])
-    return false_negatives, true_positives, false_positives, res
+    accumulator = ConfusionAccumulator()
+    with multiprocessing.Pool(threads, initializer=_init_eval_worker, initargs=(magcr_lkp, ncbi_taxdmp_folder)) as pool:
+        if is_compressed(kraken2_output):
+            with open_file(kraken2_output, 'rt', threads=threads) as k2out:
+                for shard_acc in pool.imap_unordered(_score_kraken2_lines, iter_chunks(k2out, chunk_size)):
+                    accumulator.merge(shard_acc)
+        else:
+            shards = [(str(kraken2_output), start, end, chunk_size) for start, end in byte_range_shards(kraken2_output, threads * shards_per_thread)]
+            for shard_acc in pool.imap_unordered(_score_kraken2_byte_range, shards):
+                accumulator.merge(shard_acc)
+    return accumulator
 
-ncbitax=NCBItaxonomy(ncbi_taxdmp_fold)
+def print_rank_table(full_res):
+    print('rank\tFN\tTP\tFP\tTN\tPrec\tRec')
+    for i in full_res.keys():
+        print('%s\t%d\t%d\t%d\t%d\t%.3f\t%.3f' % ((i,)+tuple(full_res[i])))
 
 def rescore_kraken2_nanosim_output_by_rank(kraken2_scores, ncbitax):
     '''takes the list of tuples from the previous function where indices 2,3 
     of the tuple are the true taxon ID and the kraken estimated taxon ID, 
-    respectively, and restates the FN/TP/FP counts by rank.'''
-    #
-    def fn_tp_fp_tn(id_pair_list):
-        tn = sum([1 if i[0] is None and i[1] is not None else 0 for i in id_pair_list])
-        fn = sum([1 if i[1] is None and i[0] is not None else 0 for i in id_pair_list])
-        tp = sum([1 if i[0] is not None and i[1] is not None and i[0]==i[1] else 0 for i in id_pair_list])
-        fp = sum([1 if i[0] is not None and i[1] is not None and i[0]!=i[1] else 0 for i in id_pair_list])
-        prec = tp / (tp+fp)
-        rec = tp / (tp+fp+fn)
-        return fn, tp, fp, tn, prec, rec
-    #
-    species_res=[]
-    genus_res = []
-    family_res = []
-    order_res = []
-    class_res = []
-    phylum_res = []
-    for i in kraken2_scores:
-        true_taxid = i[2]; est_taxid=i[3];
-        try:
-            true_lineage = ncbitax.get_taxid_lineage(true_taxid, True, 'rank2taxidnm')
-        except:
-            true_lineage = {}
-        try:
-            if est_taxid==0:
-                est_lineage={}
-            else:
-                est_lineage = ncbitax.get_taxid_lineage(est_taxid, True, 'rank2taxidnm')
-        except:
-            est_lineage={}
-        species_res.append((true_lineage.get('species',None), est_lineage.get('species',None)))
-        genus_res.append((true_lineage.get('genus',None), est_lineage.get('genus',None)))
-        family_res.append((true_lineage.get('family',None), est_lineage.get('family',None)))
-        order_res.append((true_lineage.get('order',None), est_lineage.get('order',None)))
-        class_res.append((true_lineage.get('class',None), est_lineage.get('class',None)))
-        phylum_res.append((true_lineage.get('phylum',None), est_lineage.get('phylum',None)))
+    respectively, and restates the FN/TP/FP counts by rank. lineages are
+    resolved in one batch over the distinct taxon IDs (see 
+    NCBItaxonomy.get_main_rank_lineages) rather than once per read.'''
+    true_taxids = np.fromiter((i[2] for i in kraken2_scores), dtype=np.int64, count=len(kraken2_scores))
+    est_taxids = np.fromiter((i[3] for i in kraken2_scores), dtype=np.int64, count=len(kraken2_scores))
+    true_lineages = ncbitax.get_main_rank_lineages(true_taxids)
+    est_lineages = ncbitax.get_main_rank_lineages(est_taxids)
     #
     full_res = {}
-    full_res['species'] = fn_tp_fp_tn(species_res)
-    full_res['genus'] = fn_tp_fp_tn(genus_res)
-    full_res['family'] = fn_tp_fp_tn(family_res)
-    full_res['order'] = fn_tp_fp_tn(order_res)
-    full_res['class'] = fn_tp_fp_tn(class_res)
-    full_res['phylum'] = fn_tp_fp_tn(phylum_res)
-    #
-    print('rank\tFN\tTP\tFP\tTN\tPrec\tRec')
-    for i in full_res.keys():
-        print('%s\t%d\t%d\t%d\t%d\t%.3f\t%.3f' % ((i,)+full_res[i]))
+    for rank in EVAL_RANKS:
+        col = ncbitax.rank_main_seven.index(rank)
+        full_res[rank] = fn_tp_fp_tn(true_lineages[:, col], est_lineages[:, col])
     #
+    print_rank_table(full_res)
     return full_res
 
+def score_kraken2_lca_by_rank(kraken2_scores, ncbitax):
+    '''takes the same list of tuples as rescore_kraken2_nanosim_output_by_rank and, 
+    for every classified read, finds the lowest common ancestor of the true and 
+    estimated taxon. reports how many reads have their LCA at each main rank 
+    (species = exact or below-species match) plus the mean tree distance between 
+    truth and call. unclassified reads and unknown taxon IDs are counted separately.'''
+    true_taxids = np.fromiter((i[2] for i in kraken2_scores), dtype=np.int64, count=len(kraken2_scores))
+    est_taxids = np.fromiter((i[3] for i in kraken2_scores), dtype=np.int64, count=len(kraken2_scores))
+    lca = ncbitax.get_lca(true_taxids, est_taxids)
+    dist = ncbitax.get_lca_distance(true_taxids, est_taxids)
+    lca_rank = ncbitax.get_lowest_main_rank(lca)
+    #
+    res = {}
+    for col in range(len(ncbitax.rank_main_seven)-1, -1, -1):
+        res[ncbitax.rank_main_seven[col]] = int(np.count_nonzero(lca_rank == col))
+    res['root'] = int(np.count_nonzero((lca > 0) & (lca_rank == -1)))
+    res['unclassified'] = int(np.count_nonzero(est_taxids == 0))
+    res['unknown'] = int(np.count_nonzero((lca == 0) & (est_taxids != 0)))
+    res['mean_distance'] = float(dist[dist >= 0].mean()) if np.any(dist >= 0) else float('nan')
+    #
+    print('lca_rank\treads')
+    for k, v in res.items():
+        print('%s\t%s' % (k, ('%.3f' % v) if isinstance(v, float) else v))
+    return res
+
+
+## parsers from each classifier's output to a common columnar form: per-read assignments as a
+## DataFrame (read_id, taxid), 0 meaning unclassified, or an abundance profile as a Series taxid -> abundance.
+## a new tool only needs a parser registered under its output format.
+READ_PARSERS = {}
+PROFILE_PARSERS = {}
+
+def read_parser(fmt):
+    def register(func):
+        READ_PARSERS[fmt] = func
+        return func
+    return register
+
+def profile_parser(fmt):
+    def register(func):
+        PROFILE_PARSERS[fmt] = func
+        return func
+    return register
+
+@read_parser('kraken2')
+def parse_kraken2_reads(path):
+    '''kraken2 per-read output (output.txt), only the read ID and taxon ID columns are parsed. uses
+    pyarrow's multithreaded csv reader (Arrow backed columns) when it is installed'''
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        pyarrow = None
+    with open_file(path, 'rb') as k2out:
+        if pyarrow is None:
+            return pd.read_csv(k2out, sep='\t', header=None, usecols=[1, 2], names=['read_id', 'taxid'],
+                               dtype={'read_id': str, 'taxid': np.int64})
+        table = pyarrow.csv.read_csv(k2out, read_options=pyarrow.csv.ReadOptions(autogenerate_column_names=True),
+                                     parse_options=pyarrow.csv.ParseOptions(delimiter='\t', quote_char=False),
+                                     convert_options=pyarrow.csv.ConvertOptions(include_columns=['f1', 'f2'],
+                                                                                column_types={'f1': pyarrow.string(), 'f2': pyarrow.int64()}))
+    return table.rename_columns(['read_id', 'taxid']).to_pandas(types_mapper=pd.ArrowDtype)
+
+@profile_parser('kraken2_report')
+def parse_kraken2_report(path):
+    '''kraken2 report.txt, each taxon weighted by the reads assigned directly to it'''
+    with open_file(path, 'rt') as report:
+        df = pd.read_csv(report, sep='\t', header=None, usecols=[2, 4], names=['reads', 'taxid'])
+    return df.groupby('taxid')['reads'].sum()
+
+@profile_parser('bracken')
+def parse_bracken_profile(path):
+    with open_file(path, 'rt') as bracken:
+        df = pd.read_csv(bracken, sep='\t')
+    return df.groupby('taxonomy_id')['fraction_total_reads'].sum()
+
+@profile_parser('lemur')
+def parse_lemur_profile(path):
+    '''lemur relative_abundance.tsv (column F is the abundance of Target_ID)'''
+    with open_file(path, 'rt') as lemur:
+        df = pd.read_csv(lemur, sep='\t')
+    df = df[pd.to_numeric(df['Target_ID'], errors='coerce').notna()]
+    return df.groupby(df['Target_ID'].astype(np.int64))['F'].sum()
+
+@profile_parser('profile')
+def parse_generic_profile(path):
+    '''any two column (taxid, abundance) tsv with a header'''
+    with open_file(path, 'rt') as profile:
+        df = pd.read_csv(profile, sep='\t', usecols=[0, 1])
+    return df.groupby(df.columns[0])[df.columns[1]].sum()
+
+def load_classifier_output(fmt, path):
+    '''(per-read assignments or None, abundance profile) of a classifier output of format fmt. the profile
+    of a per-read format is its read counts per assigned taxon'''
+    if fmt in READ_PARSERS:
+        reads = READ_PARSERS[fmt](path)
+        taxids = reads['taxid'].to_numpy(np.int64)
+        profile = pd.Series(taxids[taxids != 0]).value_counts()
+        return reads, profile
+    if fmt in PROFILE_PARSERS:
+        return None, PROFILE_PARSERS[fmt](path)
+    raise ValueError(f'Unknown classifier output format {fmt}, known: {", ".join(sorted(READ_PARSERS) + sorted(PROFILE_PARSERS))}')
+
+TRUTH_CACHE_VERSION = 1
+
+class EvaluationTruth():
+    '''truth of a simulated dataset (from its truth table), resolved once and shared by every
+    classifier scored against it: the ID (as bytes), true taxon and main-rank lineage of every
+    read, and the true profile (reads per taxon). it can be saved as a columnar cache of .npy
+    files that is memory-mapped back, so rescoring a new classifier output never touches the
+    truth table or the taxonomy lineages of the truth again.'''
+
+    def __init__(self, read_ids, true_taxids, lineages):
+        self.read_ids = read_ids
+        self.true_taxids = true_taxids
+        self.lineages = lineages
+        self._read_index = None
+        self._arrow_read_ids = None
+
+    @classmethod
+    def from_truth_table(cls, truth_loc, ncbitax):
+        truth = read_truth_table(str(truth_loc), columns=['read_id', 'true_taxid'])
+        true_taxids = truth['true_taxid'].to_numpy(np.int64)
+        return cls(truth['read_id'].to_numpy().astype('S'), true_taxids, ncbitax.get_main_rank_lineages(true_taxids))
+
+    @property
+    def profile(self):
+        return pd.Series(self.true_taxids[self.true_taxids != 0]).value_counts()
+
+    def save(self, cache_dir, source=None):
+        '''writes the cache to cache_dir; source describes what it was built from (see cached)'''
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in ['read_ids', 'true_taxids', 'lineages']:
+            np.save(os.path.join(cache_dir, f'{name}.npy'), getattr(self, name))
+        tmp_loc = os.path.join(cache_dir, 'meta.json.tmp')
+        with open(tmp_loc, 'w') as meta_f:
+            json.dump({'version': TRUTH_CACHE_VERSION, 'source': source}, meta_f)
+        os.replace(tmp_loc, os.path.join(cache_dir, 'meta.json'))
+
+    @classmethod
+    def load(cls, cache_dir):
+        return cls(*(np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r') for name in ['read_ids', 'true_taxids', 'lineages']))
+
+    @classmethod
+    def cached(cls, truth_loc, ncbitax, cache_dir):
+        '''the truth of truth_loc, from cache_dir if that was built from the same truth table and
+        taxonomy, otherwise built from them and saved there'''
+        truth_stat, nodes_stat = os.stat(truth_loc), os.stat(ncbitax.nodes_filepath)
+        source = {'truth': os.path.abspath(str(truth_loc)), 'truth_size': truth_stat.st_size, 'truth_mtime': truth_stat.st_mtime_ns,
+                  'nodes': os.path.abspath(ncbitax.nodes_filepath), 'nodes_mtime': nodes_stat.st_mtime_ns}
+        meta_loc = os.path.join(cache_dir, 'meta.json')
+        if os.path.exists(meta_loc):
+            with open(meta_loc, 'r') as meta_f:
+                meta = json.load(meta_f)
+            if meta == {'version': TRUTH_CACHE_VERSION, 'source': source}:
+                return cls.load(cache_dir)
+        truth = cls.from_truth_table(truth_loc, ncbitax)
+        truth.save(cache_dir, source)
+        return truth
+
+    def _same_order(self, read_ids):
+        '''whether read_ids are exactly the truth reads in truth order, as a classifier that keeps the
+        input order reports them. compared as Arrow arrays when pyarrow is installed'''
+        if len(read_ids) != len(self.read_ids):
+            return False
+        try:
+            import pyarrow
+            import pyarrow.compute
+        except ImportError:
+            return bool(np.array_equal(np.asarray(read_ids, dtype=object).astype('S'), self.read_ids))
+        if self._arrow_read_ids is None:
+            self._arrow_read_ids = pyarrow.array(np.asarray(self.read_ids), pyarrow.binary())
+        ids = pyarrow.array(read_ids) if isinstance(read_ids, pd.Series) else pyarrow.array(np.asarray(read_ids, dtype=object), pyarrow.string())
+        return bool(pyarrow.compute.all(pyarrow.compute.equal(ids.cast(pyarrow.binary()), self._arrow_read_ids)).as_py())
+
+    def align(self, reads):
+        '''estimated taxon ID of every truth read, 0 for reads the classifier did not report'''
+        taxids = reads['taxid'].to_numpy(np.int64)
+        if self._same_order(reads['read_id']):
+            return taxids
+        if self._read_index is None:
+            self._read_index = pd.Index(np.char.decode(np.asarray(self.read_ids)))
+        est = pd.Series(taxids, index=reads['read_id'].astype(str).to_numpy())
+        est = est[~est.index.duplicated()]
+        return est.reindex(self._read_index).fillna(0).to_numpy(np.int64)
+
+def rank_profile(profile, lineages, col):
+    '''sums a profile (aligned with the lineages of its taxa) onto the taxa of one rank'''
+    ids = lineages[:, col]
+    keep = ids != 0
+    return pd.Series(profile[keep]).groupby(ids[keep]).sum()
+
+def profile_distances(true_profile, est_profile, ncbitax, min_abundance=0.0):
+    '''compares two abundance profiles (Series taxid -> abundance, any scale) rank by rank. returns
+    ({rank: (taxa TP, FP, FN, precision, recall, L1, Bray-Curtis)}, weighted UniFrac). ranks are compared
+    on profiles renormalized at that rank; the UniFrac-style distance is the mass moved along the
+    taxonomy (unit branch lengths through the main ranks) between the two profiles normalized to 1.'''
+    true_profile = true_profile / true_profile.sum() if true_profile.sum() > 0 else true_profile
+    est_profile = est_profile / est_profile.sum() if est_profile.sum() > 0 else est_profile
+    est_profile = est_profile[est_profile > min_abundance]
+    true_lineages = ncbitax.get_main_rank_lineages(true_profile.index.to_numpy(np.int64))
+    est_lineages = ncbitax.get_main_rank_lineages(est_profile.index.to_numpy(np.int64))
+    by_rank, unifrac = {}, 0.0
+    for col, rank in enumerate(ncbitax.rank_main_seven):
+        p = rank_profile(true_profile.to_numpy(), true_lineages, col)
+        q = rank_profile(est_profile.to_numpy(), est_lineages, col)
+        p, q = p.align(q, fill_value=0)
+        unifrac += float(np.abs(p - q).sum())
+        if rank not in EVAL_RANKS:
+            continue
+        tp, fp, fn = int(((p > 0) & (q > 0)).sum()), int(((p == 0) & (q > 0)).sum()), int(((p > 0) & (q == 0)).sum())
+        pn = p / p.sum() if p.sum() > 0 else p
+        qn = q / q.sum() if q.sum() > 0 else q
+        l1 = float(np.abs(pn - qn).sum())
+        total = float((pn + qn).sum())
+        by_rank[rank] = (tp, fp, fn, tp / (tp + fp) if tp + fp > 0 else 0.0, tp / (tp + fn) if tp + fn > 0 else 0.0,
+                         l1, l1 / total if total > 0 else 0.0)
+    return by_rank, unifrac
+
+RANK_SCORE_COLUMNS = ['tool', 'rank', 'FN', 'TP', 'FP', 'TN', 'read_precision', 'read_recall',
+                      'taxa_TP', 'taxa_FP', 'taxa_FN', 'taxon_precision', 'taxon_recall', 'l1', 'bray_curtis']
+SUMMARY_COLUMNS = ['tool', 'format', 'reads', 'classified', 'weighted_unifrac']
+
+def evaluate_classifiers(outputs, truth, ncbitax, min_abundance=0.0):
+    '''scores every classifier output in outputs ({tool: (format, path)}) against an EvaluationTruth.
+    per-read outputs get read-level FN/TP/FP/TN, precision and recall per rank (as in
+    rescore_kraken2_nanosim_output_by_rank); every output gets taxon detection precision/recall,
+    L1 and Bray-Curtis distances per rank and a weighted UniFrac distance of its profile. with a
+    cached truth (EvaluationTruth.cached) only the classifier outputs are parsed.
+    returns (per-rank DataFrame, per-tool DataFrame)'''
+    rank_rows, summary_rows = [], []
+    for tool, (fmt, path) in outputs.items():
+        reads, profile = load_classifier_output(fmt, path)
+        read_scores, classified = {}, None
+        if reads is not None:
+            est_taxids = truth.align(reads)
+            classified = int(np.count_nonzero(est_taxids))
+            est_lineages = ncbitax.get_main_rank_lineages(est_taxids)
+            for rank in EVAL_RANKS:
+                col = ncbitax.rank_main_seven.index(rank)
+                read_scores[rank] = fn_tp_fp_tn(truth.lineages[:, col], est_lineages[:, col])
+        by_rank, unifrac = profile_distances(truth.profile, profile, ncbitax, min_abundance)
+        for rank in EVAL_RANKS:
+            rank_rows.append([tool, rank] + list(read_scores.get(rank, [None] * 6)) + list(by_rank[rank]))
+        summary_rows.append([tool, fmt, len(truth.read_ids), classified, unifrac])
+    rank_scores = pd.DataFrame(rank_rows, columns=RANK_SCORE_COLUMNS)
+    summary = pd.DataFrame(summary_rows, columns=SUMMARY_COLUMNS)
+    ## profile-only tools have no read counts, keep the others integers next to the missing values
+    rank_scores[['FN', 'TP', 'FP', 'TN']] = rank_scores[['FN', 'TP', 'FP', 'TN']].astype('Int64')
+    summary['classified'] = summary['classified'].astype('Int64')
+    return rank_scores, summary
+
+def write_evaluation(rank_scores, summary, out_folder):
+    '''writes scores_by_rank.tsv and scores.tsv to out_folder'''
+    os.makedirs(out_folder, exist_ok=True)
+    rank_scores.to_csv(os.path.join(out_folder, 'scores_by_rank.tsv'), sep='\t', index=False, float_format='%.5g')
+    summary.to_csv(os.path.join(out_folder, 'scores.tsv'), sep='\t', index=False, float_format='%.5g')
+    return os.path.join(out_folder, 'scores_by_rank.tsv'), os.path.join(out_folder, 'scores.tsv')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scores a Kraken2 run on MIMIC simulated reads against the truth.")
+    parser.add_argument("-k", "--kraken2-output", type=str, required=True, help="Kraken2 per-read output (output.txt, may be gzip or zstd compressed)")
+    parser.add_argument("-m", "--magnet", type=str, required=False, help="Magnet output folder containing cluster_representative.csv")
+    parser.add_argument("--truth", type=str, required=False, help="Per-read truth table from the simulation (simulated_data/truth_table.parquet), used instead of parsing read names")
+    parser.add_argument("--taxonomy", type=str, required=False, help="NCBI taxdump folder (names.dmp/nodes.dmp) for per-rank scoring")
+    parser.add_argument('-t', '--threads', type=int, required=False, default=1, help='Number of threads for multithreading (Default: 1)')
+    args = parser.parse_args()
+    
+    if args.truth is not None:
+        ncbitax = NCBItaxonomy(args.taxonomy, use_mmap_cache=True) if args.taxonomy is not None else None
+        accumulator = score_kraken2_with_truth_table(args.kraken2_output, args.truth, ncbitax)
+    elif args.magnet is not None:
+        accumulator = parallel_score_kraken2_nanosim_output(args.kraken2_output, args.magnet, args.taxonomy, threads=args.threads)
+    else:
+        raise SystemExit('One of --truth or --magnet is required')
+    print('reads\tFN\tTP\tFP')
+    print('%d\t%d\t%d\t%d' % ((accumulator.n_reads,) + tuple(accumulator.overall)))
+    if args.taxonomy is not None:
+        print_rank_table(accumulator.rank_table())
+
+
+if __name__ == '__main__':
+    parse_args()
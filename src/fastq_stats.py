@@ -0,0 +1,173 @@
+"""
+Single pass profile of a FASTQ/FASTA file (optionally compressed): read length histogram, N50, quality
+and base composition. Memory is bounded by the number of distinct read lengths, and uncompressed FASTQ
+files can be split into byte ranges profiled by several processes.
+"""
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from src.io_utils import is_compressed
+from src.seq_utils import iter_fastx
+
+BASES = ['A', 'C', 'G', 'T', 'N']
+MAX_QUALITY = 93
+
+class FastqStats():
+    """Running statistics of a set of reads. Two profiles of parts of a file can be merged"""
+
+    def __init__(self):
+        self.n_reads = 0
+        self.n_bases = 0
+        self.length_counts = {}
+        self.quality_sum = 0
+        self.n_quality_bases = 0
+        self.read_quality_counts = [0] * (MAX_QUALITY + 1)
+        self.composition = dict.fromkeys(BASES + ['other'], 0)
+
+    def add(self, seq:bytes, qual:bytes=None):
+        length = len(seq)
+        self.n_reads += 1
+        self.n_bases += length
+        self.length_counts[length] = self.length_counts.get(length, 0) + 1
+        counted = 0
+        for base in BASES:
+            n = seq.count(base.encode()) + seq.count(base.lower().encode())
+            self.composition[base] += n
+            counted += n
+        self.composition['other'] += length - counted
+        if qual and length:
+            ## phred+33 ASCII codes, summed without making a Python int per base
+            phred_sum = int(np.frombuffer(qual, dtype=np.uint8).sum(dtype=np.int64)) - 33 * len(qual)
+            self.quality_sum += phred_sum
+            self.n_quality_bases += len(qual)
+            self.read_quality_counts[min(MAX_QUALITY, max(0, phred_sum // len(qual)))] += 1
+
+    def merge(self, other):
+        self.n_reads += other.n_reads
+        self.n_bases += other.n_bases
+        for length, count in other.length_counts.items():
+            self.length_counts[length] = self.length_counts.get(length, 0) + count
+        self.quality_sum += other.quality_sum
+        self.n_quality_bases += other.n_quality_bases
+        self.read_quality_counts = [a + b for a, b in zip(self.read_quality_counts, other.read_quality_counts)]
+        for base, count in other.composition.items():
+            self.composition[base] += count
+        return self
+
+    def lengths(self):
+        """(distinct read lengths, number of reads of each length), sorted by length"""
+        lengths = np.array(sorted(self.length_counts), dtype=np.int64)
+        return lengths, np.array([self.length_counts[length] for length in lengths], dtype=np.int64)
+
+    def n50(self):
+        lengths, counts = self.lengths()
+        if len(lengths) == 0:
+            return 0
+        bases = np.cumsum((lengths * counts)[::-1])
+        return int(lengths[::-1][np.searchsorted(bases, bases[-1] / 2)])
+
+    def as_dict(self):
+        lengths, counts = self.lengths()
+        return {'reads': self.n_reads,
+                'bases': self.n_bases,
+                'min_length': int(lengths[0]) if len(lengths) else 0,
+                'max_length': int(lengths[-1]) if len(lengths) else 0,
+                'mean_length': self.n_bases / self.n_reads if self.n_reads else 0,
+                'n50': self.n50(),
+                'mean_quality': self.quality_sum / self.n_quality_bases if self.n_quality_bases else None,
+                'gc_content': (self.composition['G'] + self.composition['C']) / self.n_bases if self.n_bases else 0,
+                'composition': self.composition,
+                'read_quality_histogram': {q: n for q, n in enumerate(self.read_quality_counts) if n},
+                'length_histogram': [[int(length), int(count)] for length, count in zip(lengths, counts)]}
+
+    @classmethod
+    def from_dict(cls, d:dict):
+        stats = cls()
+        stats.n_reads, stats.n_bases = d['reads'], d['bases']
+        stats.length_counts = {length: count for length, count in d['length_histogram']}
+        stats.composition = dict(d['composition'])
+        for q, n in d['read_quality_histogram'].items():
+            stats.read_quality_counts[int(q)] = n
+        if d['mean_quality'] is not None:
+            stats.n_quality_bases = d['bases']
+            stats.quality_sum = d['mean_quality'] * d['bases']
+        return stats
+
+def fastq_block_starts(fastq:str, n_blocks:int):
+    """Byte offsets that split an uncompressed FASTQ file into about n_blocks ranges, each starting at a
+    record. A record start is a line beginning with '@' whose third line begins with '+' (a quality line
+    may also begin with '@', but is never followed two lines later by a '+' line of a well formed file)"""
+    size = os.path.getsize(fastq)
+    starts = [0]
+    with open(fastq, 'rb') as f:
+        for i in range(1, n_blocks):
+            f.seek(max(starts[-1], size * i // n_blocks))
+            f.readline()
+            while True:
+                position = f.tell()
+                lines = [f.readline() for _ in range(3)]
+                if not lines[0]:
+                    position = size
+                    break
+                if lines[0].startswith(b'@') and lines[2].startswith(b'+'):
+                    break
+                f.seek(position)
+                f.readline()
+            if position > starts[-1] and position < size:
+                starts.append(position)
+    return starts + [size]
+
+def _profile_block(block):
+    fastq, start, end = block
+    stats = FastqStats()
+    with open(fastq, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            header = f.readline()
+            if not header:
+                break
+            seq = f.readline().rstrip(b'\r\n')
+            f.readline()
+            stats.add(seq, f.readline().rstrip(b'\r\n'))
+    return stats
+
+def profile_fastx(fastx:str, processes:int=1):
+    """FastqStats of a FASTQ/FASTA file. Uncompressed FASTQ is split in byte ranges over `processes`
+    worker processes; compressed files (decompressed with up to `processes` threads) and FASTA are
+    streamed in a single pass"""
+    with open(fastx, 'rb') as f:
+        first = f.read(1)
+    if is_compressed(fastx) or first != b'@':
+        stats = FastqStats()
+        for _, seq, qual in iter_fastx(fastx, threads=processes):
+            stats.add(seq.encode(), qual.encode() if qual is not None else None)
+        return stats
+
+    starts = fastq_block_starts(fastx, max(1, processes) * 4)
+    blocks = [(fastx, start, end) for start, end in zip(starts[:-1], starts[1:])]
+    if processes <= 1 or len(blocks) == 1:
+        parts = [_profile_block(block) for block in blocks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            parts = pool.map(_profile_block, blocks)
+    stats = FastqStats()
+    for part in parts:
+        stats.merge(part)
+    return stats
+
+def write_fastq_stats(stats:FastqStats, out_loc:str, source:str=None):
+    d = stats.as_dict()
+    if source is not None:
+        d = dict(source=os.path.abspath(str(source)), **d)
+    tmp_loc = out_loc + '.tmp'
+    with open(tmp_loc, 'w') as f:
+        json.dump(d, f, indent=1)
+    os.replace(tmp_loc, out_loc)
+    return out_loc
+
+def read_fastq_stats(stats_loc:str):
+    with open(stats_loc, 'r') as f:
+        return FastqStats.from_dict(json.load(f))
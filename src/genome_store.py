@@ -0,0 +1,142 @@
+"""
+Shared, read-only store of reference genomes. Each genome is kept once, under the sha256 of its
+contents, and sample working directories get hard links (or symlinks across file systems) to it.
+"""
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+from src.seq_utils import build_fasta_index
+
+DEFAULT_GENOME_STORE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'mimic', 'genomes')
+INDEX_COLUMNS = ['accession', 'sha256', 'bytes', 'added', 'taxid']
+
+def file_sha256(path:str):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 22), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class GenomeStore():
+    """objects/<sha256[:2]>/<sha256>.fasta holds the genomes (each with its .fai), index.tsv maps accessions (and
+    their taxonomy ids, when known) to them. The index is only changed under an exclusive lock so several samples
+    can share one store."""
+
+    def __init__(self, store_dir:str=DEFAULT_GENOME_STORE):
+        self.store_dir = store_dir
+        self.index_loc = os.path.join(store_dir, 'index.tsv')
+        os.makedirs(os.path.join(store_dir, 'objects'), exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.store_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_index(self):
+        """accession -> {sha256, bytes, added, taxid}. taxid is '' when unknown (and in stores written before it was kept)"""
+        index = {}
+        if os.path.exists(self.index_loc):
+            with open(self.index_loc, 'r') as f:
+                next(f)
+                for line in f:
+                    accession, digest, size, added, *taxid = line.rstrip('\n').split('\t')
+                    index[accession] = {'sha256': digest, 'bytes': int(size), 'added': added, 'taxid': taxid[0] if taxid else ''}
+        return index
+
+    def _write_index(self, index:dict):
+        tmp_loc = self.index_loc + '.tmp'
+        with open(tmp_loc, 'w') as f:
+            f.write('\t'.join(INDEX_COLUMNS) + '\n')
+            for accession in sorted(index):
+                entry = index[accession]
+                f.write(f"{accession}\t{entry['sha256']}\t{entry['bytes']}\t{entry['added']}\t{entry.get('taxid', '')}\n")
+        os.replace(tmp_loc, self.index_loc)
+
+    def object_loc(self, digest:str):
+        return os.path.join(self.store_dir, 'objects', digest[:2], f'{digest}.fasta')
+
+    def __contains__(self, accession:str):
+        entry = self.read_index().get(accession)
+        return entry is not None and os.path.exists(self.object_loc(entry['sha256']))
+
+    def add(self, accession:str, fasta:str, taxid=None):
+        """Stores fasta under accession (a no-op if identical content is already stored) and returns
+        the location of the stored object. taxid, if given, is recorded so the genome can be found by taxon"""
+        digest = file_sha256(fasta)
+        obj_loc = self.object_loc(digest)
+        if not os.path.exists(obj_loc):
+            os.makedirs(os.path.dirname(obj_loc), exist_ok=True)
+            fd, tmp_loc = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(obj_loc))
+            os.close(fd)
+            shutil.copyfile(fasta, tmp_loc)
+            os.chmod(tmp_loc, 0o444)
+            build_fasta_index(tmp_loc, obj_loc + '.fai')
+            os.chmod(obj_loc + '.fai', 0o444)
+            os.replace(tmp_loc, obj_loc)
+
+        taxid = str(taxid) if taxid is not None else ''
+        with self._locked():
+            index = self.read_index()
+            entry = index.get(accession, {})
+            if entry.get('sha256') != digest or (taxid and entry.get('taxid') != taxid):
+                index[accession] = {'sha256': digest, 'bytes': os.path.getsize(obj_loc),
+                                    'added': entry['added'] if entry.get('sha256') == digest else datetime.datetime.now().isoformat(timespec='seconds'),
+                                    'taxid': taxid or entry.get('taxid', '')}
+                self._write_index(index)
+        return obj_loc
+
+    def materialize(self, accession:str, dest:str):
+        """Links the stored genome for accession (and its .fai) to dest, hard link first, symlink if the store is on
+        another file system. Returns False if the accession is not in the store"""
+        entry = self.read_index().get(accession)
+        if entry is None or not os.path.exists(self.object_loc(entry['sha256'])):
+            return False
+        obj_loc = self.object_loc(entry['sha256'])
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+        for src, dst in [(obj_loc, dest), (obj_loc + '.fai', dest + '.fai')]:
+            if not os.path.exists(src) or (os.path.exists(dst) and os.path.samefile(dst, src)):
+                continue
+            tmp_loc = f'{dst}.tmp'
+            if os.path.lexists(tmp_loc):
+                os.remove(tmp_loc)
+            try:
+                os.link(src, tmp_loc)
+            except OSError:
+                os.symlink(os.path.abspath(src), tmp_loc)
+            os.replace(tmp_loc, dst)
+        return True
+
+    def unlink_folder(self, genome_folder:str):
+        """Removes links into the store from genome_folder, so a tool that rewrites its genomes in place
+        cannot write through a hard link into the store"""
+        if not os.path.isdir(genome_folder):
+            return
+        for name in os.listdir(genome_folder):
+            path = os.path.join(genome_folder, name)
+            if os.path.islink(path) or (os.path.isfile(path) and os.stat(path).st_nlink > 1):
+                os.remove(path)
+
+    def ingest_folder(self, genome_folder:str, suffixes=('.fasta', '.fasta.gz', '.fasta.zst'), taxids:dict=None):
+        """Moves every <accession><suffix> genome in genome_folder into the store and replaces it with a
+        link to the stored copy. taxids maps accessions to the taxonomy ids recorded with them. Returns the
+        accessions ingested"""
+        accessions = []
+        for name in sorted(os.listdir(genome_folder)):
+            path = os.path.join(genome_folder, name)
+            suffix = next((suffix for suffix in suffixes if name.endswith(suffix)), None)
+            if suffix is None or not os.path.isfile(path):
+                continue
+            accession = name[:-len(suffix)]
+            self.add(accession, path, taxid=(taxids or {}).get(accession))
+            self.materialize(accession, path)
+            accessions.append(accession)
+        return accessions
@@ -0,0 +1,139 @@
+"""
+Per-stage resource accounting. Wall and CPU time and I/O of the Python side of a stage are measured in
+the thread that runs it, and every external tool launched through run_command is reaped with wait4 so its
+CPU time, peak RSS and I/O are charged to the stage that started it, even when several stages run at once.
+"""
+import cProfile
+import os
+import resource
+import subprocess
+import threading
+import time
+
+_current = threading.local()
+
+METRIC_FIELDS = ['stage', 'threads', 'wall_time', 'cpu_time', 'child_cpu_time', 'commands', 'peak_rss_mb',
+                 'child_peak_rss_mb', 'bytes_read', 'bytes_written', 'child_bytes_read', 'child_bytes_written']
+
+def _read_proc_io(path:str):
+    """(bytes read, bytes written) from a /proc io file, or (0, 0) where /proc is not available"""
+    try:
+        with open(path, 'r') as f:
+            fields = dict(line.split(': ', 1) for line in f.read().splitlines() if ': ' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def thread_io():
+    """Bytes read and written so far by the calling thread (Linux only)"""
+    return _read_proc_io(f'/proc/self/task/{threading.get_native_id()}/io')
+
+def process_peak_rss_mb():
+    """Peak resident set size of this process in MB. This is process wide, so with stages running at once
+    it is an upper bound for each of them"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageMetrics():
+    """Resource usage of one stage"""
+
+    def __init__(self, name:str, threads:int=1):
+        self.name = name
+        self.threads = threads
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.child_cpu_time = 0.0
+        self.n_commands = 0
+        self.peak_rss_mb = 0.0
+        self.child_peak_rss_mb = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.child_bytes_read = 0
+        self.child_bytes_written = 0
+        self._lock = threading.Lock()
+
+    def add_child_usage(self, rusage, io=(0, 0)):
+        with self._lock:
+            self.child_cpu_time += rusage.ru_utime + rusage.ru_stime
+            self.n_commands += 1
+            ## ru_maxrss is in KB on Linux
+            self.child_peak_rss_mb = max(self.child_peak_rss_mb, rusage.ru_maxrss / 1024)
+            self.child_bytes_read += io[0]
+            self.child_bytes_written += io[1]
+
+    def as_dict(self):
+        return {'stage': self.name,
+                'threads': self.threads,
+                'wall_time': round(self.wall_time, 3),
+                'cpu_time': round(self.cpu_time, 3),
+                'child_cpu_time': round(self.child_cpu_time, 3),
+                'commands': self.n_commands,
+                'peak_rss_mb': round(self.peak_rss_mb, 1),
+                'child_peak_rss_mb': round(self.child_peak_rss_mb, 1),
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'child_bytes_read': self.child_bytes_read,
+                'child_bytes_written': self.child_bytes_written}
+
+def measure_stage(name:str, func, *args, threads:int=1, profile_loc:str=None, **kwargs):
+    """Runs func(*args, **kwargs) in the current thread and returns (result, StageMetrics). If profile_loc
+    is given, the Python side of the stage is run under cProfile and the stats are dumped there"""
+    metrics = StageMetrics(name, threads)
+    previous = getattr(_current, 'metrics', None)
+    _current.metrics = metrics
+    profiler = cProfile.Profile() if profile_loc is not None else None
+    read_start, written_start = thread_io()
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        if profiler is not None:
+            result = profiler.runcall(func, *args, **kwargs)
+        else:
+            result = func(*args, **kwargs)
+    finally:
+        metrics.wall_time = time.perf_counter() - wall_start
+        metrics.cpu_time = time.thread_time() - cpu_start
+        read_end, written_end = thread_io()
+        metrics.bytes_read = read_end - read_start
+        metrics.bytes_written = written_end - written_start
+        metrics.peak_rss_mb = process_peak_rss_mb()
+        _current.metrics = previous
+        if profiler is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(profile_loc)), exist_ok=True)
+            profiler.dump_stats(profile_loc)
+    return result, metrics
+
+def in_current_stage(func):
+    """Wraps func so that when it runs in another thread (e.g. a worker pool inside a stage), the tools it
+    launches are still charged to the stage that created the wrapper"""
+    metrics = getattr(_current, 'metrics', None)
+    
+    def wrapper(*args, **kwargs):
+        previous = getattr(_current, 'metrics', None)
+        _current.metrics = metrics
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.metrics = previous
+    return wrapper
+
+def run_command(cmd, **kwargs):
+    """Drop-in for subprocess.run(cmd, check=True) that records the child's resource usage against
+    the stage running in this thread. Raises CalledProcessError on a non-zero exit."""
+    proc = subprocess.Popen(cmd, **kwargs)
+    try:
+        ## wait for the exit without reaping, so the child's /proc io counters can still be read
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io = _read_proc_io(f'/proc/{proc.pid}/io')
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    metrics = getattr(_current, 'metrics', None)
+    if metrics is not None:
+        metrics.add_child_usage(rusage, io)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return proc
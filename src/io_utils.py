@@ -0,0 +1,145 @@
+"""
+Shared file I/O helpers so every stage can read and write compressed files transparently.
+gzip, bgzip and zstd are supported; (de)compression runs in pigz, bgzip or zstd with several threads
+when they are installed, and falls back to the Python gzip (or zstandard) module otherwise.
+"""
+import gzip
+import io
+import itertools
+import shutil
+import subprocess
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSIONS = ['none', 'gzip', 'bgzip', 'zstd']
+EXTENSIONS = {'gzip': '.gz', 'bgzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+def detect_compression(filename:str):
+    """'gzip', 'bgzip', 'zstd' or 'none', from the magic bytes of a file rather than its extension.
+    bgzip files are gzip files whose header carries the 'BC' extra subfield"""
+    with open(filename, 'rb') as f:
+        head = f.read(14)
+    if head[:2] == GZIP_MAGIC:
+        return 'bgzip' if len(head) >= 14 and head[3] & 4 and head[12:14] == b'BC' else 'gzip'
+    if head[:4] == ZSTD_MAGIC:
+        return 'zstd'
+    return 'none'
+
+def is_gzipped(filename:str):
+    """Checks the magic bytes of a file rather than trusting its extension (bgzip files are gzip files)"""
+    return detect_compression(filename) in ('gzip', 'bgzip')
+
+def is_compressed(filename:str):
+    return detect_compression(filename) != 'none'
+
+def compression_from_extension(filename:str):
+    filename = str(filename)
+    if filename.endswith('.zst'):
+        return 'zstd'
+    if filename.endswith('.bgz'):
+        return 'bgzip'
+    if filename.endswith('.gz'):
+        return 'gzip'
+    return 'none'
+
+def _command(compression:str, reading:bool, threads:int):
+    """(De)compression command line for an external tool, or None if none is installed (or worth starting)"""
+    threads = str(max(1, threads))
+    if compression in ('gzip', 'bgzip'):
+        if compression == 'bgzip' and shutil.which('bgzip'):
+            ## BGZF blocks are independent, so bgzip also decompresses with several threads
+            return ['bgzip', '-dc' if reading else '-c', '-@', threads]
+        if compression == 'gzip' and int(threads) > 1 and shutil.which('pigz'):
+            return ['pigz', '-dc' if reading else '-c', '-p', threads]
+        return None
+    if compression == 'zstd' and shutil.which('zstd'):
+        return ['zstd', '-qdc'] if reading else ['zstd', '-qc', f'-T{threads}']
+    return None
+
+class ProcessFile():
+    """File object over the output (reading) or input (writing) of a (de)compression process. Closing it
+    waits for the process and raises OSError if it failed"""
+
+    def __init__(self, cmd:list, filename:str, mode:str):
+        self.cmd = cmd
+        self.reading = 'r' in mode
+        if self.reading:
+            self._target = None
+            self.proc = subprocess.Popen(cmd + [filename], stdout=subprocess.PIPE)
+            pipe = self.proc.stdout
+        else:
+            self._target = open(filename, 'wb')
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._target)
+            pipe = self.proc.stdin
+        self.handle = pipe if 'b' in mode else io.TextIOWrapper(pipe)
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+    def __iter__(self):
+        return iter(self.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.handle.closed:
+            return
+        try:
+            self.handle.close()
+        except BrokenPipeError:
+            pass
+        ## a reader may stop before the end, which is not an error of the decompressor
+        if self.reading and self.proc.poll() is None:
+            self.proc.terminate()
+        returncode = self.proc.wait()
+        if self._target is not None:
+            self._target.close()
+        if returncode > 0 or (not self.reading and returncode != 0):
+            raise OSError(f"{' '.join(self.cmd)} exited with code {returncode}")
+
+def _open_zstd(filename:str, mode:str, threads:int):
+    try:
+        import zstandard
+    except ImportError:
+        raise OSError(f'{filename}: zstd files need the zstd executable or the zstandard package')
+    if 'r' in mode:
+        return zstandard.open(filename, mode)
+    return zstandard.open(filename, mode, cctx=zstandard.ZstdCompressor(threads=threads if threads > 1 else 0))
+
+def open_file(filename:str, mode:str='rt', threads:int=1, compression:str=None):
+    """Opens plain or compressed (gzip, bgzip, zstd) files. When reading, compression is detected from the
+    file contents; when writing, it is `compression` if given, otherwise chosen from the extension
+    (`.gz`, `.bgz`, `.zst`). threads is a hint for how many threads the (de)compressor may use."""
+    filename = str(filename)
+    if 'r' in mode:
+        compression = detect_compression(filename)
+    elif compression is None:
+        compression = compression_from_extension(filename)
+
+    if compression == 'none':
+        if 'b' in mode:
+            return open(filename, mode)
+        return open(filename, mode.replace('t', ''))
+
+    cmd = _command(compression, 'r' in mode, threads)
+    if cmd is not None:
+        return ProcessFile(cmd, filename, mode)
+    if compression == 'zstd':
+        return _open_zstd(filename, mode if 'b' in mode or 't' in mode else mode + 't', threads)
+    ## without bgzip installed, plain gzip is written: every reader still handles it, but it cannot be indexed
+    mode = mode if 't' in mode or 'b' in mode else mode + 't'
+    if 'r' in mode:
+        return gzip.open(filename, mode)
+    return gzip.open(filename, mode, compresslevel=6)
+
+def iter_chunks(handle, chunk_size:int=100000):
+    """Yields lists of up to chunk_size lines from an open file handle"""
+    while True:
+        chunk = list(itertools.islice(handle, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,142 @@
+"""
+Content-addressed cache of trained NanoSim error/length models, shared between runs so repeat
+simulations of the same sample skip read_analysis.py
+"""
+import datetime
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pandas as pd
+
+DEFAULT_MODEL_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'mimic', 'nanosim_models')
+
+def nanosim_version():
+    """Version string reported by NanoSim's read_analysis.py, 'unknown' if it cannot be determined. The
+    answer is remembered until read_analysis.py itself changes, so repeated runs in one process only ask once"""
+    executable = shutil.which('read_analysis.py')
+    if executable is None:
+        return 'unknown'
+    return _nanosim_version(executable, os.stat(executable).st_mtime_ns)
+
+@functools.lru_cache(maxsize=16)
+def _nanosim_version(executable:str, mtime_ns:int):
+    try:
+        proc = subprocess.run([executable, '--version'], capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+    return (proc.stdout + proc.stderr).strip() or 'unknown'
+
+def genome_list_digest(genome_list_loc:str):
+    """Digest of a NanoSim genome list that ignores where the working directory is: only the species
+    names and the reference file names (accessions) are used"""
+    genome_list = pd.read_csv(genome_list_loc, sep='\t', header=None, dtype=str)
+    h = hashlib.sha256()
+    for species, genome in zip(genome_list[0], genome_list[1]):
+        h.update(f'{species}\t{os.path.basename(str(genome))}\n'.encode())
+    return h.hexdigest()
+
+def _link_or_copy(src:str, dst:str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def reset_training_dir(training_dir:str):
+    """Empties training_dir before NanoSim trains into it. Its files may be hard links to a cached model,
+    and retraining in place would write through them into the cache"""
+    shutil.rmtree(training_dir, ignore_errors=True)
+    os.makedirs(training_dir, exist_ok=True)
+
+class ModelCache():
+    """Directory of trained models, one sub directory per key holding the model files and a meta.json.
+    The total size is kept under max_bytes by evicting the least recently used entries."""
+
+    def __init__(self, cache_dir:str=DEFAULT_MODEL_CACHE, max_bytes:int=50 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(fastq_digest:str, genome_digest:str, version:str, **params):
+        """Key for a model trained on this input with this NanoSim version; params holds anything else
+        that changes the training input (e.g. subsampling settings)"""
+        key = json.dumps({'fastq': fastq_digest, 'genomes': genome_digest, 'nanosim': version, 'params': params}, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def entry_loc(self, key:str):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_meta(self, key:str):
+        with open(os.path.join(self.entry_loc(key), 'meta.json'), 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, entry_loc:str, meta:dict):
+        tmp_loc = os.path.join(entry_loc, 'meta.json.tmp')
+        with open(tmp_loc, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp_loc, os.path.join(entry_loc, 'meta.json'))
+
+    def fetch(self, key:str, training_dir:str):
+        """Materializes a cached model into training_dir (hard links where possible, to read-only files; use
+        reset_training_dir before training into training_dir again). Returns False on a miss"""
+        entry_loc = self.entry_loc(key)
+        if not os.path.isfile(os.path.join(entry_loc, 'meta.json')):
+            return False
+        os.makedirs(training_dir, exist_ok=True)
+        for name in os.listdir(os.path.join(entry_loc, 'model')):
+            dst = os.path.join(training_dir, name)
+            if os.path.exists(dst):
+                os.remove(dst)
+            _link_or_copy(os.path.join(entry_loc, 'model', name), dst)
+
+        meta = self._read_meta(key)
+        meta['last_used'] = datetime.datetime.now().isoformat()
+        self._write_meta(entry_loc, meta)
+        return True
+
+    def store(self, key:str, training_dir:str, **info):
+        """Adds the model files in training_dir under key, then evicts old entries if over budget"""
+        if os.path.isfile(os.path.join(self.entry_loc(key), 'meta.json')):
+            return
+        tmp_loc = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        try:
+            shutil.copytree(training_dir, os.path.join(tmp_loc, 'model'))
+            ## the files are shared by hard links with every run that fetches them, so nothing may modify them
+            for root, _, files in os.walk(os.path.join(tmp_loc, 'model')):
+                for f in files:
+                    os.chmod(os.path.join(root, f), 0o444)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(tmp_loc) for f in files)
+            now = datetime.datetime.now().isoformat()
+            self._write_meta(tmp_loc, dict(info, created=now, last_used=now, size=size))
+            os.replace(tmp_loc, self.entry_loc(key))
+        except OSError:
+            shutil.rmtree(tmp_loc, ignore_errors=True)
+            if not os.path.isfile(os.path.join(self.entry_loc(key), 'meta.json')):
+                raise
+        self.evict(keep=key)
+
+    def entries(self):
+        """(key, meta) of every complete entry"""
+        out = []
+        for key in os.listdir(self.cache_dir):
+            if os.path.isfile(os.path.join(self.entry_loc(key), 'meta.json')):
+                out.append((key, self._read_meta(key)))
+        return out
+
+    def evict(self, keep:str=None):
+        """Removes least recently used entries until the cache fits in max_bytes (never the `keep` entry)"""
+        entries = sorted(self.entries(), key=lambda e: e[1]['last_used'])
+        total = sum(meta['size'] for _, meta in entries)
+        for key, meta in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_loc(key), ignore_errors=True)
+            total -= meta['size']
+            print(f'Evicted NanoSim model {key} from the model cache')
@@ -1,7 +1,14 @@
-import os, datetime
+import os, datetime, json, shutil, tempfile, threading
+from array import array
+from collections.abc import Mapping
+import numpy as np
 
 filemtime2datetime=lambda mypath: datetime.datetime.fromtimestamp(os.stat(mypath).st_mtime)
 
+TAXCACHE_VERSION = 3
+TAXCACHE_FOLDERNAME = 'taxcache'
+RANK_MAIN_SEVEN = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
 def ncbi_taxonomy_parse_nodes_dmp(nodes_dmp_path):
     '''
     Opens the NCBI nodes.dmp file from the taxdump FTP site. Parses it into a dictionary with
@@ -43,24 +50,339 @@ def ncbi_taxonomy_parse_names_dmp(names_dmp_path):
         names_dmp = [i.strip().split('\t') for i in names_dmp_f.readlines()]
     return {int(x[0]): (x[2], x[4], x[6]) for x in names_dmp if x[6]=='scientific name'}
 
+def ncbi_taxonomy_iter_dmp(dmp_path):
+    '''
+    Streams the rows of a taxdump `.dmp` file one at a time as a list of fields (with the `\t|\t`
+    separators removed), so the whole file never has to sit in memory at once.
+    '''
+    with open(dmp_path, 'r') as dmp_f:
+        for line in dmp_f:
+            yield line.rstrip('\n').rstrip('\t|').split('\t|\t')
+
+def _write_string_table(strings_by_taxid, n_slots, blob_path, offsets_path):
+    '''
+    Writes a string table indexed by taxid: a flat utf-8 blob plus an offsets array such that the
+    string for taxid `t` is `blob[offsets[t]:offsets[t+1]]` (empty for taxids with no entry).
+    '''
+    lengths = np.zeros(n_slots, dtype=np.int64)
+    with open(blob_path, 'wb') as blob_f:
+        for taxid in sorted(strings_by_taxid):
+            encoded = strings_by_taxid[taxid].encode('utf-8')
+            lengths[taxid] = len(encoded)
+            blob_f.write(encoded)
+    offsets = np.zeros(n_slots + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(offsets_path, offsets)
+
+def ncbi_taxonomy_compile_cache(nodes_dmp_path, names_dmp_path, cache_folder):
+    '''
+    One-time compile step that converts the NCBI nodes.dmp/names.dmp text dumps into a compact binary
+    layout that can be memory-mapped by :class:`NCBItaxonomyCache`. The cache folder holds:
+        parent.npy        int32 array, parent taxid indexed by taxid (-1 where the taxid does not exist)
+        rank.npy          uint8 array, index into meta['ranks'] indexed by taxid
+        main_rank_ancestors.npy   int32 (n x 7) array, ancestor at each of the main seven ranks (0 if none)
+        lca_up.npy / lca_depth.npy    binary-lifting tables for :class:`TaxonomyLCAIndex`
+        names.bin / name_offsets.npy       string table of scientific names
+        unames.bin / uname_offsets.npy     string table of the "unique name" column
+        meta.json         format version, rank vocabulary and the mtimes of the source dump files
+
+    The folder is written to a temporary location and moved into place at the end so that concurrent
+    readers never see a half-written cache.
+
+    Args:
+        nodes_dmp_path (str): path to the file `nodes.dmp` from the NCBI taxonomy.
+        names_dmp_path (str): path to the file `names.dmp` from the NCBI taxonomy.
+        cache_folder (str): destination folder for the compiled cache.
+
+    Returns:
+        str: the cache folder
+    '''
+    taxids, parents, rank_codes = array('i'), array('i'), array('B')
+    rank_vocab = {}
+    for x in ncbi_taxonomy_iter_dmp(nodes_dmp_path):
+        taxids.append(int(x[0]))
+        parents.append(int(x[1]))
+        rank_codes.append(rank_vocab.setdefault(x[2], len(rank_vocab)))
+    taxids = np.frombuffer(taxids, dtype=np.int32)
+    n_slots = int(taxids.max()) + 1 if len(taxids) > 0 else 1
+
+    parent_arr = np.full(n_slots, -1, dtype=np.int32)
+    parent_arr[taxids] = np.frombuffer(parents, dtype=np.int32)
+    rank_arr = np.zeros(n_slots, dtype=np.uint8)
+    rank_arr[taxids] = np.frombuffer(rank_codes, dtype=np.uint8)
+
+    names, unames = {}, {}
+    for x in ncbi_taxonomy_iter_dmp(names_dmp_path):
+        if x[3] == 'scientific name':
+            taxid = int(x[0])
+            if taxid < n_slots:
+                names[taxid] = x[1]
+                if x[2] != '':
+                    unames[taxid] = x[2]
+
+    parent_folder = os.path.dirname(os.path.abspath(cache_folder))
+    os.makedirs(parent_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix='.taxcache_', dir=parent_folder)
+    try:
+        np.save(os.path.join(tmp_folder, 'parent.npy'), parent_arr)
+        np.save(os.path.join(tmp_folder, 'rank.npy'), rank_arr)
+        np.save(os.path.join(tmp_folder, 'main_rank_ancestors.npy'),
+                ncbi_taxonomy_main_rank_ancestors(parent_arr, rank_arr, sorted(rank_vocab, key=rank_vocab.get)))
+        lca_index = TaxonomyLCAIndex.from_parent_array(parent_arr)
+        np.save(os.path.join(tmp_folder, 'lca_up.npy'), lca_index.up)
+        np.save(os.path.join(tmp_folder, 'lca_depth.npy'), lca_index.depth)
+        _write_string_table(names, n_slots, os.path.join(tmp_folder, 'names.bin'), os.path.join(tmp_folder, 'name_offsets.npy'))
+        _write_string_table(unames, n_slots, os.path.join(tmp_folder, 'unames.bin'), os.path.join(tmp_folder, 'uname_offsets.npy'))
+        meta = {
+            'version': TAXCACHE_VERSION,
+            'ranks': sorted(rank_vocab, key=rank_vocab.get),
+            'n_slots': n_slots,
+            'n_taxa': int(len(taxids)),
+            'nodes_fetch_date': filemtime2datetime(nodes_dmp_path).isoformat(),
+            'names_fetch_date': filemtime2datetime(names_dmp_path).isoformat(),
+        }
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as meta_f:
+            json.dump(meta, meta_f, indent=1)
+        if os.path.isdir(cache_folder):
+            shutil.rmtree(cache_folder, ignore_errors=True)
+        os.replace(tmp_folder, cache_folder)
+    except OSError:
+        # another process may have moved a fresh cache into place first, which is fine
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        if not os.path.isfile(os.path.join(cache_folder, 'meta.json')):
+            raise
+    return cache_folder
+
+def ncbi_nodes_to_arrays(ncbi_taxonomy_nodes_dmp):
+    '''
+    Converts the parsed nodes.dmp dictionary into the array layout used by the cache.
+
+    Returns:
+        tuple: (parent_arr, rank_arr, ranks) where parent_arr[taxid] is the parent taxid (-1 if the taxid does not
+            exist) and ranks[rank_arr[taxid]] is the rank name.
+    '''
+    n_slots = max(ncbi_taxonomy_nodes_dmp) + 1 if len(ncbi_taxonomy_nodes_dmp) > 0 else 1
+    rank_vocab = {}
+    parent_arr = np.full(n_slots, -1, dtype=np.int32)
+    rank_arr = np.zeros(n_slots, dtype=np.uint8)
+    for taxid, (parent, rank) in ncbi_taxonomy_nodes_dmp.items():
+        parent_arr[taxid] = parent
+        rank_arr[taxid] = rank_vocab.setdefault(rank, len(rank_vocab))
+    return parent_arr, rank_arr, sorted(rank_vocab, key=rank_vocab.get)
+
+def ncbi_taxonomy_main_rank_ancestors(parent_arr, rank_arr, ranks, rank_names=RANK_MAIN_SEVEN, max_depth=200):
+    '''
+    Computes, for every taxid at once, its ancestor (or itself) at each rank in `rank_names`. All taxids are walked
+    up the tree in lockstep, one parent step per iteration, so the cost is ~(tree depth) vectorized passes rather
+    than one Python loop per taxid. Where a lineage has the same rank twice the lowest one wins, matching
+    `NCBItaxonomy.get_taxid_lineage(..., format='rank2taxidnm')`.
+
+    Args:
+        parent_arr (np.ndarray): parent taxid indexed by taxid, -1 for taxids that do not exist.
+        rank_arr (np.ndarray): rank code indexed by taxid.
+        ranks (list): rank name for each rank code.
+        rank_names (list): ranks to report, one column each.
+
+    Returns:
+        np.ndarray: int32 array of shape (len(parent_arr), len(rank_names)), 0 where there is no ancestor at that rank.
+    '''
+    out = np.zeros((len(parent_arr), len(rank_names)), dtype=np.int32)
+    col_of_code = np.array([rank_names.index(r) if r in rank_names else -1 for r in ranks] or [-1], dtype=np.int64)
+    rows = np.flatnonzero(np.asarray(parent_arr) >= 0)
+    cur = rows.copy()
+    for _ in range(max_depth):
+        if len(cur) == 0:
+            break
+        cols = col_of_code[rank_arr[cur]]
+        hit = np.flatnonzero(cols >= 0)
+        hit = hit[out[rows[hit], cols[hit]] == 0]
+        out[rows[hit], cols[hit]] = cur[hit]
+        nxt = parent_arr[cur]
+        keep = (nxt != cur) & (nxt > 0)
+        rows, cur = rows[keep], nxt[keep].astype(np.int64)
+    return out
+
+class TaxonomyLCAIndex():
+    '''
+    Binary-lifting index over the taxonomy tree. `up[k][t]` is the 2**k-th ancestor of taxid `t` (the root is its
+    own parent) and `depth[t]` is the number of edges from `t` up to the root. Slot 0 is a sentinel that points to
+    itself and taxids that do not exist point to it, so queries involving taxid 0 (unclassified) or unknown taxids
+    return 0. All queries take arrays and run as O(log depth) vectorized passes.
+    '''
+
+    def __init__(self, up, depth):
+        self.up = up
+        self.depth = depth
+
+    @classmethod
+    def from_parent_array(cls, parent_arr):
+        '''Builds the tables from a parent array (-1 for missing taxids) by repeated pointer doubling.'''
+        slots = np.arange(len(parent_arr), dtype=np.int32)
+        parent = np.where(np.asarray(parent_arr) >= 0, parent_arr, 0).astype(np.int32)
+        parent[0] = 0
+        ups = [parent]
+        dist = (parent != slots).astype(np.int32)
+        while True:
+            prev = ups[-1]
+            nxt = prev[prev]
+            if np.array_equal(nxt, prev):
+                break
+            dist = dist + dist[prev]
+            ups.append(nxt)
+        return cls(np.stack(ups), dist)
+
+    def _valid(self, taxids):
+        in_range = (taxids > 0) & (taxids < len(self.depth))
+        # every real taxid ends up at the root after the longest jump, missing ones end up at the sentinel
+        return in_range & (self.up[-1][np.where(in_range, taxids, 0)] != 0)
+
+    def lca(self, taxids_a, taxids_b):
+        '''
+        Lowest common ancestor of each pair (taxids_a[i], taxids_b[i]).
+
+        Returns:
+            np.ndarray: LCA taxids, 0 where either taxid is 0 or unknown.
+        '''
+        a = np.asarray(taxids_a, dtype=np.int64).ravel()
+        b = np.asarray(taxids_b, dtype=np.int64).ravel()
+        valid = self._valid(a) & self._valid(b)
+        a = np.where(valid, a, 0)
+        b = np.where(valid, b, 0)
+        # make `a` the deeper of the two, then lift it to the depth of `b`
+        swap = self.depth[a] < self.depth[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        diff = self.depth[a] - self.depth[b]
+        for k in range(len(self.up)):
+            step = ((diff >> k) & 1).astype(bool)
+            a[step] = self.up[k][a[step]]
+        # lift both while their ancestors differ; what is left one step up is the LCA
+        for k in range(len(self.up) - 1, -1, -1):
+            ua, ub = self.up[k][a], self.up[k][b]
+            m = ua != ub
+            a[m], b[m] = ua[m], ub[m]
+        out = np.where(a == b, a, self.up[0][a])
+        return np.where(valid, out, 0)
+
+    def distance(self, taxids_a, taxids_b):
+        '''Number of tree edges between each pair via their LCA, -1 where either taxid is 0 or unknown.'''
+        a = np.asarray(taxids_a, dtype=np.int64).ravel()
+        b = np.asarray(taxids_b, dtype=np.int64).ravel()
+        lca = self.lca(a, b)
+        valid = lca > 0
+        d = np.full(len(a), -1, dtype=np.int64)
+        d[valid] = self.depth[a[valid]] + self.depth[b[valid]] - 2 * self.depth[lca[valid]]
+        return d
+
+def _mmap_bytes(path):
+    '''np.memmap refuses zero-length files, so fall back to an empty array for those.'''
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+class NCBItaxonomyCache():
+    '''Read-only, memory-mapped view of a taxonomy cache written by :func:`ncbi_taxonomy_compile_cache`.
+    Opening one is near-instant and the pages are shared between every process that maps the same files.'''
+
+    def __init__(self, cache_folder):
+        self.folder = cache_folder
+        with open(os.path.join(cache_folder, 'meta.json'), 'r') as meta_f:
+            self.meta = json.load(meta_f)
+        self.ranks = self.meta['ranks']
+        self.parent = np.load(os.path.join(cache_folder, 'parent.npy'), mmap_mode='r')
+        self.rank = np.load(os.path.join(cache_folder, 'rank.npy'), mmap_mode='r')
+        self.main_rank_ancestors = np.load(os.path.join(cache_folder, 'main_rank_ancestors.npy'), mmap_mode='r')
+        self.lca_index = TaxonomyLCAIndex(np.load(os.path.join(cache_folder, 'lca_up.npy'), mmap_mode='r'),
+                                          np.load(os.path.join(cache_folder, 'lca_depth.npy'), mmap_mode='r'))
+        self._name_offsets = np.load(os.path.join(cache_folder, 'name_offsets.npy'), mmap_mode='r')
+        self._names = _mmap_bytes(os.path.join(cache_folder, 'names.bin'))
+        self._uname_offsets = np.load(os.path.join(cache_folder, 'uname_offsets.npy'), mmap_mode='r')
+        self._unames = _mmap_bytes(os.path.join(cache_folder, 'unames.bin'))
+
+    @staticmethod
+    def is_current(cache_folder, nodes_fetch_date, names_fetch_date):
+        '''True if the cache exists, has the current format and was compiled from dump files with these mtimes.'''
+        meta_path = os.path.join(cache_folder, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, 'r') as meta_f:
+            meta = json.load(meta_f)
+        return (meta.get('version') == TAXCACHE_VERSION and
+                meta.get('nodes_fetch_date') == (nodes_fetch_date.isoformat() if nodes_fetch_date else None) and
+                meta.get('names_fetch_date') == (names_fetch_date.isoformat() if names_fetch_date else None))
+
+    def has_taxid(self, taxid):
+        return 0 <= taxid < len(self.parent) and self.parent[taxid] >= 0
+
+    def _string(self, blob, offsets, taxid):
+        return bytes(blob[offsets[taxid]:offsets[taxid + 1]]).decode('utf-8')
+
+    def name(self, taxid):
+        return self._string(self._names, self._name_offsets, taxid)
+
+    def unique_name(self, taxid):
+        return self._string(self._unames, self._uname_offsets, taxid)
+
+class _TaxCacheNodesView(Mapping):
+    '''Dict-like stand-in for the parsed nodes.dmp ({taxid: (parent_taxid, rank)}) backed by the mmap cache.'''
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __getitem__(self, taxid):
+        if not self._cache.has_taxid(taxid):
+            raise KeyError(taxid)
+        return (int(self._cache.parent[taxid]), self._cache.ranks[self._cache.rank[taxid]])
+
+    def __iter__(self):
+        return (int(i) for i in np.flatnonzero(np.asarray(self._cache.parent) >= 0))
+
+    def __len__(self):
+        return self._cache.meta['n_taxa']
+
+class _TaxCacheNamesView(Mapping):
+    '''Dict-like stand-in for the parsed names.dmp ({taxid: (name, unique_name, name_type)}) backed by the mmap cache.'''
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __getitem__(self, taxid):
+        if not self._cache.has_taxid(taxid) or self._cache._name_offsets[taxid] == self._cache._name_offsets[taxid + 1]:
+            raise KeyError(taxid)
+        return (self._cache.name(taxid), self._cache.unique_name(taxid), 'scientific name')
+
+    def __iter__(self):
+        return (int(i) for i in np.flatnonzero(np.diff(np.asarray(self._cache._name_offsets)) > 0))
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(np.asarray(self._cache._name_offsets)) > 0))
+
 class NCBItaxonomy():
     '''Helper class to hold the NCBI taxonomy names/nodes files and easily return info without having to pass
     the big dictionary objects in every time.'''
-    rank_main_seven = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+    rank_main_seven = RANK_MAIN_SEVEN
     rank_prefixes = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__']
 
-    def __init__(self, taxdmp_folder, default_dmp_filenames=True, lazy_parse=False):
+    def __init__(self, taxdmp_folder, default_dmp_filenames=True, lazy_parse=False, use_mmap_cache=False, cache_folder=None):
         '''
         Initializes the object. Cannonically the taxdmp object from the ftp site is all in one folder, so this thing
         can be initialized just by specifying that.
+
+        With `use_mmap_cache=True` the dump files are compiled once into a binary cache (in `cache_folder`, default
+        `<taxdmp_folder>/taxcache`) and memory-mapped instead of parsed. The cache is recompiled automatically when
+        the mtimes of names.dmp/nodes.dmp no longer match the ones it was built from. `nodes_d` and `names_d`
+        are then read-only dict-like views over the mapped arrays.
         '''
         self.folder = taxdmp_folder
+        self.cache = None
+        self._main_rank_ancestors = None
+        self._lca_index = None
         if default_dmp_filenames:
             self.names_filepath = os.path.join(self.folder, 'names.dmp')
             self.nodes_filepath = os.path.join(self.folder, 'nodes.dmp')
             self.names_fetch_date = filemtime2datetime(self.names_filepath) if os.path.isfile(self.names_filepath) else None
             self.nodes_fetch_date = filemtime2datetime(self.nodes_filepath) if os.path.isfile(self.nodes_filepath) else None
-            if not lazy_parse:
+            if use_mmap_cache:
+                self.cache_folder = cache_folder if cache_folder is not None else os.path.join(self.folder, TAXCACHE_FOLDERNAME)
+                self.load_mmap_cache()
+            elif not lazy_parse:
                 self.parse_names_nodes_dmp()
             else:
                 self._names_d = None
@@ -88,6 +410,87 @@ class NCBItaxonomy():
         self._names_d = ncbi_taxonomy_parse_names_dmp(self.names_filepath)
         self._nodes_d = ncbi_taxonomy_parse_nodes_dmp(self.nodes_filepath)
 
+    def load_mmap_cache(self):
+        '''
+        Memory-maps the compiled taxonomy cache, compiling it first if it is missing or stale.
+        '''
+        if not NCBItaxonomyCache.is_current(self.cache_folder, self.nodes_fetch_date, self.names_fetch_date):
+            if self.nodes_fetch_date is None or self.names_fetch_date is None:
+                raise FileNotFoundError(f'Cannot compile the taxonomy cache, names.dmp/nodes.dmp not found in {self.folder}')
+            print(f'Compiling NCBI taxonomy cache into {self.cache_folder}')
+            ncbi_taxonomy_compile_cache(self.nodes_filepath, self.names_filepath, self.cache_folder)
+        self.cache = NCBItaxonomyCache(self.cache_folder)
+        self._nodes_d = _TaxCacheNodesView(self.cache)
+        self._names_d = _TaxCacheNamesView(self.cache)
+
+    @property
+    def main_rank_ancestors(self):
+        '''(max_taxid+1) x 7 matrix of the superkingdom..species ancestor of every taxid, computed on first use
+        (or mapped straight from the cache).'''
+        if self._main_rank_ancestors is None:
+            if self.cache is not None:
+                self._main_rank_ancestors = self.cache.main_rank_ancestors
+            else:
+                self._main_rank_ancestors = ncbi_taxonomy_main_rank_ancestors(*ncbi_nodes_to_arrays(self.nodes_d))
+        return self._main_rank_ancestors
+
+    def get_main_rank_lineages(self, taxids):
+        '''
+        Batch version of `get_taxid_lineage` restricted to the main seven ranks. Duplicate taxids are only
+        looked up once.
+
+        Args:
+            taxids (array-like): taxon IDs to resolve. 0 and unknown taxids give an all-zero row.
+
+        Returns:
+            np.ndarray: int32 array of shape (len(taxids), 7) with the ancestor taxid at each rank of
+                `rank_main_seven` (superkingdom..species), 0 where the lineage has no node at that rank.
+        '''
+        taxids = np.asarray(taxids, dtype=np.int64).ravel()
+        uniq, inverse = np.unique(taxids, return_inverse=True)
+        anc = self.main_rank_ancestors
+        valid = (uniq > 0) & (uniq < anc.shape[0])
+        rows = np.zeros((len(uniq), len(self.rank_main_seven)), dtype=np.int32)
+        rows[valid] = anc[uniq[valid]]
+        return rows[inverse.ravel()]
+
+    @property
+    def lca_index(self):
+        ''':class:`TaxonomyLCAIndex` over the whole tree, built on first use (or mapped straight from the cache).'''
+        if self._lca_index is None:
+            if self.cache is not None:
+                self._lca_index = self.cache.lca_index
+            else:
+                self._lca_index = TaxonomyLCAIndex.from_parent_array(ncbi_nodes_to_arrays(self.nodes_d)[0])
+        return self._lca_index
+
+    def get_rank_ancestors(self, taxids, rank):
+        '''
+        Ancestor (or self) of each taxid at one of the main seven ranks, 0 where there is none. This is a single
+        column lookup into `main_rank_ancestors`.
+        '''
+        if rank not in self.rank_main_seven:
+            raise ValueError(f'rank must be one of {self.rank_main_seven}, got {rank}')
+        return self.get_main_rank_lineages(taxids)[:, self.rank_main_seven.index(rank)]
+
+    def get_lca(self, taxids_a, taxids_b):
+        '''Lowest common ancestor of each pair of taxids (arrays of equal length), 0 where either is 0/unknown.'''
+        return self.lca_index.lca(taxids_a, taxids_b)
+
+    def get_lca_distance(self, taxids_a, taxids_b):
+        '''Tree distance (edges) between each pair of taxids through their LCA, -1 where either is 0/unknown.'''
+        return self.lca_index.distance(taxids_a, taxids_b)
+
+    def get_lowest_main_rank(self, taxids):
+        '''
+        For each taxid, the index into `rank_main_seven` of the lowest main rank in its lineage (e.g. 6 for a
+        species or strain, 5 for a genus), -1 for 0/unknown taxids or nodes above superkingdom.
+        '''
+        lineages = self.get_main_rank_lineages(taxids)
+        has_rank = lineages != 0
+        lowest = len(self.rank_main_seven) - 1 - np.argmax(has_rank[:, ::-1], axis=1)
+        return np.where(has_rank.any(axis=1), lowest, -1)
+
     def get_taxid_full_info(self, taxid, print_string=False):
         '''Returns the info from both files in a neatly organized format (i.e. TaxID, Name, Rank, Parent, Name-Type)'''
         nm_info = self.names_d[taxid]
@@ -157,3 +560,21 @@ def ncbi_taxonid_to_lineage_rawvector(taxid, ncbi_taxonomy_nodes_dmp, ncbi_taxon
     main_rank_rows = [ranks[::-1].index(i) if i in ranks else -1 for i in rank_main_seven]
     return list3tup, main_rank_rows
 
+_LOADED_TAXONOMIES = {}
+_LOADED_TAXONOMIES_LOCK = threading.Lock()
+
+def load_ncbi_taxonomy(taxdmp_folder):
+    '''
+    Memory-mapped :class:`NCBItaxonomy` of a taxdump folder, opened once per process and shared by every
+    caller (a long running ``mimic.py serve`` scores many jobs against the same taxonomy). It is reopened
+    when names.dmp/nodes.dmp change, which also recompiles the cache.
+    '''
+    folder = os.path.abspath(taxdmp_folder)
+    key = tuple(os.stat(os.path.join(folder, f)).st_mtime_ns if os.path.isfile(os.path.join(folder, f)) else None
+                for f in ['names.dmp', 'nodes.dmp'])
+    with _LOADED_TAXONOMIES_LOCK:
+        loaded = _LOADED_TAXONOMIES.get(folder)
+        if loaded is None or loaded[0] != key:
+            loaded = (key, NCBItaxonomy(folder, use_mmap_cache=True))
+            _LOADED_TAXONOMIES[folder] = loaded
+        return loaded[1]
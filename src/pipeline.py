@@ -0,0 +1,347 @@
+"""
+Stage graph for the MIMIC pipeline. Every stage that finishes writes a completion marker keyed on
+the digests of its input files, its parameters and the keys of the stages it depends on, so a re-run
+skips stages that are still up to date and resumes from the first one that failed or went stale.
+"""
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from src.instrumentation import METRIC_FIELDS, measure_stage
+
+STATE_DIRNAME = '.mimic'
+
+class DigestCache():
+    """sha256 digests of input files, remembered by (size, mtime) so large inputs such as the
+    sample FASTQ are only hashed once per working directory. Stages running in parallel share one cache, so
+    it is only read and saved under a lock"""
+
+    def __init__(self, cache_loc:str):
+        self.cache_loc = cache_loc
+        self._digests = {}
+        self._lock = threading.Lock()
+        if os.path.exists(cache_loc):
+            with open(cache_loc, 'r') as f:
+                self._digests = json.load(f)
+
+    def digest(self, path:str):
+        path = os.path.abspath(str(path))
+        if not os.path.exists(path):
+            return 'missing'
+        if os.path.isdir(path):
+            return self._dir_digest(path)
+
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        ## hashed outside the lock, so a large input does not hold up the other stages
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 22), b''):
+                h.update(block)
+        with self._lock:
+            self._digests[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+            self._save()
+        return h.hexdigest()
+
+    def _dir_digest(self, path:str):
+        """Directories (databases, genome folders) are keyed on their listing, not their contents"""
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                h.update(f'{os.path.relpath(os.path.join(root, name), path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+        return h.hexdigest()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        fd, tmp_loc = tempfile.mkstemp(prefix='.digests_', dir=os.path.dirname(self.cache_loc))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._digests, f)
+            os.replace(tmp_loc, self.cache_loc)
+        except BaseException:
+            if os.path.exists(tmp_loc):
+                os.remove(tmp_loc)
+            raise
+
+class ResourceBudget():
+    """Threads and memory shared by every pipeline that runs with it, e.g. all samples of a batch.
+    A stage only starts once its threads and its memory estimate fit in what is left; a stage that needs
+    more memory than the whole budget may still run, but only while nothing else holds memory."""
+
+    def __init__(self, threads:int, memory:int=None):
+        self.threads = max(1, threads)
+        self.memory = memory
+        self.free_threads = self.threads
+        self.free_memory = memory
+        self._cond = threading.Condition()
+
+    def available(self):
+        with self._cond:
+            return self.free_threads
+
+    def try_acquire(self, threads:int, memory:int=0):
+        with self._cond:
+            if threads > self.free_threads:
+                return False
+            if self.memory is not None and memory > self.free_memory and self.free_memory < self.memory:
+                return False
+            self.free_threads -= threads
+            if self.memory is not None:
+                self.free_memory -= memory
+            return True
+
+    def release(self, threads:int, memory:int=0):
+        with self._cond:
+            self.free_threads += threads
+            if self.memory is not None:
+                self.free_memory += memory
+            self._cond.notify_all()
+
+    def wait(self, timeout:float=None):
+        """Blocks until another pipeline releases resources (or timeout)"""
+        with self._cond:
+            self._cond.wait(timeout)
+
+class Stage():
+    """One step of the pipeline.
+
+    func is called with the number of threads it was given. inputs are files/directories whose contents key the stage,
+    outputs are files that must still exist for the stage to count as complete, params are any
+    other settings that change the result, and deps are the names of upstream stages. A stage is
+    keyed on the key of each upstream stage, unless it lists some of that stage's outputs among its
+    own inputs, in which case only the content of those files matters. Multithreaded stages get a
+    share of the pipeline's thread budget, the others a single thread. memory is an estimate in bytes
+    of what the stage needs, counted against the memory budget if there is one."""
+
+    def __init__(self, name:str, func, inputs=(), outputs=(), params=None, deps=(), multithreaded=False, memory:int=0):
+        self.name = name
+        self.multithreaded = multithreaded
+        self.memory = memory
+        self.func = func
+        self.inputs = [str(i) for i in inputs if i is not None]
+        self.outputs = [str(i) for i in outputs if i is not None]
+        self.params = params if params is not None else {}
+        self.deps = list(deps)
+
+class Pipeline():
+    """Runs stages as soon as the stages they depend on are done, skipping the ones whose marker is
+    still current. Independent stages run concurrently and split a global thread budget."""
+
+    def __init__(self, working:str, name:str=None, profile:bool=False):
+        self.working = str(working)
+        self.name = name
+        self.profile = profile
+        self.stages = {}
+        self.state_dir = os.path.join(self.working, STATE_DIRNAME)
+        self.marker_dir = os.path.join(self.state_dir, 'stages')
+        os.makedirs(self.marker_dir, exist_ok=True)
+        self.digests = DigestCache(os.path.join(self.state_dir, 'digests.json'))
+        self.keys = {}
+        self.metrics = {}
+        self.status = {}
+
+    def add_stage(self, name:str, func, inputs=(), outputs=(), params=None, deps=(), multithreaded=False, memory:int=0):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dep}')
+        self.stages[name] = Stage(name, func, inputs, outputs, params, deps, multithreaded, memory)
+        return self.stages[name]
+
+    def log(self, stage_name:str, message:str):
+        prefix = f'{self.name}:{stage_name}' if self.name is not None else stage_name
+        print(f'[{prefix}] {message}')
+
+    def downstream(self, name:str):
+        """The named stage plus every stage that (transitively) depends on it"""
+        if name not in self.stages:
+            raise ValueError(f'Unknown stage {name}, choose from: {", ".join(self.stages)}')
+        found = {name}
+        for stage in self.stages.values():
+            if any(dep in found for dep in stage.deps):
+                found.add(stage.name)
+        return found
+
+    def marker_loc(self, name:str):
+        return os.path.join(self.marker_dir, f'{name}.json')
+
+    def read_marker(self, name:str):
+        if not os.path.exists(self.marker_loc(name)):
+            return None
+        with open(self.marker_loc(name), 'r') as f:
+            return json.load(f)
+
+    def stage_key(self, stage:Stage):
+        key = {
+            'stage': stage.name,
+            'params': stage.params,
+            'inputs': {i: self.digests.digest(i) for i in stage.inputs},
+            'deps': {dep: self.keys.get(dep, '') for dep in stage.deps
+                     if not set(self.stages[dep].outputs) & set(stage.inputs)},
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_up_to_date(self, stage:Stage, key:str):
+        marker = self.read_marker(stage.name)
+        return marker is not None and marker['key'] == key and all(os.path.exists(i) for i in stage.outputs)
+
+    def thread_shares(self, ready, free:int):
+        """Splits the free threads over the ready stages: one each for single-threaded stages, an even
+        share of the rest for the multithreaded ones. Stages that do not fit wait for the next round."""
+        shares = {}
+        for stage in [s for s in ready if not s.multithreaded]:
+            if free < 1:
+                return shares
+            shares[stage.name] = 1
+            free -= 1
+        multithreaded = [s for s in ready if s.multithreaded]
+        for i, stage in enumerate(multithreaded):
+            if free < 1:
+                break
+            share = max(1, free // (len(multithreaded) - i))
+            shares[stage.name] = share
+            free -= share
+        return shares
+
+    def write_marker(self, stage:Stage, key:str, metrics):
+        with open(self.marker_loc(stage.name), 'w') as f:
+            json.dump({'key': key,
+                       'params': stage.params,
+                       'completed': datetime.datetime.now().isoformat(),
+                       'metrics': metrics.as_dict()}, f, indent=1, default=str)
+
+    def run(self, force_from:str=None, skip_before:str=None, threads:int=1, budget:ResourceBudget=None):
+        """Runs the pipeline with at most `threads` threads in use across all running stages. When budget is
+        given (shared with other pipelines) the threads are also taken from it.
+
+        force_from reruns the named stage and everything downstream of it even if up to date.
+        skip_before does not run any stage added before the named one (their outputs are assumed to
+        exist already, e.g. for --simulate-only on a directory from an older MIMIC version)."""
+        budget = budget if budget is not None else ResourceBudget(threads)
+        forced = self.downstream(force_from) if force_from is not None else set()
+        skipped = set()
+        if skip_before is not None:
+            self.downstream(skip_before)
+            for name in self.stages:
+                if name == skip_before:
+                    break
+                skipped.add(name)
+
+        pending = list(self.stages.values())
+        done = set()
+        running = {}
+        stage_keys = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as pool:
+            while pending or running:
+                ready = [s for s in pending if all(dep in done for dep in s.deps)] if failure is None else []
+
+                ## resolve skipped and up to date stages straight away, which may make more stages ready
+                to_run = []
+                for stage in ready:
+                    if stage.name in skipped:
+                        marker = self.read_marker(stage.name)
+                        self.keys[stage.name] = marker['key'] if marker is not None else ''
+                        self.status[stage.name] = 'skipped'
+                        self.log(stage.name, 'skipped')
+                    else:
+                        stage_keys[stage.name] = self.stage_key(stage)
+                        if stage.name in forced or not self.is_up_to_date(stage, stage_keys[stage.name]):
+                            to_run.append(stage)
+                            continue
+                        self.keys[stage.name] = stage_keys[stage.name]
+                        self.status[stage.name] = 'up to date'
+                        self.log(stage.name, 'up to date, skipping')
+                    pending.remove(stage)
+                    done.add(stage.name)
+                if len(to_run) < len(ready):
+                    continue
+
+                free = min(budget.available(), max(1, threads) - sum(n for _, n in running.values()))
+                shares = self.thread_shares(to_run, free)
+                for stage in to_run:
+                    if stage.name not in shares or not budget.try_acquire(shares[stage.name], stage.memory):
+                        continue
+                    ## remove the old marker first so a crash part way through leaves the stage incomplete
+                    if os.path.exists(self.marker_loc(stage.name)):
+                        os.remove(self.marker_loc(stage.name))
+                    n_threads = shares[stage.name]
+                    self.log(stage.name, f'running with {n_threads} thread(s)')
+                    profile_loc = os.path.join(self.state_dir, 'profiles', f'{stage.name}.prof') if self.profile else None
+                    future = pool.submit(measure_stage, stage.name, stage.func, n_threads, threads=n_threads, profile_loc=profile_loc)
+                    running[future] = (stage, n_threads)
+                    pending.remove(stage)
+
+                if not running:
+                    if not to_run:
+                        break
+                    ## everything is held by other pipelines sharing the budget
+                    budget.wait(timeout=5)
+                    continue
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage, n_threads = running.pop(future)
+                    budget.release(n_threads, stage.memory)
+                    try:
+                        _, metrics = future.result()
+                    except (Exception, SystemExit) as e:
+                        self.status[stage.name] = 'failed'
+                        self.log(stage.name, f'failed: {e}')
+                        if failure is None:
+                            failure = e
+                        continue
+                    self.keys[stage.name] = stage_keys[stage.name]
+                    self.metrics[stage.name] = metrics
+                    self.status[stage.name] = 'ran'
+                    self.write_marker(stage, stage_keys[stage.name], metrics)
+                    done.add(stage.name)
+                    self.log(stage.name, f'done in {metrics.wall_time:.1f}s (cpu {metrics.cpu_time:.1f}s, tools {metrics.child_cpu_time:.1f}s)')
+
+        self.write_report()
+        if failure is not None:
+            raise failure
+        self.print_timings()
+
+    def report(self):
+        """One dict per stage that was considered in the last run: its status and metrics (for stages that
+        were up to date, the metrics recorded when they last ran)"""
+        rows = []
+        for name, status in self.status.items():
+            if name in self.metrics:
+                metrics = self.metrics[name].as_dict()
+            else:
+                marker = self.read_marker(name)
+                metrics = marker.get('metrics', {}) if marker is not None else {}
+            rows.append(dict({field: metrics.get(field, '') for field in METRIC_FIELDS}, stage=name, status=status))
+        return rows
+
+    def write_report(self):
+        """Writes the run report to run_report.json and run_report.tsv in the working directory"""
+        rows = self.report()
+        with open(os.path.join(self.working, 'run_report.json'), 'w') as f:
+            json.dump({'completed': datetime.datetime.now().isoformat(), 'stages': rows}, f, indent=1)
+        columns = ['stage', 'status'] + METRIC_FIELDS[1:]
+        with open(os.path.join(self.working, 'run_report.tsv'), 'w') as f:
+            f.write('\t'.join(columns) + '\n')
+            for row in rows:
+                f.write('\t'.join(str(row[c]) for c in columns) + '\n')
+
+    def print_timings(self):
+        if not self.metrics:
+            return
+        print('stage\tthreads\twall_s\tcpu_s\ttool_cpu_s\tpeak_rss_mb\ttool_peak_rss_mb')
+        for m in self.metrics.values():
+            print('%s\t%d\t%.1f\t%.1f\t%.1f\t%.0f\t%.0f' % (m.name, m.threads, m.wall_time, m.cpu_time, m.child_cpu_time,
+                                                        m.peak_rss_mb, m.child_peak_rss_mb))
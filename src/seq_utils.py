@@ -0,0 +1,159 @@
+"""
+Lightweight streaming FASTA/FASTQ helpers used across the pipeline
+"""
+import functools
+import math
+import os
+import random
+import shutil
+import tempfile
+import uuid
+
+from src.io_utils import is_compressed, open_file
+
+def iter_fastx(filename:str, threads:int=1):
+    """Streams (name, sequence, quality) records from a FASTA or FASTQ file (optionally compressed, see
+    io_utils.open_file for threads). The name is the header up to the first whitespace and quality is None
+    for FASTA records."""
+    with open_file(filename, 'rt', threads=threads) as f:
+        first = f.readline()
+        if not first:
+            return
+        if first.startswith('@'):
+            line = first
+            while line:
+                name = line[1:].split(None, 1)[0] if line[1:].strip() else ''
+                seq = f.readline().rstrip('\n\r')
+                f.readline()
+                qual = f.readline().rstrip('\n\r')
+                yield name, seq, qual
+                line = f.readline()
+        else:
+            name = first[1:].split(None, 1)[0] if first[1:].strip() else ''
+            seq = []
+            for line in f:
+                if line.startswith('>'):
+                    yield name, ''.join(seq), None
+                    name = line[1:].split(None, 1)[0] if line[1:].strip() else ''
+                    seq = []
+                else:
+                    seq.append(line.rstrip('\n\r'))
+            yield name, ''.join(seq), None
+
+def format_record(name:str, seq:str, qual:str=None):
+    """Formats a record as FASTQ if it has qualities, otherwise as FASTA"""
+    if qual is not None:
+        return f'@{name}\n{seq}\n+\n{qual}\n'
+    return f'>{name}\n{seq}\n'
+
+def _iter_renamed(read_files, rename=None):
+    for f in read_files:
+        renamer = rename(f) if rename is not None else None
+        for name, seq, qual in iter_fastx(f):
+            yield (renamer(name) if renamer is not None else name), seq, qual
+
+def merge_shuffle_reads(read_files, out_loc:str, seed:int=None, buffer_bytes:int=512 * 1024 * 1024, tmp_dir:str=None,
+                        compression:str=None, threads:int=1, rename=None):
+    """Streams all records from read_files into one file at out_loc in a uniformly random order, using
+    bounded memory. out_loc is compressed with `compression` (default: from its extension, see
+    io_utils.open_file) using up to `threads` compression threads.
+    
+    Records are first scattered at random over enough temporary bucket files that each fits in
+    buffer_bytes, then each bucket is loaded, shuffled in memory and appended to the output. The same
+    seed and inputs always give the same output order. rename, if given, is called with each read file and
+    returns a function applied to the names of its reads (or None to keep them), so reads can be renamed in
+    the same pass. Returns the number of records written."""
+    rng = random.Random(seed)
+    read_files = [str(f) for f in read_files]
+    
+    ## compressed inputs expand roughly 4x once decompressed
+    total_bytes = sum(os.path.getsize(f) * (4 if is_compressed(f) else 1) for f in read_files)
+    n_buckets = max(1, math.ceil(total_bytes / buffer_bytes))
+    
+    n_records = 0
+    if n_buckets == 1:
+        records = [format_record(*rec) for rec in _iter_renamed(read_files, rename)]
+        rng.shuffle(records)
+        with open_file(out_loc, 'wt', threads=threads, compression=compression) as out:
+            out.writelines(records)
+        return len(records)
+    
+    tmp_dir = tempfile.mkdtemp(prefix='.shuffle_', dir=tmp_dir if tmp_dir is not None else os.path.dirname(os.path.abspath(out_loc)))
+    try:
+        bucket_locs = [os.path.join(tmp_dir, f'bucket{i}.txt') for i in range(n_buckets)]
+        buckets = [open(loc, 'w') for loc in bucket_locs]
+        try:
+            for rec in _iter_renamed(read_files, rename):
+                buckets[rng.randrange(n_buckets)].write(format_record(*rec))
+        finally:
+            for bucket in buckets:
+                bucket.close()
+        
+        with open_file(out_loc, 'wt', threads=threads, compression=compression) as out:
+            for loc in bucket_locs:
+                records = [format_record(*rec) for rec in iter_fastx(loc)] if os.path.getsize(loc) > 0 else []
+                rng.shuffle(records)
+                out.writelines(records)
+                n_records += len(records)
+                os.remove(loc)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return n_records
+
+def build_fasta_index(fasta:str, fai_loc:str=None):
+    """Writes a samtools faidx compatible index (name, length, offset, line bases, line width) of a
+    FASTA file to fai_loc (default fasta + '.fai') and returns its records. As with samtools, offsets of a
+    compressed FASTA are into its decompressed contents"""
+    fai_loc = fai_loc if fai_loc is not None else fasta + '.fai'
+    records = []
+    name, length, offset, line_bases, line_width = None, 0, 0, 0, 0
+    position = 0
+    with open_file(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    records.append((name, length, offset, line_bases, line_width))
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ''
+                length, offset, line_bases, line_width = 0, position + len(line), 0, 0
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if line_bases == 0:
+                    line_bases, line_width = bases, len(line)
+                length += bases
+            position += len(line)
+    if name is not None:
+        records.append((name, length, offset, line_bases, line_width))
+    
+    ## a temporary name of its own, as several samples (or stages) may index the same genome at once
+    tmp_loc = f'{fai_loc}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_loc, 'w') as out:
+            for record in records:
+                out.write('\t'.join(str(r) for r in record) + '\n')
+        os.replace(tmp_loc, fai_loc)
+    finally:
+        if os.path.exists(tmp_loc):
+            os.remove(tmp_loc)
+    return records
+
+@functools.lru_cache(maxsize=4096)
+def _read_fasta_index(fai_loc:str, mtime_ns:int, size:int):
+    records = []
+    with open(fai_loc, 'r') as f:
+        for line in f:
+            name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+            records.append((name, int(length), int(offset), int(line_bases), int(line_width)))
+    return tuple(records)
+
+def read_fasta_index(fai_loc:str):
+    """Reads the records of a .fai index. They are kept in memory while the index file is unchanged, so a
+    long running process (mimic.py serve) does not reread the indexes of the same genomes for every job"""
+    stat = os.stat(fai_loc)
+    return list(_read_fasta_index(os.path.abspath(fai_loc), stat.st_mtime_ns, stat.st_size))
+
+def fasta_index(fasta:str):
+    """Records of the .fai index next to fasta, building it first if it is missing or older than the FASTA"""
+    fai_loc = fasta + '.fai'
+    if os.path.exists(fai_loc) and os.path.getmtime(fai_loc) >= os.path.getmtime(fasta):
+        return read_fasta_index(fai_loc)
+    return build_fasta_index(fasta, fai_loc)
@@ -0,0 +1,201 @@
+"""
+Long running local MIMIC service (mimic.py serve). Jobs, given as the usual mimic.py command line arguments,
+are posted as JSON to a small HTTP server on localhost, wait in a bounded queue and are run by a few worker
+threads that share one thread/memory budget. Python, pandas and numpy are imported once, and the taxonomy,
+.fai indexes and NanoSim version stay loaded between jobs.
+"""
+import argparse
+import collections
+import http.server
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import uuid
+
+from src.pipeline import ResourceBudget
+
+DEFAULT_PORT = 8765
+JOB_STATES = ['queued', 'running', 'done', 'failed']
+
+class JobArgumentError(ValueError):
+    pass
+
+class JobArgumentParser(argparse.ArgumentParser):
+    """ArgumentParser that raises instead of exiting, so a job with bad arguments is rejected without
+    stopping the server"""
+
+    def error(self, message):
+        raise JobArgumentError(f'{self.prog}: {message}')
+
+    def exit(self, status=0, message=None):
+        raise JobArgumentError(message.strip() if message else f'{self.prog}: exited with status {status}')
+
+class Job():
+    """One submitted job: its arguments, state, timings and, once it has run, its results"""
+
+    def __init__(self, kind:str, argv:list, args):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.argv = argv
+        self.args = args
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.outputs = {}
+        self.stages = []
+        self.error = ''
+        self.done = threading.Event()
+
+    @property
+    def output(self):
+        return os.path.abspath(str(self.args.output))
+
+    def as_dict(self):
+        now = time.time()
+        started = self.started if self.started is not None else now
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'args': self.argv, 'output': self.output,
+                'submitted': self.submitted, 'queue_time': round(started - self.submitted, 3),
+                'run_time': round((self.finished or now) - self.started, 3) if self.started is not None else None,
+                'outputs': self.outputs, 'stages': self.stages, 'error': self.error}
+
+class JobServer():
+    """Bounded queue of jobs run by `workers` threads under one ResourceBudget. runners maps a job kind to
+    (parse, run): parse(argv) returns the parsed arguments or raises JobArgumentError, run(args, budget, job_id)
+    runs the job and returns (pipeline, {result name: location})"""
+
+    def __init__(self, runners:dict, budget:ResourceBudget, workers:int=1, queue_size:int=16, max_history:int=1000):
+        self.runners = runners
+        self.budget = budget
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_history = max_history
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, name=f'mimic-worker-{i}', daemon=True) for i in range(max(1, workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, kind:str, argv:list):
+        """Parses and queues a job. Raises JobArgumentError for bad arguments, FileExistsError when another
+        unfinished job writes to the same output directory and queue.Full when the queue is full"""
+        if kind not in self.runners:
+            raise JobArgumentError(f'unknown job kind {kind!r}, one of {", ".join(self.runners)}')
+        if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+            raise JobArgumentError('args must be a list of strings')
+        parse, _ = self.runners[kind]
+        job = Job(kind, argv, parse(argv))
+        with self.lock:
+            ## two jobs writing to one output directory at once would corrupt each other
+            for other in self.jobs.values():
+                if other.status in ('queued', 'running') and other.output == job.output:
+                    raise FileExistsError(f'job {other.id} is already {other.status} with output {job.output}')
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+        print(f'[serve] queued {kind} job {job.id} ({job.output})')
+        return job
+
+    def get(self, job_id:str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def summary(self):
+        with self.lock:
+            counts = collections.Counter(job.status for job in self.jobs.values())
+        return dict({state: counts.get(state, 0) for state in JOB_STATES}, workers=len(self.workers),
+                    queue_size=self.queue.maxsize, threads=self.budget.threads)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.status, job.started = 'running', time.time()
+            print(f'[serve] running {job.kind} job {job.id}')
+            _, run = self.runners[job.kind]
+            try:
+                pipeline, job.outputs = run(job.args, self.budget, job.id)
+                job.stages = pipeline.report()
+                job.status = 'done'
+            except (Exception, SystemExit) as e:
+                job.error = str(e) or type(e).__name__
+                job.status = 'failed'
+            job.finished = time.time()
+            job.done.set()
+            print(f'[serve] {job.kind} job {job.id} {job.status} in {job.finished - job.started:.1f}s' + (f': {job.error}' if job.error else ''))
+            self._forget_old_jobs()
+
+    def _forget_old_jobs(self):
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+            for job_id in finished[:max(0, len(finished) - self.max_history)]:
+                del self.jobs[job_id]
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    """JSON API of the job server:
+        GET  /health                 queue and worker counts
+        GET  /jobs                   every known job
+        POST /jobs                   {"kind": "simulate" | "evaluate", "args": [...]}, answers 202 with the job
+        GET  /jobs/<id>[?wait=S]     the job, after waiting up to S seconds for it to finish"""
+
+    def send_json(self, code:int, body):
+        data = json.dumps(body, indent=1).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        jobs = self.server.jobs
+        if parts == ['health']:
+            return self.send_json(200, dict(status='ok', **jobs.summary()))
+        if parts == ['jobs']:
+            with jobs.lock:
+                listed = list(jobs.jobs.values())
+            return self.send_json(200, [job.as_dict() for job in listed])
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = jobs.get(parts[1])
+            if job is None:
+                return self.send_json(404, {'error': f'no job {parts[1]}'})
+            wait = urllib.parse.parse_qs(url.query).get('wait')
+            if wait:
+                try:
+                    job.done.wait(float(wait[0]))
+                except ValueError:
+                    return self.send_json(400, {'error': 'wait must be a number of seconds'})
+            return self.send_json(200, job.as_dict())
+        self.send_json(404, {'error': f'unknown path {url.path}'})
+
+    def do_POST(self):
+        if [p for p in urllib.parse.urlparse(self.path).path.split('/') if p] != ['jobs']:
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = self.server.jobs.submit(body.get('kind', 'simulate'), body.get('args', []))
+        except (ValueError, AttributeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        except FileExistsError as e:
+            return self.send_json(409, {'error': str(e)})
+        except queue.Full:
+            return self.send_json(503, {'error': f'job queue is full ({self.server.jobs.queue.maxsize} jobs), retry later'})
+        self.send_json(202, job.as_dict())
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(jobs:JobServer, port:int=DEFAULT_PORT):
+    """Serves the job API on localhost only (jobs run arbitrary pipelines on this machine) until interrupted"""
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), JobRequestHandler)
+    httpd.daemon_threads = True
+    httpd.jobs = jobs
+    print(f'[serve] listening on http://127.0.0.1:{httpd.server_address[1]} with {len(jobs.workers)} worker(s), '
+          f'{jobs.budget.threads} thread(s) and room for {jobs.queue.maxsize} queued job(s)')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('[serve] stopping')
+    finally:
+        httpd.server_close()
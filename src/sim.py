@@ -1,72 +1,448 @@
+import concurrent.futures
+import glob
+import heapq
+import math
+import mmap
 import os
+import random
+import re
+import shutil
 import pandas as pd
 import numpy as np
-import subprocess
+
+from src.io_utils import is_compressed, open_file
+from src.seq_utils import fasta_index, format_record, iter_fastx
+from src.instrumentation import in_current_stage, run_command
 
 def run_read_analysis(fastq:str, genome_list:str, out_loc:str, threads:int=1):
     
-    subprocess.run(['read_analysis.py',
-                    'metagenome',
-                    '-i', fastq,
-                    '-gl', genome_list,
-                    '-o', out_loc + '/training/training',
-                    '-t', str(threads)], check=True)
-    
-def run_sim(genome_list:str, abundance_list:str, species_list:str, out_loc:str, perfect:bool=False, threads:int=1):
+    run_command(['read_analysis.py',
+                 'metagenome',
+                 '-i', fastq,
+                 '-gl', genome_list,
+                 '-o', out_loc + '/training/training',
+                 '-t', str(threads)])
+
+def subsample_training_reads(fastq:str, out_loc:str, max_reads:int=None, max_bases:int=None, seed:int=0, length_counts:dict=None):
+    """Writes a random subset of fastq to out_loc, bounded by max_reads and/or max_bases.
+
+    Reads are stratified by length (powers of two) so the subset keeps the length distribution of the
+    input, which is what NanoSim's length model is fit to: every stratum contributes in proportion to its
+    share of the input reads (or bases). The strata sizes come from length_counts, the read length
+    histogram of fastq ({length: reads}, e.g. FastqStats.length_counts), or from a first pass that only
+    counts lengths. Each stratum is then a reservoir of the reads with the smallest random keys, holding no
+    more than its share of the caps, so memory is bounded by the caps, not by the input or the number of strata.
+    Returns (reads written, bases written)."""
+    if length_counts is None:
+        length_counts = {}
+        for _, seq, _ in iter_fastx(fastq):
+            length_counts[len(seq)] = length_counts.get(len(seq), 0) + 1
+    total_reads, total_bases = {}, {}
+    for length, count in length_counts.items():
+        stratum = int(length).bit_length()
+        total_reads[stratum] = total_reads.get(stratum, 0) + count
+        total_bases[stratum] = total_bases.get(stratum, 0) + int(length) * count
+    n_reads, n_bases = sum(total_reads.values()), sum(total_bases.values())
+    read_targets = {stratum: max_reads * total_reads[stratum] / n_reads if max_reads is not None else math.inf for stratum in total_reads}
+    base_targets = {stratum: max_bases * total_bases[stratum] / max(n_bases, 1) if max_bases is not None else math.inf for stratum in total_bases}
+    ## the selection below keeps a read while kept_reads + 0.5 <= read_target, so this many at most
+    read_quotas = {stratum: math.floor(target + 0.5) if target != math.inf else math.inf for stratum, target in read_targets.items()}
+
+    rng = random.Random(seed)
+    reservoirs = {} ## stratum -> max-heap of (-key, index, record)
+    stratum_bases = {}
+    for index, (name, seq, qual) in enumerate(iter_fastx(fastq)):
+        stratum = len(seq).bit_length()
+        key = rng.random()
+        heap = reservoirs.setdefault(stratum, [])
+        heapq.heappush(heap, (-key, index, (name, seq, qual)))
+        stratum_bases[stratum] = stratum_bases.get(stratum, 0) + len(seq)
+
+        ## drop the largest key while the stratum holds more than its share of either cap could need
+        read_quota, base_target = read_quotas.get(stratum, 0), base_targets.get(stratum, 0)
+        while heap and (len(heap) > read_quota or stratum_bases[stratum] - len(heap[0][2][1]) >= base_target):
+            stratum_bases[stratum] -= len(heapq.heappop(heap)[2][1])
+
+    selected = []
+    for stratum, heap in reservoirs.items():
+        read_target, base_target = read_targets.get(stratum, 0), base_targets.get(stratum, 0)
+        kept_reads, kept_bases = 0, 0
+        for _, index, record in sorted(heap, reverse=True):
+            if kept_reads + 0.5 > read_target or kept_bases + len(record[1]) / 2 > base_target:
+                break
+            selected.append((index, record))
+            kept_reads += 1
+            kept_bases += len(record[1])
+
+    ## keep the input order
+    selected.sort(key=lambda s: s[0])
+    with open_file(out_loc, 'wt') as f:
+        for _, record in selected:
+            f.write(format_record(*record))
+    return len(selected), sum(len(record[1]) for _, record in selected)
+
+def run_sim(genome_list:str, abundance_list:str, species_list:str, out_loc:str, perfect:bool=False, threads:int=1,
+            seed:int=None, out_prefix:str=None, model_prefix:str=None):
     
+    out_prefix = out_prefix if out_prefix is not None else out_loc + '/simulated'
+    model_prefix = model_prefix if model_prefix is not None else out_loc + '/training/training'
+    cmd = ['simulator.py', 'metagenome',
+           '-gl', genome_list,
+           '-a', abundance_list,
+           '-dl', species_list,
+           '-c', model_prefix,
+           '-o', out_prefix]
     if perfect:
-        subprocess.run(['simulator.py', 'metagenome',
-                        '-gl', genome_list,
-                        '-a', abundance_list,
-                        '-dl', species_list,
-                        '-c', out_loc + '/training/training',
-                        '-o', out_loc + '/simulated',
-                        '--perfect',
-                        '-t', str(threads)], check=True)
-    else:
-        subprocess.run(['simulator.py', 'metagenome',
-                        '-gl', genome_list,
-                        '-a', abundance_list,
-                        '-dl', species_list,
-                        '-c', out_loc + '/training/training',
-                        '-o', out_loc + '/simulated',
-                        '-t', str(threads)], check=True)
-
-def get_lemur_abundance(taxid, lemur_data):
-    try:
-        out = lemur_data[lemur_data['Target_ID'] == taxid]
-        if not out.empty:
-            return out['F'].values[0]
+        cmd.append('--perfect')
+    if seed is not None:
+        cmd += ['--seed', str(seed)]
+    cmd += ['-t', str(threads)]
+    run_command(cmd)
+
+def read_length_distribution(fastq:str, cache_loc:str=None, max_reads:int=1000000, seed:int=0):
+    """Empirical read lengths of fastq as an int array: every length, or a uniform reservoir sample of
+    max_reads of them for larger inputs. Saved to cache_loc (.npy) and reused while it is newer than fastq"""
+    if cache_loc is not None and os.path.exists(cache_loc) and os.path.getmtime(cache_loc) >= os.path.getmtime(fastq):
+        return np.load(cache_loc)
+
+    rng = random.Random(seed)
+    lengths = np.zeros(max_reads, dtype=np.int64)
+    n = 0
+    for _, seq, _ in iter_fastx(fastq):
+        if n < max_reads:
+            lengths[n] = len(seq)
         else:
-            return 0
-    except KeyError:
+            j = rng.randrange(n + 1)
+            if j < max_reads:
+                lengths[j] = len(seq)
+        n += 1
+    lengths = lengths[:min(n, max_reads)]
+    lengths = lengths[lengths > 0]
+    if cache_loc is not None:
+        np.save(cache_loc, lengths)
+    return lengths
+
+_COMPLEMENT = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+
+class MappedGenome():
+    """A reference FASTA memory-mapped and addressed through its .fai index, so any substring of any contig
+    can be cut out without loading the genome. A compressed reference is decompressed into memory instead"""
+
+    def __init__(self, fasta:str):
+        self.index = fasta_index(fasta)
+        if is_compressed(fasta):
+            self._file = None
+            with open_file(fasta, 'rb') as f:
+                self._map = f.read()
+        else:
+            self._file = open(fasta, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def fetch(self, contig:int, start:int, end:int):
+        """Bases [start, end) of the contig-th contig as bytes"""
+        _, _, offset, line_bases, line_width = self.index[contig]
+        begin = offset + (start // line_bases) * line_width + start % line_bases
+        stop = offset + (end // line_bases) * line_width + end % line_bases
+        chunk = self._map[begin:stop]
+        return chunk.replace(b'\n', b'').replace(b'\r', b'') if line_width != line_bases else chunk
+
+    def close(self):
+        if self._file is not None:
+            self._map.close()
+            self._file.close()
+
+def simulate_perfect_reads(read_plan:str, species_list:str, out_loc:str, read_lengths,
+                           seed:int=None, batch_size:int=100000, length_counts=None):
+    """In-process replacement for `simulator.py metagenome --perfect`: writes error-free reads to
+    out_loc/simulated_sample0_aligned_reads.fasta with NanoSim-style names, so the merge and truth table
+    steps treat them like NanoSim output. Returns the number of reads written.
+
+    Every genome gets exactly its number of reads in read_plan (see plan_read_counts), in random order; lengths are drawn from
+    read_lengths (the empirical lengths of the input reads, or the distinct lengths with their number of
+    reads in length_counts, as in a length histogram), the contig and start position are uniform
+    over the genome and the strand is random. Circular contigs (from species_list) wrap around, reads on
+    linear contigs are clipped to the contig. Reads are drawn in vectorized batches and streamed out."""
+    rng = np.random.default_rng(seed)
+    read_lengths = np.asarray(read_lengths, dtype=np.int64)
+    if len(read_lengths) == 0:
+        raise ValueError('No read lengths to draw from')
+    length_p = np.asarray(length_counts, dtype=np.float64) / np.sum(length_counts) if length_counts is not None else None
+
+    plan = read_read_plan(read_plan)
+    circular = set()
+    with open(species_list, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 3 and fields[2] == 'circular':
+                circular.add((fields[0], fields[1]))
+
+    ## one flat table of every contig: owning genome, start in the concatenated genome, length, circularity
+    mapped, genome_reads = [], []
+    contig_genome, contig_start, contig_length, contig_circular = [], [], [], []
+    genome_start, genome_size = [], []
+    for species, fasta, reads in zip(plan['species'], plan['genome'], plan['reads']):
+        if reads <= 0 or not os.path.exists(fasta) or os.path.getsize(fasta) == 0:
+            continue
+        genome = MappedGenome(fasta)
+        total = sum(record[1] for record in genome.index)
+        if total == 0:
+            genome.close()
+            continue
+        g = len(mapped)
+        position = contig_start[-1] + contig_length[-1] if contig_start else 0
+        genome_start.append(position)
+        for name, length, *_ in genome.index:
+            contig_genome.append(g)
+            contig_start.append(position)
+            contig_length.append(length)
+            contig_circular.append((species, name) in circular)
+            position += length
+        genome_size.append(total)
+        mapped.append((species, genome))
+        genome_reads.append(reads)
+
+    out_file = os.path.join(out_loc, 'simulated_sample0_aligned_reads.fasta')
+    if not mapped:
+        open(out_file, 'w').close()
         return 0
+    ## the genome of every read, in random order
+    read_genomes = rng.permutation(np.repeat(np.arange(len(mapped)), genome_reads))
+    num_reads = len(read_genomes)
+    genome_start, genome_size = np.asarray(genome_start), np.asarray(genome_size)
+    contig_start, contig_length = np.asarray(contig_start), np.asarray(contig_length)
+    contig_local = [0] * len(contig_genome)
+    for i in range(1, len(contig_genome)):
+        contig_local[i] = contig_local[i - 1] + 1 if contig_genome[i] == contig_genome[i - 1] else 0
+
+    written = 0
+    with open(out_file, 'wb') as out:
+        while written < num_reads:
+            n = min(batch_size, num_reads - written)
+            g = read_genomes[written:written + n]
+            lengths = rng.choice(read_lengths, size=n, p=length_p)
+            ## a uniform position over the whole genome picks the contig in proportion to its length
+            flat = genome_start[g] + (rng.random(n) * genome_size[g]).astype(np.int64)
+            contig = np.searchsorted(contig_start, flat, side='right') - 1
+            starts = flat - contig_start[contig]
+            reverse = rng.random(n) < 0.5
+
+            records = []
+            for i in range(n):
+                c = contig[i]
+                species, genome = mapped[g[i]]
+                clen, start, length = contig_length[c], starts[i], lengths[i]
+                if contig_circular[c]:
+                    length = min(length, clen)
+                    end = start + length
+                    seq = genome.fetch(contig_local[c], start, min(end, clen))
+                    if end > clen:
+                        seq += genome.fetch(contig_local[c], 0, end - clen)
+                else:
+                    length = min(length, clen)
+                    start = min(start, clen - length)
+                    seq = genome.fetch(contig_local[c], start, start + length)
+                strand = 'R' if reverse[i] else 'F'
+                if reverse[i]:
+                    seq = seq.translate(_COMPLEMENT)[::-1]
+                name = f'{species.replace(" ", "_")}-{genome.index[contig_local[c]][0]}_{start}_aligned_{written + i}_{strand}_0_{length}_0'
+                records.append(b'>' + name.encode() + b'\n' + seq + b'\n')
+            out.writelines(records)
+            written += n
+
+    for _, genome in mapped:
+        genome.close()
+    return written
+
+def split_read_count(num_reads:int, n_shards:int, offset:int=0):
+    """Splits num_reads into n_shards near-equal integer counts that sum to num_reads. The extra reads go
+    to the shards from `offset` on (wrapping around)"""
+    base, extra = divmod(num_reads, n_shards)
+    return [base + (1 if (i - offset) % n_shards < extra else 0) for i in range(n_shards)]
+
+def split_read_counts(read_counts, n_shards:int):
+    """Splits every count of read_counts over n_shards, the extra reads of each count continuing where the
+    previous count's stopped, so every count and every shard total stays within one read of even.
+    Returns a (len(read_counts), n_shards) array"""
+    shards, offset = [], 0
+    for count in read_counts:
+        shards.append(split_read_count(int(count), n_shards, offset))
+        offset = (offset + int(count) % n_shards) % n_shards
+    return np.asarray(shards, dtype=np.int64).reshape(len(shards), n_shards)
+
+def largest_remainder(weights, total:int):
+    """Integer counts proportional to weights that sum to total: every share is rounded down and the
+    counts left over go to the largest remainders (ties to the earlier entry). Non-positive weights get 0"""
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = np.where(np.isfinite(weights) & (weights > 0), weights, 0)
+    if total <= 0 or weights.sum() == 0:
+        return np.zeros(len(weights), dtype=np.int64)
+    quotas = weights / weights.sum() * total
+    counts = np.floor(quotas).astype(np.int64)
+    order = np.argsort(-(quotas - counts), kind='stable')
+    counts[order[:total - counts.sum()]] += 1
+    return counts
+
+READ_PLAN_COLUMNS = ['species', 'genome', 'abundance', 'genome_size', 'reads']
+
+def plan_read_counts(genome_list:pd.DataFrame, num_reads:int, length_weighted:bool=False, genome_sizes:pd.Series=None):
+    """Turns the abundances of a genome list (see prep_sim_lemur) into an exact number of reads per genome,
+    summing to num_reads, by largest remainder rounding, so even very rare genomes keep their share of a
+    deep simulation. With length_weighted the abundances are taken as cell abundances and a genome's reads
+    also scale with its length. Genomes without a FASTA (size 0) get no reads. genome_sizes defaults to
+    get_genome_sizes (from the .fai indexes)."""
+    sizes = genome_sizes if genome_sizes is not None else get_genome_sizes(genome_list)
+    abundance = pd.to_numeric(genome_list['Abundance'], errors='coerce').fillna(0)
+    weights = abundance * sizes if length_weighted else abundance.where(sizes > 0, 0)
+    return pd.DataFrame({'species': genome_list['Organism of Assembly'].to_numpy(),
+                         'genome': genome_list['Assembly Accession ID'].to_numpy(),
+                         'abundance': abundance.to_numpy(),
+                         'genome_size': sizes.to_numpy(np.int64),
+                         'reads': largest_remainder(weights.to_numpy(), num_reads)}, columns=READ_PLAN_COLUMNS)
+
+def write_read_plan(plan:pd.DataFrame, out_loc:str):
+    plan.to_csv(out_loc, sep='\t', index=False)
+    return out_loc
+
+def read_read_plan(plan_loc:str):
+    return pd.read_csv(plan_loc, sep='\t', dtype={'species': str, 'genome': str})
+
+def write_nanosim_abundances(species, read_counts, out_loc:str):
+    """Writes a NanoSim metagenome abundance file (total reads, then the percentage of every species) for
+    the given read counts. Percentages are written at full precision rather than rounded, so rare species
+    are not lost"""
+    read_counts = np.asarray(read_counts, dtype=np.int64)
+    total = int(read_counts.sum())
+    with open(out_loc, 'w') as f:
+        f.write(f'Size\t{total}\n')
+        for name, count in zip(species, read_counts):
+            if count > 0:
+                f.write(f'{name}\t{100 * count / total:.12g}\n')
+    return out_loc
+
+def tag_nanosim_read_name(read_id:str, tag:str):
+    """Makes a NanoSim read name unique across shards by prefixing its read index with the shard tag,
+    e.g. ..._aligned_17_F_0_1000_0 -> ..._aligned_3.17_F_0_1000_0, so parse_nanosim_read_name still works"""
+    segments = read_id.split(';')
+    head, _, rest = segments[0].partition('-')
+    parts = rest.rsplit('_', 6)
+    if len(parts) == 7 and parts[1] in ('aligned', 'unaligned'):
+        parts[2] = f'{tag}.{parts[2]}'
+        segments[0] = head + '-' + '_'.join(parts)
+        return ';'.join(segments)
+    return f'{read_id}.{tag}'
+
+def shard_read_renamer(read_file:str):
+    """For merge_shuffle_reads: the function making the read names of a shard's read file
+    (simulated_sample*_shard<i>_*) unique across shards, None for the read files of an unsharded run"""
+    match = re.match(r'simulated_sample\d+_shard(\d+)_', os.path.basename(str(read_file)))
+    if match is None:
+        return None
+    tag = match.group(1)
+    return lambda read_id: tag_nanosim_read_name(read_id, tag)
+
+def run_sim_sharded(genome_list:str, abundance_list:str, species_list:str, out_loc:str, perfect:bool=False, threads:int=1,
+                    n_shards:int=1, seed:int=None, read_plan:str=None):
+    """Splits the requested read count into n_shards independent NanoSim runs with their own seeds, runs them
+    concurrently (threads are divided between them) and moves their outputs to out_loc as simulated_sample*_shard<i>
+    files; merge them with rename=shard_read_renamer to make the read names unique across shards. With a read_plan
+    (see plan_read_counts) the reads of every genome are split over the shards, otherwise the total of
+    abundance_list is. n_shards=1 is a plain run_sim call."""
+    if n_shards <= 1:
+        run_sim(genome_list, abundance_list, species_list, out_loc, perfect=perfect, threads=threads, seed=seed)
+        return
+    
+    with open(abundance_list, 'r') as f:
+        size_line, *species_lines = f.read().splitlines()
+    num_reads = int(size_line.split('\t')[1])
+    rng = random.Random(seed)
+    shard_seeds = [rng.randrange(1, 2**31) for _ in range(n_shards)]
+    if read_plan is not None:
+        plan = read_read_plan(read_plan)
+        shard_counts = split_read_counts(plan['reads'], n_shards)
+    
+    shard_dirs = []
+    for i, shard_reads in enumerate(split_read_count(num_reads, n_shards)):
+        if read_plan is not None:
+            shard_reads = int(shard_counts[:, i].sum())
+        if shard_reads == 0:
+            continue
+        shard_dir = os.path.join(out_loc, 'shards', f'shard{i}')
+        os.makedirs(shard_dir, exist_ok=True)
+        if read_plan is not None:
+            write_nanosim_abundances(plan['species'], shard_counts[:, i], os.path.join(shard_dir, 'abundances.tsv'))
+        else:
+            with open(os.path.join(shard_dir, 'abundances.tsv'), 'w') as f:
+                f.write('\n'.join([f'Size\t{shard_reads}'] + species_lines) + '\n')
+        shard_dirs.append((i, shard_dir))
+    
+    shard_threads = max(1, threads // len(shard_dirs))
+    def simulate_shard(shard):
+        i, shard_dir = shard
+        run_sim(genome_list, os.path.join(shard_dir, 'abundances.tsv'), species_list, out_loc, perfect=perfect,
+                threads=shard_threads, seed=shard_seeds[i], out_prefix=os.path.join(shard_dir, 'simulated'))
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(shard_dirs), max(1, threads))) as pool:
+        list(pool.map(in_current_stage(simulate_shard), shard_dirs))
+    
+    ## collect: files are only moved and renamed by shard, the reads themselves get their shard-tagged names
+    ## in the merge (see shard_read_renamer), which parses every read anyway
+    for i, shard_dir in shard_dirs:
+        for shard_file in sorted(glob.glob(os.path.join(shard_dir, 'simulated_sample*'))):
+            name = re.sub(r'^simulated_sample(\d+)', rf'simulated_sample\1_shard{i}', os.path.basename(shard_file))
+            shutil.move(shard_file, os.path.join(out_loc, name))
+    shutil.rmtree(os.path.join(out_loc, 'shards'), ignore_errors=True)
 
-def prep_sim_lemur(metadata_loc, lemur_data_loc, out, working, number_reads_generated):
+def lookup_abundances(taxids:pd.Series, abundance_table:pd.DataFrame, taxid_col:str, abundance_col:str):
+    """Looks up the abundance of every taxid in `taxids` from `abundance_table` with a single indexed join
+    instead of scanning the table once per taxid.
+    
+    Duplicate taxids in the table keep their first row (the same row a boolean-mask lookup would have picked),
+    and taxids that are missing from the table, or whose abundance is missing, get 0."""
+    table = abundance_table[[taxid_col, abundance_col]].copy()
+    table[taxid_col] = pd.to_numeric(table[taxid_col], errors='coerce')
+    table = table.dropna(subset=[taxid_col]).drop_duplicates(subset=taxid_col, keep='first')
+    lookup = pd.Series(pd.to_numeric(table[abundance_col], errors='coerce').to_numpy(),
+                       index=table[taxid_col].astype(np.int64).to_numpy())
     
+    keys = pd.to_numeric(taxids, errors='coerce')
+    abundances = pd.Series(np.nan, index=taxids.index, dtype=float)
+    found = keys.notna()
+    abundances[found] = lookup.reindex(keys[found].astype(np.int64).to_numpy()).to_numpy()
+    return abundances.fillna(0)
+
+REFERENCE_SUFFIXES = ['.fasta', '.fasta.gz', '.fasta.zst']
+
+def reference_genome_loc(genome_folder:str, accession:str):
+    """Location of the reference genome of accession in genome_folder, which may be stored compressed"""
+    for suffix in REFERENCE_SUFFIXES:
+        loc = os.path.join(genome_folder, accession + suffix)
+        if os.path.exists(loc):
+            return loc
+    return os.path.join(genome_folder, accession + REFERENCE_SUFFIXES[0])
+
+def prep_sim_lemur(metadata_loc, lemur_data_loc, out, working):
+    """Writes the genome lists (genome_list1.tsv with abundances, genome_list2.tsv without) of the genomes
+    Magnet called present, with their Lemur abundances normalized to sum to 100. The number of reads per
+    genome is planned from them afterwards, see plan_read_counts"""
     lemur_data = pd.read_csv(lemur_data_loc, delimiter='\t')
     print(lemur_data)
     metadata = pd.read_csv(metadata_loc)
-    genome_list = metadata[metadata['Presence/Absence'] == 'Present']
+    genome_list = metadata[metadata['Presence/Absence'] == 'Present'].copy()
     
-    ## get the abundances from lemur and normalize to sum to 100
-    genome_list['Abundance'] = genome_list['Taxonomy ID'].apply(lambda row: get_lemur_abundance(row, lemur_data))
+    ## get the abundances from lemur and normalize to sum to 100 (not rounded, rare taxa would round to 0)
+    genome_list['Abundance'] = lookup_abundances(genome_list['Taxonomy ID'], lemur_data, 'Target_ID', 'F')
     
     total_abundance = genome_list['Abundance'].sum()
     if total_abundance > 0:
-        genome_list['Abundance'] = np.round(genome_list['Abundance'] / total_abundance * 100, 2)
+        genome_list['Abundance'] = genome_list['Abundance'] / total_abundance * 100
     
     ## fix the locations names and drop unnecessary taxonomy column
-    genome_list['Assembly Accession ID'] = f'{working}/magnet/reference_genomes/' + genome_list['Assembly Accession ID'].astype(str) + '.fasta'
+    genome_list['Assembly Accession ID'] = [reference_genome_loc(f'{working}/magnet/reference_genomes', accession)
+                                            for accession in genome_list['Assembly Accession ID'].astype(str)]
 
     ## select final columns
     genome_list = genome_list[['Organism of Assembly', 'Assembly Accession ID', 'Abundance']]
     
-    abundances =  genome_list[['Organism of Assembly', 'Abundance']] 
-    
-    out_loc = os.path.join(out, 'abundances.tsv')
-    abundances.to_csv(out_loc, sep='\t', header=['Size', number_reads_generated], index=False)
-    
     out_loc = os.path.join(out, 'genome_list1.tsv')
     out_loc2 = os.path.join(out, 'genome_list2.tsv')
     genome_list.to_csv(out_loc, sep='\t', header=False, index=False)
@@ -85,23 +461,13 @@ def make_genome_list(metadata_loc, out):
     return genome_list
 
 
-def get_kraken_abundance(taxid, kraken_data):
-    try:
-        out = kraken_data[kraken_data['TaxID'] == taxid]
-        if not out.empty:
-            return out['Abundance'].values[0]
-        else:
-            return 0
-    except KeyError:
-        return 0
-
 def get_final_species_abundances(kraken_report, metadata_loc, out, number_reads_generated):
     # Read kraken report and metadata
     kraken_data = pd.read_csv(kraken_report, delimiter='\t', header=None, names=['Abundance', 'NumCovered', 'NumTaxon', 'Rank', 'TaxID', 'Name'])
     metadata = pd.read_csv(metadata_loc)
     
-    metadata = metadata[metadata['Presence/Absence'] == 'Present']
-    metadata['Abundance'] = metadata['Taxonomy ID'].apply(lambda row: get_kraken_abundance(row, kraken_data))
+    metadata = metadata[metadata['Presence/Absence'] == 'Present'].copy()
+    metadata['Abundance'] = lookup_abundances(metadata['Taxonomy ID'], kraken_data, 'TaxID', 'Abundance')
         
     total_abundance = metadata['Abundance'].sum()
     if total_abundance > 0:
@@ -114,7 +480,14 @@ def get_final_species_abundances(kraken_report, metadata_loc, out, number_reads_
       
     return abundances
 
+def read_genome_list(genome_list_loc):
+    """Reads back a genome list written by prep_sim_lemur (genome_list1.tsv or genome_list2.tsv)"""
+    genome_list = pd.read_csv(genome_list_loc, sep='\t', header=None, dtype={0: str, 1: str})
+    return genome_list.rename(columns={0: 'Organism of Assembly', 1: 'Assembly Accession ID', 2: 'Abundance'})
+
 def generate_species_file_info(genome_list, out):
+    """Writes NanoSim's species file (species, contig, circular/linear) with a row for every contig of every
+    genome, read from the genome's .fai index rather than the FASTA itself"""
     
     results = []
     for _, row in genome_list.iterrows():
@@ -122,18 +495,129 @@ def generate_species_file_info(genome_list, out):
         filename = row['Assembly Accession ID']  
         
         if os.path.exists(filename):
-            with open(filename, 'r') as file:
-                first_line = file.readline().strip()[1:]
+            for contig, *_ in fasta_index(filename):
+                results.append([species, contig, 'circular'])
         else:
-            first_line = 'File not found'
-        
-        results.append([species, first_line, 'circular'])
+            results.append([species, 'File not found', 'circular'])
     
-    species_info = pd.DataFrame(results, columns=['Species', 'FirstLine', 'Circular'])
+    species_info = pd.DataFrame(results, columns=['Species', 'Contig', 'Circular'])
     
     out_loc = os.path.join(out, 'species_info.tsv')
     species_info.to_csv(out_loc, sep='\t', header=False, index=False)
     
     return species_info
 
+def get_genome_sizes(genome_list):
+    """Total length in bases of every genome in the genome list (0 where the FASTA is missing), from its .fai index"""
+    sizes = [sum(record[1] for record in fasta_index(filename)) if os.path.exists(filename) else 0
+             for filename in genome_list['Assembly Accession ID']]
+    return pd.Series(sizes, index=genome_list.index, name='Genome Size')
+
+
+TRUTH_COLUMNS = ['read_id', 'true_taxid', 'species', 'assembly_accession', 'contig', 'strand', 'length', 'aligned', 'perfect']
+
+def parse_nanosim_read_name(read_id:str):
+    """Splits a NanoSim metagenome read name, e.g. Mycobacterium_cookii-NZ_CP012345.1_2331_aligned_17_F_0_1000_0,
+    into (species, contig, aligned, strand). Chimeric reads (segments joined by ';') are attributed to their first
+    segment. Fields that cannot be recovered are returned as empty strings."""
+    first_segment = read_id.split(';')[0]
+    species, _, rest = first_segment.partition('-')
+    species = species.replace('_', ' ')
+    
+    parts = rest.rsplit('_', 6)
+    if len(parts) == 7 and parts[1] in ('aligned', 'unaligned'):
+        contig = parts[0].rsplit('_', 1)[0]
+        return species, contig, parts[1] == 'aligned', parts[3]
+    return species, '', True, ''
+
+def load_species_taxids(metadata_loc):
+    """Reads the Magnet cluster_representative.csv into {organism name: (taxonomy id, assembly accession)}"""
+    metadata = pd.read_csv(metadata_loc)
+    return {row['Organism of Assembly']: (int(row['Taxonomy ID']), str(row['Assembly Accession ID']))
+            for _, row in metadata.iterrows()}
+
+TRUTH_TABLE_SUFFIXES = ['.parquet', '.tsv.gz']
+
+def truth_table_loc(out_loc:str):
+    """Where TruthTableWriter(out_loc) writes the truth table: Parquet when pyarrow is installed, a gzipped TSV otherwise"""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return out_loc + TRUTH_TABLE_SUFFIXES[1]
+    return out_loc + TRUTH_TABLE_SUFFIXES[0]
 
+class TruthTableWriter():
+    """Writes the per-read truth table incrementally, one batch of rows at a time. Uses Parquet when pyarrow is
+    installed and falls back to a gzipped TSV (same columns) otherwise; read it back with read_truth_table."""
+    
+    def __init__(self, out_loc:str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            self._pa = pyarrow
+            self.out_loc = out_loc if out_loc.endswith('.parquet') else out_loc + '.parquet'
+            self._schema = pyarrow.schema([('read_id', pyarrow.string()), ('true_taxid', pyarrow.int64()),
+                                           ('species', pyarrow.string()), ('assembly_accession', pyarrow.string()),
+                                           ('contig', pyarrow.string()), ('strand', pyarrow.string()),
+                                           ('length', pyarrow.int64()), ('aligned', pyarrow.bool_()),
+                                           ('perfect', pyarrow.bool_())])
+            self._writer = pyarrow.parquet.ParquetWriter(self.out_loc, self._schema)
+        except ImportError:
+            self._pa = None
+            self.out_loc = out_loc if out_loc.endswith('.tsv.gz') else out_loc + '.tsv.gz'
+            self._writer = None
+            self._header_written = False
+    
+    def write_batch(self, rows:dict):
+        if self._pa is not None:
+            self._writer.write_table(self._pa.Table.from_pydict(rows, schema=self._schema))
+        else:
+            pd.DataFrame(rows, columns=TRUTH_COLUMNS).to_csv(self.out_loc, sep='\t', index=False, compression='gzip',
+                                                           mode='a' if self._header_written else 'w',
+                                                           header=not self._header_written)
+            self._header_written = True
+    
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        elif self._pa is None and not self._header_written:
+            self.write_batch({c: [] for c in TRUTH_COLUMNS})
+
+def read_truth_table(truth_loc:str, columns=None):
+    """Reads a truth table written by TruthTableWriter (Parquet or TSV) into a DataFrame"""
+    if truth_loc.endswith('.parquet'):
+        return pd.read_parquet(truth_loc, columns=columns)
+    return pd.read_csv(truth_loc, sep='\t', usecols=columns, dtype={'read_id': str, 'contig': str, 'strand': str})
+
+def generate_truth_table(read_files, metadata_loc:str, out_loc:str, perfect:bool=False, batch_size:int=100000):
+    """Streams the simulated read files and writes one truth table row per read (read id, true taxid, source
+    accession/contig, strand, length, aligned and perfect flags), so scoring can join against it instead of
+    re-parsing read names. Returns the path of the written table."""
+    species_taxids = load_species_taxids(metadata_loc)
+    writer = TruthTableWriter(out_loc)
+    rows = {c: [] for c in TRUTH_COLUMNS}
+    
+    def flush():
+        writer.write_batch(rows)
+        for c in TRUTH_COLUMNS:
+            rows[c].clear()
+    
+    for read_file in read_files:
+        for name, seq, _ in iter_fastx(read_file):
+            species, contig, aligned, strand = parse_nanosim_read_name(name)
+            taxid, accession = species_taxids.get(species, (0, ''))
+            rows['read_id'].append(name)
+            rows['true_taxid'].append(taxid)
+            rows['species'].append(species)
+            rows['assembly_accession'].append(accession)
+            rows['contig'].append(contig)
+            rows['strand'].append(strand)
+            rows['length'].append(len(seq))
+            rows['aligned'].append(aligned)
+            rows['perfect'].append(perfect)
+            if len(rows['read_id']) >= batch_size:
+                flush()
+    if rows['read_id']:
+        flush()
+    writer.close()
+    return writer.out_loc
@@ -2,7 +2,7 @@
 Module to run Kraken2 and Braken2 on imput fastq files
 """
 import os
-import subprocess
+from src.instrumentation import run_command
 import pandas as pd
 import numpy as np
 
@@ -10,14 +10,14 @@ def run_lemur(fastq: str, lemur_db:str, working:str, threads:int=1, rank:str='sp
     """Runs lemur on ONT fastq file using lemur_db"""
     
     taxonomy = os.path.join(lemur_db, 'taxonomy.tsv')
-    subprocess.run(['lemur',
-                    '--i', fastq,
-                    '-o', working,
-                    '-d', lemur_db,
-                    '--tax-path', taxonomy,
-                    '-r', rank,
-                    '-t', str(threads)
-                    ], check=True)
+    run_command(['lemur',
+                 '--i', fastq,
+                 '-o', working,
+                 '-d', lemur_db,
+                 '--tax-path', taxonomy,
+                 '-r', rank,
+                 '-t', str(threads)
+                 ])
     
     return os.path.join(working, f'relative_abundance.tsv')
 
@@ -31,20 +31,20 @@ def run_kraken2(fastq:str, kraken2_db:str, working:str, threads:int=1, fastq2=No
     
     #run kraken db on paired reads
     if fastq2 is not None:
-        subprocess.run(['kraken2',
-                        '--db', kraken2_db,
-                        '--threads', str(threads),
-                        '--output', output,
-                        '--report', report,
-                        '--paired',
-                        fastq, fastq2], check=True)
+        run_command(['kraken2',
+                     '--db', kraken2_db,
+                     '--threads', str(threads),
+                     '--output', output,
+                     '--report', report,
+                     '--paired',
+                     fastq, fastq2])
     else:
-        subprocess.run(['kraken2',
-                        '--db', kraken2_db,
-                        '--threads', str(threads),
-                        '--output', output,
-                        '--report', report,
-                        fastq], check=True)
+        run_command(['kraken2',
+                     '--db', kraken2_db,
+                     '--threads', str(threads),
+                     '--output', output,
+                     '--report', report,
+                     fastq])
         
     return report
         
@@ -69,13 +69,13 @@ def run_bracken(kraken_report,
                     '-t', read_threshold,
                     '-o', bracken_output)
     
-    subprocess.run(['bracken',
-                    '-d', kraken2_db,
-                    '-i', kraken_report,
-                    '-r', read_length,
-                    '-l', classification_level,
-                    '-t', read_threshold,
-                    '-o', bracken_output], check=True)
+    run_command(['bracken',
+                 '-d', kraken2_db,
+                 '-i', kraken_report,
+                 '-r', str(read_length),
+                 '-l', classification_level,
+                 '-t', str(read_threshold),
+                 '-o', bracken_output])
     
     return bracken_output
 
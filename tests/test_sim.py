@@ -0,0 +1,118 @@
+"""
+Regression tests of src/sim.py: lookup_abundances against the per-row lookups it replaced in
+prep_sim_lemur (get_lemur_abundance) and get_final_species_abundances (get_kraken_abundance), and the
+memory bound of subsample_training_reads. Run from the repository root with `python -m pytest tests`
+"""
+import heapq
+import random
+
+import numpy as np
+import pandas as pd
+
+from src import sim
+from src.fastq_stats import profile_fastx
+from src.sim import lookup_abundances, subsample_training_reads
+
+def get_lemur_abundance(taxid, lemur_data):
+    """The original per-row lookup: one boolean-mask scan of the whole table per taxid"""
+    try:
+        out = lemur_data[lemur_data['Target_ID'] == taxid]
+        if not out.empty:
+            return out['F'].values[0]
+        else:
+            return 0
+    except KeyError:
+        return 0
+
+def get_kraken_abundance(taxid, kraken_data):
+    try:
+        out = kraken_data[kraken_data['TaxID'] == taxid]
+        if not out.empty:
+            return out['Abundance'].values[0]
+        else:
+            return 0
+    except KeyError:
+        return 0
+
+def synthetic_tables(n_rows:int=20000, n_genomes:int=5000, seed:int=0):
+    """A large Lemur-like table (duplicate taxids, missing abundances, missing taxids) and the taxids of the
+    genomes Magnet called present, some of which are not in the table"""
+    rng = np.random.default_rng(seed)
+    taxids = rng.integers(1, n_rows, size=n_rows)
+    abundances = rng.random(n_rows)
+    abundances[rng.random(n_rows) < 0.05] = np.nan
+    lemur_data = pd.DataFrame({'Target_ID': taxids, 'F': abundances})
+    genome_taxids = pd.Series(rng.integers(1, 2 * n_rows, size=n_genomes), name='Taxonomy ID')
+    return lemur_data, genome_taxids
+
+def test_lookup_abundances_matches_per_row_lookup():
+    lemur_data, genome_taxids = synthetic_tables()
+    assert lemur_data['Target_ID'].duplicated().any()
+    assert lemur_data['F'].isna().any()
+    assert (~genome_taxids.isin(lemur_data['Target_ID'])).any()
+
+    expected = genome_taxids.apply(lambda taxid: get_lemur_abundance(taxid, lemur_data)).astype(float)
+    result = lookup_abundances(genome_taxids, lemur_data, 'Target_ID', 'F')
+
+    assert result.index.equals(genome_taxids.index)
+    ## the one intended difference: a taxid whose first row has no abundance used to leak NaN, it is now 0
+    nan_rows = expected.isna()
+    assert nan_rows.any()
+    assert (result[nan_rows] == 0).all()
+    np.testing.assert_array_equal(result[~nan_rows].to_numpy(), expected[~nan_rows].to_numpy())
+
+def test_lookup_abundances_kraken_columns():
+    """get_final_species_abundances does the same lookup in a Kraken table, by TaxID"""
+    lemur_data, genome_taxids = synthetic_tables(n_rows=2000, n_genomes=500, seed=1)
+    kraken_data = lemur_data.rename(columns={'Target_ID': 'TaxID', 'F': 'Abundance'}).fillna({'Abundance': 0.5})
+    expected = genome_taxids.apply(lambda taxid: get_kraken_abundance(taxid, kraken_data)).astype(float)
+    result = lookup_abundances(genome_taxids, kraken_data, 'TaxID', 'Abundance')
+    np.testing.assert_array_equal(result.to_numpy(), expected.to_numpy())
+
+class CountingHeapq():
+    """heapq that tracks how many records the reservoirs hold at most"""
+
+    def __init__(self):
+        self.live, self.peak = 0, 0
+
+    def heappush(self, heap, item):
+        heapq.heappush(heap, item)
+        self.live += 1
+        self.peak = max(self.peak, self.live)
+
+    def heappop(self, heap):
+        self.live -= 1
+        return heapq.heappop(heap)
+
+def write_fastq(path, n_reads:int, seed:int=0):
+    """Reads of lengths spread over many powers of two, so there are many strata"""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(n_reads):
+            length = int(rng.lognormvariate(7, 1.5)) + 1
+            f.write(f'@read{i}\n{"ACGT" * (length // 4) + "A" * (length % 4)}\n+\n{"I" * length}\n')
+    return str(path)
+
+def test_subsample_training_reads_holds_only_the_caps(tmp_path, monkeypatch):
+    fastq = write_fastq(tmp_path / 'in.fastq', 20000)
+    stats = profile_fastx(fastq)
+    n_strata = len({length.bit_length() for length in stats.length_counts})
+    assert n_strata > 8
+
+    for max_reads, max_bases in [(200, None), (None, 200000), (300, 100000)]:
+        counting = CountingHeapq()
+        monkeypatch.setattr(sim, 'heapq', counting)
+        n_reads, n_bases = subsample_training_reads(fastq, str(tmp_path / 'a.fastq'), max_reads=max_reads, max_bases=max_bases,
+                                                    seed=1, length_counts=stats.length_counts)
+        monkeypatch.setattr(sim, 'heapq', heapq)
+        ## every stratum holds its share of the caps, plus at most one read while trimming (and one for rounding)
+        if max_reads is not None:
+            assert n_reads <= max_reads + n_strata
+            assert counting.peak <= max_reads + 2 * n_strata
+        if max_bases is not None:
+            assert n_bases <= max_bases
+            assert counting.peak < 1000
+
+        ## the strata sizes from a counting pass give the same subset as the ones from the profile
+        subsample_training_reads(fastq, str(tmp_path / 'b.fastq'), max_reads=max_reads, max_bases=max_bases, seed=1)
+        assert (tmp_path / 'a.fastq').read_text() == (tmp_path / 'b.fastq').read_text()